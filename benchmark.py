@@ -0,0 +1,357 @@
+"""
+Benchmarks of the tagging hot paths, stage by stage.
+
+    python benchmark.py --output bench.json
+    python benchmark.py --compare bench.json --tolerance 0.15
+
+Everything runs against a tiny ONNX model and a synthetic tag list generated
+into a temporary directory (needs the onnx package), so no network is used
+and the numbers only move when the code or the libraries under it do.
+
+Stages, timed separately:
+    decode               load_image on PNG/JPEG files
+    preprocess           Interrogator.preprocess (tagger.preprocessing)
+    preprocess_legacy    the former dbimutils chain, for reference
+    data_generator       tagger.generator.data_reader.DataGenerator over all images
+    infer                InferenceSession.run through Interrogator.infer, per batch size
+    build_results        Interrogator.to_dicts, the dicts returned by interrogate
+    postprocess_tags     thresholding and sorting those dicts
+    postprocess          thresholding the confidents matrix directly
+    write_sidecar        writing the txt sidecar files
+    write_jsonl          the same results through the bulk JSONL sink
+    write_sqlite         and through the SQLite sink, one transaction per batch
+    startup              importing wd_tagger and gui in a fresh interpreter, and
+                         the GUI's time to first paint (needs a display)
+
+The slowest imports of gui, from python -X importtime, are listed under
+"import_profile".
+
+Results are medians over --repeat runs, in milliseconds per image. With
+--compare, any stage more than --tolerance slower than the baseline is
+reported and the exit code is 1.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+from PIL import Image
+
+from tagger import dbimutils
+from tagger.benchmarking import environment, measure, summarize
+from tagger.generator.data_reader import DataGenerator
+from tagger.interrogator import Interrogator, WaifuDiffusionInterrogator
+from tagger.pipeline import load_image
+from tagger.sinks import JsonlSink, SidecarSink, SqliteSink
+
+SEED = 0
+
+REPO_DIR = Path(__file__).resolve().parent
+
+# (width, height), image mode, file format
+IMAGE_CASES = [
+    ((512, 512), 'RGB', 'JPEG'),
+    ((2048, 1536), 'RGB', 'JPEG'),
+    ((6000, 4000), 'RGB', 'JPEG'),
+    ((2048, 1536), 'RGBA', 'PNG'),
+    ((2048, 1536), 'L', 'PNG'),
+]
+QUICK_IMAGE_CASES = IMAGE_CASES[:2] + IMAGE_CASES[3:]
+
+BATCH_SIZES = [1, 4, 8, 16]
+
+
+def make_model(path: Path, input_size=448, num_tags=10000) -> None:
+    """
+    A WD-shaped model, (N, S, S, 3) BGR in, (N, 4 + num_tags) sigmoid out,
+    doing a strided convolution and a linear layer so that inference still
+    reads the whole input.
+    """
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+
+    rng = np.random.default_rng(SEED)
+    conv = rng.standard_normal((16, 3, 8, 8)).astype(np.float32) / 64
+    dense = rng.standard_normal((16, 4 + num_tags)).astype(np.float32)
+    bias = rng.standard_normal(4 + num_tags).astype(np.float32) - 1
+
+    nodes = [
+        helper.make_node('Transpose', ['input'], ['nchw'], perm=[0, 3, 1, 2]),
+        helper.make_node('Conv', ['nchw', 'conv'], ['features'], strides=[8, 8]),
+        helper.make_node('Relu', ['features'], ['activations']),
+        helper.make_node('GlobalAveragePool', ['activations'], ['pooled']),
+        helper.make_node('Flatten', ['pooled'], ['flat']),
+        helper.make_node('MatMul', ['flat', 'dense'], ['logits']),
+        helper.make_node('Add', ['logits', 'bias'], ['shifted']),
+        helper.make_node('Sigmoid', ['shifted'], ['output']),
+    ]
+    graph = helper.make_graph(
+        nodes, 'benchmark',
+        [helper.make_tensor_value_info(
+            'input', TensorProto.FLOAT, ['batch', input_size, input_size, 3])],
+        [helper.make_tensor_value_info(
+            'output', TensorProto.FLOAT, ['batch', 4 + num_tags])],
+        [numpy_helper.from_array(conv, 'conv'),
+         numpy_helper.from_array(dense, 'dense'),
+         numpy_helper.from_array(bias, 'bias')])
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)])
+    model.ir_version = 7
+    onnx.save(model, str(path))
+
+
+def make_tags(path: Path, num_tags=10000) -> None:
+    """ selected_tags.csv with the 4 ratings first, like the real ones """
+    rows = ['tag_id,name,category,count']
+    for i, rating in enumerate(['general', 'sensitive', 'questionable', 'explicit']):
+        rows.append(f'{i},{rating},9,0')
+    for i in range(num_tags):
+        # a share of names that need escaping or underscore handling
+        name = f'tag_{i}' if i % 3 else f'tag_(series_{i})'
+        rows.append(f'{i + 4},{name},{4 if i % 10 == 0 else 0},{num_tags - i}')
+    path.write_text('\n'.join(rows) + '\n')
+
+
+def make_image(size, mode: str, rng) -> Image.Image:
+    """ Smooth gradients plus noise, closer to photos than pure noise """
+    width, height = size
+    small = rng.integers(0, 256, (max(1, height // 64), max(1, width // 64), 4), dtype=np.uint8)
+    pixels = np.asarray(Image.fromarray(small, 'RGBA').resize(size, Image.Resampling.BILINEAR))
+    pixels = pixels.copy()
+    pixels[:, :, :3] ^= rng.integers(0, 16, (height, width, 3), dtype=np.uint8)
+    image = Image.fromarray(pixels, 'RGBA')
+    return image if mode == 'RGBA' else image.convert(mode)
+
+
+def legacy_preprocess(image: Image.Image, size: int) -> np.ndarray:
+    """ The dbimutils chain WaifuDiffusionInterrogator used before tagger.preprocessing """
+    image = dbimutils.fill_transparent(image)
+    pixels = np.asarray(image)[:, :, ::-1]
+    pixels = dbimutils.make_square(pixels, size)
+    return dbimutils.smart_resize(pixels, size)
+
+
+def import_seconds(module: str) -> float:
+    """ Time to import module in a fresh interpreter, without the interpreter's own startup """
+    code = (
+        'import time; start = time.perf_counter(); '
+        f'import {module}; print(time.perf_counter() - start)')
+    output = subprocess.run(
+        [sys.executable, '-c', code], cwd=REPO_DIR,
+        capture_output=True, text=True, check=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def first_paint_seconds(work: Path) -> float:
+    """ gui.py --startup-report, run in work so it writes its config.ini there """
+    result = subprocess.run(
+        [sys.executable, str(REPO_DIR / 'gui.py'), '--startup-report'],
+        cwd=work, capture_output=True, text=True, timeout=60)
+    for line in result.stdout.splitlines():
+        if line.startswith('{'):
+            return json.loads(line)['first_paint_seconds']
+    raise RuntimeError((result.stdout + result.stderr).strip().splitlines()[-1:])
+
+
+def import_profile(module: str, top=15) -> List[Dict]:
+    """ The imports of module with the largest cumulative time, from python -X importtime """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=REPO_DIR, capture_output=True, text=True, check=True)
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        entries.append({
+            'module': name.strip(),
+            'depth': (len(name) - len(name.lstrip()) - 1) // 2,
+            'self_ms': int(own) / 1000,
+            'cumulative_ms': int(cumulative) / 1000,
+        })
+    entries.sort(key=lambda entry: entry['cumulative_ms'], reverse=True)
+    return entries[:top]
+
+
+def measure_startup(work: Path, repeat: int, record: Callable[[str, Dict], None]) -> List[Dict]:
+    """ Cold start timings, each from a fresh interpreter, returns the import profile of gui """
+    for module in ('wd_tagger', 'gui'):
+        record(f'startup/import_{module}', summarize(
+            [import_seconds(module) * 1000 for _ in range(repeat)]))
+
+    try:
+        record('startup/first_paint', summarize(
+            [first_paint_seconds(work) * 1000 for _ in range(repeat)]))
+    except (RuntimeError, subprocess.SubprocessError) as e:
+        print(f'Skipping startup/first_paint, the GUI did not start: {e}')
+
+    profile = import_profile('gui')
+    for entry in profile:
+        print(f'  {"  " * entry["depth"]}{entry["module"]:<40} {entry["cumulative_ms"]:9.1f} ms')
+    return profile
+
+
+def run(args: argparse.Namespace) -> Dict:
+    with tempfile.TemporaryDirectory(prefix='booruvision-bench-') as work:
+        return run_in(Path(work), args)
+
+
+def run_in(work: Path, args: argparse.Namespace) -> Dict:
+    rng = np.random.default_rng(SEED)
+    results: Dict[str, Dict] = {}
+    make_model(work / 'model.onnx', args.input_size, args.tags)
+    make_tags(work / 'selected_tags.csv', args.tags)
+
+    def record(key: str, timing: Dict) -> None:
+        results[key] = timing
+        print(f'{key:<48} {timing["median_ms"]:9.3f} ms')
+
+    profile = []
+    if not args.skip_startup:
+        profile = measure_startup(work, args.repeat, record)
+
+    interrogator = WaifuDiffusionInterrogator('benchmark', model_dir=work)
+    interrogator.set_session_options({
+        'intra_op_num_threads': args.threads,
+        'inter_op_num_threads': 1,
+    })
+    interrogator.ensure_loaded()
+    size = interrogator.input_size()
+
+    inputs: List[np.ndarray] = []
+    paths: List[Path] = []
+    for (width, height), mode, image_format in (QUICK_IMAGE_CASES if args.quick else IMAGE_CASES):
+        name = f'{width}x{height}-{mode}'
+        path = work / f'{name}.{image_format.lower()}'
+        make_image((width, height), mode, rng).save(path, image_format)
+        paths.append(path)
+
+        record(f'decode/{name}', measure(lambda: load_image(path), args.repeat))
+        fits = interrogator.fits_input
+        if image_format == 'JPEG':
+            record(f'decode_reduced/{name}',
+                   measure(lambda: load_image(path, fits), args.repeat))
+
+        image = load_image(path)
+        record(f'preprocess/{name}',
+               measure(lambda: interrogator.preprocess(image), args.repeat))
+        record(f'preprocess_legacy/{name}',
+               measure(lambda: legacy_preprocess(image, size), args.repeat))
+        inputs.append(interrogator.preprocess(image))
+
+    record('data_generator', measure(
+        lambda: list(DataGenerator(paths, size, size, batch_size=len(paths))),
+        args.repeat, per=len(paths)))
+
+    confidents = None
+    for batch_size in BATCH_SIZES:
+        batch = [inputs[i % len(inputs)] for i in range(batch_size)]
+        record(f'infer/batch{batch_size}', measure(
+            lambda: interrogator.infer(batch, batch_size=batch_size),
+            args.repeat, per=batch_size))
+        confidents = interrogator.infer(batch, batch_size=batch_size)
+
+    count = len(confidents)
+    record('build_results', measure(
+        lambda: interrogator.to_dicts(confidents), args.repeat, per=count))
+    dicts = interrogator.to_dicts(confidents)
+    record('postprocess_tags', measure(
+        lambda: [Interrogator.postprocess_tags(tags, args.threshold) for _, tags in dicts],
+        args.repeat, per=count))
+    record('postprocess', measure(
+        lambda: interrogator.postprocess(confidents, args.threshold),
+        args.repeat, per=count))
+
+    write = SidecarSink(interrogator, args.threshold)
+    sidecar_paths = [work / f'sidecar{i}.png' for i in range(count)]
+    record('write_sidecar', measure(
+        lambda: [write(path, row) for path, row in zip(sidecar_paths, confidents)],
+        args.repeat, per=count))
+
+    def write_bulk(make_sink):
+        with make_sink() as sink:
+            for path, row in zip(sidecar_paths, confidents):
+                sink(path, row)
+
+    with open(work / 'results.jsonl', 'w', encoding='utf-8') as out:
+        record('write_jsonl', measure(
+            lambda: write_bulk(lambda: JsonlSink(interrogator, args.threshold, out)),
+            args.repeat, per=count))
+    record('write_sqlite', measure(
+        lambda: write_bulk(lambda: SqliteSink(interrogator, args.threshold, work / 'results.sqlite')),
+        args.repeat, per=count))
+    # release the model file before the directory goes
+    interrogator.unload()
+
+    return {
+        'environment': environment(),
+        'config': {
+            'input_size': args.input_size,
+            'tags': args.tags,
+            'threads': args.threads,
+            'threshold': args.threshold,
+            'repeat': args.repeat,
+            'quick': args.quick,
+        },
+        'results': results,
+        'import_profile': profile,
+    }
+
+
+def compare(current: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """ Stages that got more than tolerance slower than in baseline """
+    regressions = []
+    for key, timing in current['results'].items():
+        base = baseline['results'].get(key)
+        if base is None:
+            continue
+        ratio = timing['median_ms'] / base['median_ms'] if base['median_ms'] else 1.0
+        if ratio > 1 + tolerance:
+            regressions.append(
+                f'{key}: {base["median_ms"]:.3f} -> {timing["median_ms"]:.3f} ms '
+                f'({(ratio - 1) * 100:+.0f}%)')
+    if current['config'] != baseline.get('config'):
+        print('Warning: the baseline was run with a different configuration')
+    return regressions
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the tagging stages')
+    parser.add_argument('-o', '--output', help='write the results as JSON')
+    parser.add_argument('--compare', help='baseline JSON from an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='slowdown that counts as a regression, 0.15 is 15%%')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=1,
+                        help='onnxruntime intra-op threads, pinned to keep runs comparable')
+    parser.add_argument('--input-size', type=int, default=448)
+    parser.add_argument('--tags', type=int, default=10000)
+    parser.add_argument('--threshold', type=float, default=0.35)
+    parser.add_argument('--quick', action='store_true', help='skip the largest images')
+    parser.add_argument('--skip-startup', action='store_true',
+                        help='skip the import and first paint timings')
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'Regression {regression}')
+        if regressions:
+            return 1
+        print(f'No stage is more than {args.tolerance:.0%} slower than the baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,26 +1,82 @@
-from PIL import ImageGrab, Image
+import time
+# taken before anything else is imported, see --startup-report
+start_time = time.perf_counter()
 import sys
 from PyQt5.QtWidgets import QApplication, QMainWindow, QPushButton, QLabel, QVBoxLayout, QWidget, QCheckBox, QComboBox, QTableWidget, QTableWidgetItem
 from PyQt5.QtGui import QCloseEvent, QPixmap, QClipboard, QImage, QIcon
-from PyQt5.QtCore import Qt, QTimer
-from wd_tagger import wd_tagger
+from PyQt5.QtCore import Qt, QTimer, QObject, QRunnable, QThreadPool, pyqtSignal
+from wd_tagger import wd_tagger, read_session_options
 from PyQt5.QtWidgets import QFileDialog
 import configparser
 import os
 import platform
-import time
+import json
 from hotkey import QtKeyBinder, PynputKeyBinder, KeyBinderBase
+from tagger import metrics
+# numpy, onnxruntime and the models are imported after the window is shown, see warm_up
+from wd_tagger import warm_up
+
+imports_done_time = time.perf_counter()
 
 platform_system = platform.system()
 
+# QImage formats whose bytes PIL can read as they are, on every platform
+QIMAGE_PIL_MODES = {
+    QImage.Format.Format_RGBA8888: "RGBA",
+    QImage.Format.Format_RGBX8888: "RGBX",
+    QImage.Format.Format_RGB888: "RGB",
+    QImage.Format.Format_Grayscale8: "L",
+}
+
 def QImage_to_PIL(qimage):
-    qimage = qimage.convertToFormat(QImage.Format.Format_RGB32)
-    # swap R and B channels
-    qimage = qimage.rgbSwapped()
-    data = qimage.bits().asstring(qimage.byteCount())
-    pilimage = Image.frombuffer("RGBA", (qimage.width(), qimage.height()), data, 'raw', "RGBA", 0, 1)
+    """Wrap the QImage pixels in a PIL image without copying them.
+    The returned image shares memory with qimage, so keep qimage alive while it is in use."""
+    from PIL import Image
+
+    if qimage.format() not in QIMAGE_PIL_MODES:
+        qimage = qimage.convertToFormat(QImage.Format.Format_RGBA8888)
+    mode = QIMAGE_PIL_MODES[qimage.format()]
+    ptr = qimage.constBits()
+    ptr.setsize(qimage.sizeInBytes())
+    pilimage = Image.frombuffer(mode, (qimage.width(), qimage.height()), memoryview(ptr), 'raw', mode, qimage.bytesPerLine(), 1)
+    # frombuffer only holds the buffer, pin the QImage that owns it as well
+    pilimage.info["qimage"] = qimage
     return pilimage
 
+class AnalyzeSignals(QObject):
+    progress = pyqtSignal(int, str)
+    finished = pyqtSignal(int, object)
+    failed = pyqtSignal(int, str)
+
+class AnalyzeTask(QRunnable):
+    """Runs one analysis on the thread pool, so model loading and inference never block the event loop"""
+    def __init__(self, requestId, tagger, source, isStale):
+        super().__init__()
+        self.requestId = requestId
+        self.tagger = tagger
+        # a file path or the full resolution QImage, never the scaled preview
+        self.source = source
+        self.isStale = isStale
+        self.signals = AnalyzeSignals()
+        self.queuedAt = time.perf_counter()
+
+    def run(self):
+        metrics.observe("stage_seconds", time.perf_counter() - self.queuedAt, stage="gui_queue_wait")
+        # a newer request came in while this one was queued, drop it
+        if self.isStale(self.requestId):
+            metrics.inc("gui_stale_requests_total")
+            return
+        try:
+            if not self.tagger.is_model_loaded():
+                self.signals.progress.emit(self.requestId, "Loading model...")
+            if isinstance(self.source, QImage):
+                tags = self.tagger.tag_image_by_pil(QImage_to_PIL(self.source))
+            else:
+                tags = self.tagger.tag_image_by_path(self.source)
+            self.signals.finished.emit(self.requestId, tags)
+        except Exception as e:
+            self.signals.failed.emit(self.requestId, str(e))
+
 def resource_path(relative):
     if hasattr(sys, '_MEIPASS'):
         return os.path.join(sys._MEIPASS, relative)
@@ -98,11 +154,12 @@ class TagDisplay(QWidget):
             self.formated_tags = self.tags
         elif self.tag_format == "Stable Diffusion":
             print("Stable Diffusion format selected")
-            formatted_tags = {}
-            for tag, confidence in self.tags.items():
-                tag = tag.replace("_", " ").replace("(", r"\(").replace(")", r"\)")
-                formatted_tags[tag] = confidence
-            self.formated_tags = formatted_tags
+            from tagger.vocabulary import Vocabulary
+
+            # precomputed by the model's vocabulary, tags outside it are formatted on the spot
+            vocabulary = self.parent.tagger.vocabulary() or Vocabulary([])
+            names = vocabulary.format_names(self.tags, replace_underscore=True, escape=True)
+            self.formated_tags = dict(zip(names, self.tags.values()))
         
         self.parent.saveConfig()
 
@@ -119,23 +176,44 @@ class TagDisplay(QWidget):
         return tagString
 
 class ImageInterrogator(QMainWindow):
-    def __init__(self):
+    modelReady = pyqtSignal(str)
+
+    def __init__(self, startupReport=False):
         super().__init__()
+        self.startupReport = startupReport
+        self.firstPaintTime = None
         self.setWindowIcon(QIcon(resource_path("icon.ico")))
         self.windowTittle = "Image Interrogator"
         self.setWindowTitle(self.windowTittle)
         self.setGeometry(100, 100, self.calc_size(800, 600)[0], self.calc_size(800, 600)[1])
         self.tagger = wd_tagger()
         self.tagDisplay = None
+        # what gets analyzed: the original QImage or the path of the loaded file
+        self.analysisSource = None
         self.tag_format = "booru"
         self.currentKeybind = "Ctrl+Shift+I"
         self.modelName = "wd-swinv2-v3"
         self.threshold = 0.35
+        self.resultCache = ""
+        self.resultCacheSizeMB = 1024
+        # 0 keeps every loaded model
+        self.modelMemoryBudgetMB = 0
+        self.unloadIdleSeconds = 0
+        # [Session] and [Session.<model>] sections, written back as they are
+        self.sessionConfig = {}
+        self.metricsConfig = {}
         self.taskQueue = []
+        # one worker, so the tagger is never used by two threads at once
+        self.analyzePool = QThreadPool()
+        self.analyzePool.setMaxThreadCount(1)
+        self.analyzeRequestId = 0
+        self.bringToFrontOnResult = False
         self.taskTimer = QTimer()
         self.taskTimer.timeout.connect(self.dealWithQueue)
         self.taskTimer.setInterval(50)
         self.taskTimer.start()
+        self.modelReady.connect(self.onModelReady)
+        self.tagger.on_model_ready = self.modelReady.emit
         self.readConfig()
         if platform_system != "Darwin":
             self.keybinder = QtKeyBinder(self.winId())
@@ -144,6 +222,26 @@ class ImageInterrogator(QMainWindow):
         self.keybinder.register_hotkey(self.currentKeybind, self.addFastAnalyzeToQueue)
         self.initUI()
     
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if self.firstPaintTime is None:
+            self.firstPaintTime = time.perf_counter()
+            # heavy imports and model loading wait until the window is up
+            QTimer.singleShot(0, self.afterFirstPaint)
+
+    def afterFirstPaint(self):
+        metrics.observe("stage_seconds", self.firstPaintTime - start_time, stage="first_paint")
+        warm_up()
+        if self.tagger.preload:
+            self.setWindowTitle(f"{self.windowTittle} - Loading model...")
+            self.tagger.preload_model()
+        if self.startupReport:
+            print(json.dumps({
+                "imports_seconds": imports_done_time - start_time,
+                "first_paint_seconds": self.firstPaintTime - start_time,
+            }), flush=True)
+            QApplication.quit()
+
     def saveConfig(self):
         print("Saving config...")
         try:
@@ -151,14 +249,25 @@ class ImageInterrogator(QMainWindow):
             config["GUI"] = {
                 "shortcut": self.currentKeybind,
                 "unload_model_when_done": self.tagger.unloadAfterAnalysis,
+                "preload_model": self.tagger.preload,
                 "tag_format": self.tag_format
             }
             config["Tagger"] = {
                 "model": self.modelName,
-                "threshold": self.threshold
+                "threshold": self.threshold,
+                "ensemble_merge": self.tagger.ensemble_merge,
+                "result_cache": self.resultCache,
+                "result_cache_size_mb": self.resultCacheSizeMB,
+                "reduced_decoding": self.tagger.reduced_decoding,
+                "model_memory_budget_mb": self.modelMemoryBudgetMB,
+                "unload_idle_seconds": self.unloadIdleSeconds
             }
             if self.tagDisplay:
                 config["GUI"]["tag_format"] = self.tagDisplay.tag_format
+            for section, values in self.sessionConfig.items():
+                config[section] = values
+            if self.metricsConfig:
+                config["Metrics"] = self.metricsConfig
             with open("config.ini", "w") as configfile:
                 config.write(configfile)
         except Exception as e:
@@ -173,10 +282,34 @@ class ImageInterrogator(QMainWindow):
             config.read("config.ini")
             self.currentKeybind = config["GUI"]["shortcut"]
             self.tagger.unloadAfterAnalysis = config["GUI"].getboolean("unload_model_when_done")
+            self.tagger.preload = config["GUI"].getboolean("preload_model", False)
             self.tag_format = config["GUI"]["tag_format"]
             self.modelName = config["Tagger"]["model"]
             self.threshold = float(config["Tagger"]["threshold"])
+            self.tagger.ensemble_merge = config["Tagger"].get("ensemble_merge", "mean")
             self.tagger.set_threshold_and_model(self.threshold, self.modelName)
+            self.resultCache = config["Tagger"].get("result_cache", "")
+            self.resultCacheSizeMB = config["Tagger"].getint("result_cache_size_mb", 1024)
+            self.tagger.set_cache(self.resultCache, self.resultCacheSizeMB << 20)
+            self.tagger.reduced_decoding = config["Tagger"].getboolean("reduced_decoding", True)
+            self.modelMemoryBudgetMB = config["Tagger"].getint("model_memory_budget_mb", 0)
+            self.unloadIdleSeconds = config["Tagger"].getfloat("unload_idle_seconds", 0)
+            self.tagger.set_pool_limits(self.modelMemoryBudgetMB << 20, self.unloadIdleSeconds)
+            self.sessionConfig = {
+                section: dict(config[section]) for section in config.sections()
+                if section == "Session" or section.startswith("Session.")
+            }
+            self.tagger.configure_sessions(*read_session_options(config))
+            if "Metrics" in config and not metrics.enabled:
+                self.metricsConfig = dict(config["Metrics"])
+                section = config["Metrics"]
+                metrics.configure(
+                    enable_metrics=section.getboolean("enabled", True),
+                    port=section.getint("port", 0),
+                    json_log=section.get("json_log", ""),
+                    interval=section.getfloat("interval", 10.0),
+                    sample_rate=section.getfloat("profile_sample_rate", 0.0),
+                    trace_dir=section.get("profile_dir", ""))
         except Exception as e:
             print("Error reading config file")
             self.saveConfig()
@@ -217,7 +350,7 @@ class ImageInterrogator(QMainWindow):
 
         # Button to analyze the image
         self.analyzeButton = QPushButton("Analyze Image")
-        self.analyzeButton.clicked.connect(self.analyzeImage)
+        self.analyzeButton.clicked.connect(lambda: self.analyzeImage())
 
         # Checkbox for unload model after every analysis
         self.unloadModelCheckbox = QCheckBox("Unload model after every analysis")
@@ -271,21 +404,28 @@ class ImageInterrogator(QMainWindow):
         self.saveConfig()
 
     def addFastAnalyzeToQueue(self, Optional=None):
-        self.taskQueue.append(self.fastAnalyzeImageFromClipboard)
-        if len(self.taskQueue) > 1:
+        # repeated presses before the queue is handled collapse into one job
+        if self.fastAnalyzeImageFromClipboard in self.taskQueue:
             return
+        self.taskQueue.append(self.fastAnalyzeImageFromClipboard)
+        metrics.queue_depth("hotkey", len(self.taskQueue))
     
     def dealWithQueue(self):
-        for task in self.taskQueue:
+        # the hotkey listener may append from another thread, swap the list first
+        tasks, self.taskQueue = self.taskQueue, []
+        if tasks:
+            metrics.queue_depth("hotkey", 0)
+        for task in tasks:
             task()
-        self.taskQueue = []
 
 
     def fastAnalyzeImageFromClipboard(self):
         if self.tagDisplay:
             self.tagDisplay.close()
         self.loadImageFromClipboard()
-        self.analyzeImage()
+        self.analyzeImage(bringToFront=True)
+
+    def bringResultsToFront(self):
         #If window is minimized, restore it
         self.showNormal()
         #bring the main window to the front
@@ -301,6 +441,7 @@ class ImageInterrogator(QMainWindow):
         if image.isNull() or not image:
             print("Clipboard does not contain an image!")
             return
+        self.analysisSource = image
         pixmap = QPixmap.fromImage(image)
         self.imageLabel.setPixmap(pixmap.scaled(self.imageLabel.width(), self.imageLabel.height(), Qt.KeepAspectRatio))
 
@@ -309,6 +450,7 @@ class ImageInterrogator(QMainWindow):
         try:
             if imagePath:
                 pixmap = QPixmap(imagePath)
+                self.analysisSource = imagePath
                 self.imageLabel.setPixmap(pixmap.scaled(self.imageLabel.width(), self.imageLabel.height(), Qt.KeepAspectRatio))
         except Exception as e:
             self.imageLabel.setText("Error loading image!")
@@ -325,23 +467,58 @@ class ImageInterrogator(QMainWindow):
             self.tagger.unloadAfterAnalysis = False
             self.saveConfig()
 
-    def analyzeImage(self):
+    def isStaleRequest(self, requestId):
+        return requestId != self.analyzeRequestId
+
+    def analyzeImage(self, bringToFront=False):
         print("Analyze the image...")
-        if not self.imageLabel.pixmap():
+        if not self.imageLabel.pixmap() or self.analysisSource is None:
             print("No image to analyze!")
             return
         self.setWindowTitle(f"{self.windowTittle} - Analyzing...")
-        pilimage = QImage_to_PIL(self.imageLabel.pixmap().toImage())
-        tags = self.tagger.tag_image_by_pil(pilimage)
+
+        # a new request makes any queued or running one stale
+        self.analyzeRequestId += 1
+        self.bringToFrontOnResult = bringToFront
+        task = AnalyzeTask(self.analyzeRequestId, self.tagger, self.analysisSource, self.isStaleRequest)
+        task.signals.progress.connect(self.onAnalyzeProgress)
+        task.signals.finished.connect(self.onAnalyzeFinished)
+        task.signals.failed.connect(self.onAnalyzeFailed)
+        self.analyzePool.start(task)
+        return self.analyzeRequestId
+
+    def onModelReady(self, model):
+        print(f"Model {model} is ready")
+        if self.windowTitle() == f"{self.windowTittle} - Loading model...":
+            self.setWindowTitle(f"{self.windowTittle} - {model} ready")
+
+    def onAnalyzeProgress(self, requestId, message):
+        if self.isStaleRequest(requestId):
+            return
+        self.setWindowTitle(f"{self.windowTittle} - {message}")
+
+    def onAnalyzeFinished(self, requestId, tags):
+        if self.isStaleRequest(requestId):
+            return
         print(tags)
         self.setWindowTitle(f"{self.windowTittle}")
+        if self.tagDisplay:
+            self.tagDisplay.close()
         self.displayResults(tags)
-        return tags
+        if self.bringToFrontOnResult:
+            self.bringResultsToFront()
+
+    def onAnalyzeFailed(self, requestId, error):
+        if self.isStaleRequest(requestId):
+            return
+        print(f"Error analyzing image: {error}")
+        self.setWindowTitle(f"{self.windowTittle} - Error analyzing image")
 
 if __name__ == "__main__":
     try:
         app = QApplication(sys.argv)
-        window = ImageInterrogator()
+        # print import and first paint times as JSON and exit, used by benchmark.py
+        window = ImageInterrogator(startupReport="--startup-report" in sys.argv)
         window.show()
         sys.exit(app.exec_())
     except Exception as e:
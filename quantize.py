@@ -0,0 +1,417 @@
+"""
+Quantized variants of the registered models, and how they compare to FP32.
+
+    python quantize.py -m wd-swinv2-v3 --calibration path/to/images
+    python quantize.py --all --variants int8-dynamic int8-static --calibration path/to/images
+
+Variants:
+    int8-dynamic    MatMul and Gemm weights stored as int8, activations
+                    quantized on the fly. Needs no calibration and suits
+                    the transformer models (ViT, SwinV2) best
+    int8-static     weights and activations in int8 (QDQ format, per channel
+                    weights), with activation ranges from the calibration
+                    images. Also covers the convolutions of ConvNeXt and MOAT
+    fp16            weights and activations in float16, inputs and outputs
+                    stay float32. Needs onnxconverter-common, halves the
+                    model file but is rarely faster on CPU
+
+Each variant is written to <output-dir>/<model>-<variant>/ next to a copy of
+the tag list, and registered in the model manifest (~/.config/booruvision/models.json,
+or the file named by BOORUVISION_MODELS) as <model>-<variant>, so it can be
+selected like any other model. Existing variants are reused, unless --force.
+
+The calibration folder's images are split: the first --calibration-samples
+calibrate int8-static, the others are used for the report, or all of them
+when there are not enough. The report compares every variant with FP32 at
+--threshold, with FP32's tags taken as the truth:
+    tag_agreement       share of (image, tag) decisions that are the same
+    exact_match         share of images with the same tag set
+    precision, recall   of the variant's tags, and their f1
+    rating_agreement    share of images with the same top rating
+    mean_abs_diff, max_abs_diff   of the confidences
+    worst_tags          the tags whose decision changes most often
+    latency             median ms per image at batch size 1 and --batch-size
+    speedup             FP32 latency over the variant's, at --batch-size
+    memory_mb           resident memory added by loading the model and running
+                        one batch of --batch-size, in a fresh process
+    file_mb             size of the model file
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from tagger.benchmarking import environment, measure
+from tagger.interrogator import Interrogator
+from tagger.pipeline import load_image
+from wd_tagger import IMAGE_EXTENSIONS
+
+VARIANTS = ['int8-dynamic', 'int8-static', 'fp16']
+
+# run in a fresh interpreter, prints the resident bytes added by the model
+_MEMORY_PROBE = '''
+import json, os, resource, sys
+import numpy as np
+import onnxruntime as ort
+
+def resident():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # the peak instead, in bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+base = resident()
+session = ort.InferenceSession(sys.argv[1], providers=['CPUExecutionProvider'])
+input_ = session.get_inputs()[0]
+shape = [d if isinstance(d, int) and d > 0 else int(sys.argv[2]) for d in input_.shape]
+session.run(None, {input_.name: np.zeros(shape, dtype=np.float32)})
+print(json.dumps(resident() - base))
+'''
+
+
+def image_files(folder: os.PathLike) -> List[Path]:
+    return sorted(
+        p for p in Path(folder).rglob('*')
+        if p.is_file() and p.suffix.lower() in IMAGE_EXTENSIONS)
+
+
+def capture_feeds(interrogator: Interrogator, inputs: List[np.ndarray]) -> List[Dict]:
+    """ The tensors infer feeds the model, one image each, as calibration data """
+    feeds = []
+    run_model = interrogator.run_model
+
+    def record(output_names, feed):
+        # infer reuses its batch buffer, keep copies
+        feeds.append({name: np.array(value) for name, value in feed.items()})
+        return run_model(output_names, feed)
+
+    interrogator.run_model = record
+    try:
+        interrogator.infer(inputs, batch_size=1)
+    finally:
+        del interrogator.run_model
+    return feeds
+
+
+def preprocessed_model(source: Path, work: Path) -> Path:
+    """ The model with shapes inferred and graph optimized, as quantization expects """
+    import importlib.util
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    target = work / 'preprocessed.onnx'
+    try:
+        # symbolic shape inference needs sympy, ONNX's own covers these models
+        quant_pre_process(
+            str(source), str(target),
+            skip_symbolic_shape=importlib.util.find_spec('sympy') is None)
+        return target
+    except Exception as e:
+        print(f'Quantizing without pre-processing, it failed: {e}')
+        return source
+
+
+def build_dynamic(source: Path, target: Path, work: Path) -> None:
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    # dynamic Conv becomes ConvInteger, which is slower than float on CPU
+    quantize_dynamic(
+        str(preprocessed_model(source, work)), str(target),
+        op_types_to_quantize=['MatMul', 'Gemm'], weight_type=QuantType.QInt8)
+
+
+def build_static(source: Path, target: Path, work: Path, feeds: List[Dict], method='minmax') -> None:
+    from onnxruntime.quantization import (
+        CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType, quantize_static)
+
+    if not feeds:
+        raise ValueError('int8-static needs calibration images')
+
+    class FeedReader(CalibrationDataReader):
+        def __init__(self) -> None:
+            self.feeds = iter(feeds)
+
+        def get_next(self) -> Optional[Dict]:
+            return next(self.feeds, None)
+
+    methods = {
+        'minmax': CalibrationMethod.MinMax,
+        'entropy': CalibrationMethod.Entropy,
+        'percentile': CalibrationMethod.Percentile,
+    }
+    quantize_static(
+        str(preprocessed_model(source, work)), str(target), FeedReader(),
+        quant_format=QuantFormat.QDQ, per_channel=True,
+        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+        calibrate_method=methods[method])
+
+
+def build_fp16(source: Path, target: Path, work: Path) -> None:
+    import onnx
+    try:
+        from onnxconverter_common import float16
+    except ImportError as e:
+        raise ImportError('fp16 variants need onnxconverter-common, pip install onnxconverter-common') from e
+
+    model = float16.convert_float_to_float16(onnx.load(str(source)), keep_io_types=True)
+    onnx.save(model, str(target))
+
+
+def register_variant(interrogator: Interrogator, name: str, directory: Path) -> Interrogator:
+    """ Register the model in directory as name, like the original but local """
+    from tagger.interrogators import interrogator_types, register_local_model, save_manifest
+
+    kind = next(k for k, t in interrogator_types.items() if isinstance(interrogator, t))
+    tags_path = interrogator.resolve(interrogator.tags_path)
+    if not (directory / interrogator.tags_path).is_file():
+        shutil.copyfile(tags_path, directory / interrogator.tags_path)
+    kwargs = {'model_path': interrogator.model_path, 'tags_path': interrogator.tags_path}
+    variant = register_local_model(name, str(directory.resolve()), kind, **kwargs)
+    save_manifest()
+    return variant
+
+
+def model_memory(model_path: Path, batch_size: int) -> Optional[int]:
+    try:
+        result = subprocess.run(
+            [sys.executable, '-c', _MEMORY_PROBE, str(model_path), str(batch_size)],
+            capture_output=True, text=True, check=True, timeout=600)
+        return json.loads(result.stdout.strip().splitlines()[-1])
+    except (subprocess.SubprocessError, ValueError, IndexError) as e:
+        print(f'Could not measure the memory of {model_path}: {e}')
+        return None
+
+
+def profile(interrogator: Interrogator, inputs: List[np.ndarray], args: argparse.Namespace) -> Dict:
+    """ Confidents for inputs, latency and memory of one model """
+    interrogator.ensure_loaded()
+    confidents = interrogator.infer(inputs, batch_size=args.batch_size)
+
+    latency = {}
+    for batch_size in sorted({1, args.batch_size}):
+        batch = inputs[:batch_size]
+        latency[f'batch_{batch_size}'] = measure(
+            lambda: interrogator.infer(batch, batch_size=batch_size),
+            args.repeat, per=len(batch))
+
+    memory = model_memory(interrogator.model_file, args.batch_size)
+    return {
+        'confidents': confidents,
+        'latency': latency,
+        'memory_mb': memory / (1 << 20) if memory is not None else None,
+        'file_mb': os.path.getsize(interrogator.model_file) / (1 << 20),
+    }
+
+
+def compare(
+    reference: np.ndarray,
+    candidate: np.ndarray,
+    rating_count: int,
+    names: List[str],
+    threshold: float
+) -> Dict:
+    """ How candidate's results differ from reference's, see the module docstring """
+    expected = reference[:, rating_count:] >= threshold
+    actual = candidate[:, rating_count:] >= threshold
+    true_positives = int((expected & actual).sum())
+    predicted = int(actual.sum())
+    relevant = int(expected.sum())
+    precision = true_positives / predicted if predicted else 1.0
+    recall = true_positives / relevant if relevant else 1.0
+    diff = np.abs(reference - candidate)
+
+    flips = (expected != actual).sum(axis=0)
+    worst = np.argsort(-flips, kind='stable')[:10]
+    return {
+        'tag_agreement': float((expected == actual).mean()),
+        'exact_match': float((expected == actual).all(axis=1).mean()),
+        'precision': precision,
+        'recall': recall,
+        'f1': 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+        'rating_agreement': float((
+            reference[:, :rating_count].argmax(axis=1)
+            == candidate[:, :rating_count].argmax(axis=1)).mean()) if rating_count else 1.0,
+        'mean_abs_diff': float(diff.mean()),
+        'max_abs_diff': float(diff.max()),
+        'worst_tags': {
+            names[rating_count + i]: int(flips[i]) for i in worst if flips[i]
+        },
+    }
+
+
+def quantize_model(name: str, images: List[Path], args: argparse.Namespace) -> Dict:
+    from tagger.interrogators import get_interrogator
+
+    interrogator = get_interrogator(name)
+    session_options = {'intra_op_num_threads': args.threads} if args.threads else {}
+    interrogator.set_session_options(session_options)
+    interrogator.ensure_loaded()
+    source = Path(interrogator.model_file)
+
+    calibration = images[:args.calibration_samples]
+    evaluation = images[args.calibration_samples:]
+    if len(evaluation) < args.batch_size:
+        print(f'Only {len(evaluation)} images left after calibration, evaluating on all of them')
+        evaluation = images
+
+    def preprocess(paths):
+        inputs = []
+        for path in paths:
+            try:
+                inputs.append(interrogator.preprocess(load_image(path)))
+            except Exception as e:
+                print(f'Error reading {path}: {e}')
+        return inputs
+
+    print(f'{name}: profiling FP32 on {len(evaluation)} images')
+    eval_inputs = preprocess(evaluation)
+    reference = profile(interrogator, eval_inputs, args)
+    names = interrogator.ratings.tolist() + interrogator.tags.tolist()
+    rating_count = len(interrogator.ratings)
+    feeds = None
+
+    report = {
+        'model': name,
+        'images': len(eval_inputs),
+        'fp32': {k: v for k, v in reference.items() if k != 'confidents'},
+        'variants': {},
+    }
+    base_latency = reference['latency'][f'batch_{args.batch_size}']['median_ms']
+
+    for variant in args.variants:
+        variant_name = f'{name}-{variant}'
+        directory = Path(args.output_dir) / variant_name
+        target = directory / interrogator.model_path
+        if args.force or not target.is_file():
+            print(f'{name}: building {variant}')
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.TemporaryDirectory(prefix='booruvision-quantize-') as work:
+                try:
+                    if variant == 'int8-dynamic':
+                        build_dynamic(source, target, Path(work))
+                    elif variant == 'int8-static':
+                        if feeds is None:
+                            feeds = capture_feeds(interrogator, preprocess(calibration))
+                        build_static(source, target, Path(work), feeds, args.calibration_method)
+                    else:
+                        build_fp16(source, target, Path(work))
+                except Exception as e:
+                    print(f'{name}: could not build {variant}: {e}')
+                    report['variants'][variant] = {'error': str(e)}
+                    continue
+
+        quantized = register_variant(interrogator, variant_name, directory)
+        quantized.set_session_options(session_options)
+        print(f'{name}: profiling {variant_name}')
+        result = profile(quantized, eval_inputs, args)
+        quantized.unload()
+
+        latency = result['latency'][f'batch_{args.batch_size}']['median_ms']
+        report['variants'][variant] = {
+            'name': variant_name,
+            **compare(reference['confidents'], result['confidents'], rating_count, names,
+                      args.threshold),
+            'latency': result['latency'],
+            'speedup': base_latency / latency if latency else None,
+            'memory_mb': result['memory_mb'],
+            'file_mb': result['file_mb'],
+        }
+
+    interrogator.unload()
+    return report
+
+
+def print_report(report: Dict, batch_size: int) -> None:
+    def row(label, entry, agreement=''):
+        latency = entry['latency'][f'batch_{batch_size}']['median_ms']
+        memory = entry['memory_mb']
+        memory = f'{memory:8.0f}' if memory is not None else '       -'
+        print(f'  {label:<14} {latency:10.2f} ms {memory} MB {entry["file_mb"]:8.1f} MB  {agreement}')
+
+    for model in report['models']:
+        print(f'{model["model"]}, {model["images"]} images, latency at batch size {batch_size}, '
+              'memory, file size')
+        row('fp32', model['fp32'])
+        for variant, entry in model['variants'].items():
+            if 'error' in entry:
+                print(f'  {variant:<14} failed: {entry["error"]}')
+                continue
+            row(variant, entry, (
+                f'{entry["speedup"]:.2f}x, agreement {entry["tag_agreement"]:.4f}, '
+                f'precision {entry["precision"]:.3f}, recall {entry["recall"]:.3f}'))
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Build quantized model variants and compare them with FP32')
+    parser.add_argument('-m', '--model', action='append', default=[],
+                        help='registered model to quantize, can be repeated')
+    parser.add_argument('--all', action='store_true', help='quantize every registered model')
+    parser.add_argument('--variants', nargs='+', choices=VARIANTS,
+                        default=['int8-dynamic', 'int8-static'])
+    parser.add_argument('-c', '--calibration', required=True,
+                        help='folder of images to calibrate and evaluate with')
+    parser.add_argument('--calibration-samples', type=int, default=64)
+    parser.add_argument('--calibration-method', choices=['minmax', 'entropy', 'percentile'],
+                        default='minmax')
+    parser.add_argument('-d', '--output-dir', default='quantized',
+                        help='where the variants are written')
+    parser.add_argument('-o', '--report', default='',
+                        help='report JSON, <output-dir>/report.json by default')
+    parser.add_argument('-t', '--threshold', type=float, default=0.35)
+    parser.add_argument('-b', '--batch-size', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=0,
+                        help='onnxruntime intra-op threads, all cores by default')
+    parser.add_argument('--force', action='store_true', help='rebuild existing variants')
+    args = parser.parse_args(argv)
+
+    from tagger.interrogators import all_interrogators
+
+    interrogators = all_interrogators()
+    names = list(interrogators) if args.all else args.model
+    # variants of variants make no sense
+    names = [n for n in names if not any(n.endswith(f'-{v}') for v in VARIANTS)]
+    if not names:
+        parser.error('name a model with -m, or use --all')
+    for name in names:
+        if name not in interrogators:
+            parser.error(f'unknown model {name}')
+
+    images = image_files(args.calibration)
+    if not images:
+        parser.error(f'no images in {args.calibration}')
+
+    report = {
+        'environment': environment(),
+        'config': {
+            'threshold': args.threshold,
+            'batch_size': args.batch_size,
+            'threads': args.threads,
+            'calibration_samples': args.calibration_samples,
+            'calibration_method': args.calibration_method,
+            'repeat': args.repeat,
+        },
+        'models': [quantize_model(name, images, args) for name in names],
+    }
+
+    path = Path(args.report or Path(args.output_dir) / 'report.json')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print_report(report, args.batch_size)
+    print(f'Report written to {path}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
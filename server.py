@@ -0,0 +1,245 @@
+"""
+Local HTTP inference service, so several tools can share one loaded model.
+
+    python server.py --model wd-swinv2-v3 --port 8000
+
+Concurrent requests for the same model are gathered into micro-batches, see
+tagger.batcher.MicroBatcher. Endpoints:
+
+    GET  /health        the process is up
+    GET  /ready         the default model is loaded and warmed up (503 until then)
+    GET  /models        registered models, whether they are loaded, their memory and load counts
+    GET  /metrics       Prometheus metrics, see tagger.metrics (--metrics or BOORUVISION_METRICS=1)
+    POST /tag           multipart image uploads in the "files" field
+    POST /tag/paths     {"paths": [...]}, images read from this machine's disk
+
+Both tag endpoints take optional model and threshold query parameters, and
+return {"results": [{"ratings": {...}, "tags": {...}}, ...]} in input order.
+
+Models stay loaded once used. With --memory-budget-mb the least recently
+used ones are unloaded to make room, and with --idle-unload-seconds those
+nobody asked for in a while are unloaded, see tagger.pool.ModelPool. The
+default model is never unloaded.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import os
+from io import BytesIO
+from typing import Dict, List, Optional
+
+from fastapi import FastAPI, File, HTTPException, Query, UploadFile
+from fastapi.responses import JSONResponse, PlainTextResponse
+from PIL import Image
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+
+from tagger.batcher import MicroBatcher
+from tagger.interrogator import Interrogator
+from tagger.interrogators import all_interrogators, get_interrogator
+from tagger.pipeline import load_image
+from tagger.pool import default_pool as pool
+import tagger.preprocessing as preprocessing
+from tagger import metrics
+
+default_model = os.environ.get('BOORUVISION_MODEL', 'wd-swinv2-v3')
+max_batch_size = int(os.environ.get('BOORUVISION_MAX_BATCH_SIZE', '8'))
+# seconds the first request of a batch may wait for others to join it
+max_latency = float(os.environ.get('BOORUVISION_MAX_LATENCY_MS', '10')) / 1000
+memory_budget = int(os.environ.get('BOORUVISION_MEMORY_BUDGET_MB', '0')) << 20
+idle_unload_seconds = float(os.environ.get('BOORUVISION_IDLE_UNLOAD_SECONDS', '0'))
+
+_batchers: Dict[str, MicroBatcher] = {}
+
+
+@contextlib.asynccontextmanager
+async def lifespan(_app: FastAPI):
+    pool.configure(memory_budget, idle_unload_seconds)
+    interrogator = get_batcher(default_model).interrogator
+    pool.pin(interrogator)
+    # ready turns true once the default model is loaded and warmed up
+    interrogator.preload()
+    yield
+    for batcher in _batchers.values():
+        batcher.close()
+
+
+app = FastAPI(title='booruvision', lifespan=lifespan)
+
+
+class PathsRequest(BaseModel):
+    paths: List[str]
+
+
+def get_batcher(model: str) -> MicroBatcher:
+    if model not in _batchers:
+        try:
+            interrogator = get_interrogator(model)
+        except KeyError:
+            raise HTTPException(404, f'Unknown model {model}')
+        _batchers[model] = MicroBatcher(interrogator, max_batch_size, max_latency)
+    return _batchers[model]
+
+
+def decode_upload(data: bytes, interrogator: Interrogator) -> Image.Image:
+    image = Image.open(BytesIO(data))
+    preprocessing.draft(image, interrogator.fits_input)
+    image.load()
+    return image
+
+
+async def tag_images(images, model: str, threshold: float) -> Dict:
+    """ images are callables returning a decoded image, run off the event loop """
+    batcher = get_batcher(model)
+    interrogator = batcher.interrogator
+    # the first request loads the model, the others wait for it here, and
+    # the pool won't unload it until this request is done
+    await run_in_threadpool(pool.acquire, interrogator)
+    try:
+        return await run_batch(images, model, threshold, batcher)
+    finally:
+        pool.release(interrogator)
+
+
+async def run_batch(images, model: str, threshold: float, batcher: MicroBatcher) -> Dict:
+    interrogator = batcher.interrogator
+
+    def prepare(load):
+        try:
+            with metrics.stage('decode'):
+                image = load()
+            with metrics.stage('preprocess'):
+                return interrogator.preprocess(image)
+        except Exception as e:
+            raise HTTPException(400, f'Cannot read image: {e}')
+
+    inputs = await asyncio.gather(
+        *(run_in_threadpool(prepare, load) for load in images))
+    rows = await asyncio.gather(
+        *(asyncio.wrap_future(batcher.submit(x)) for x in inputs))
+
+    results = []
+    for row in rows:
+        ratings, _ = interrogator.split_confidents(row)
+        results.append({
+            'ratings': {
+                name: float(c)
+                for name, c in zip(interrogator.ratings.tolist(), ratings)
+            },
+            'tags': {
+                name: float(c)
+                for name, c in interrogator.postprocess(row, threshold).items()
+            },
+        })
+    return {'model': model, 'results': results}
+
+
+@app.get('/health')
+def health() -> Dict:
+    return {'status': 'ok'}
+
+
+@app.get('/ready')
+def ready():
+    interrogator = get_batcher(default_model).interrogator
+    if not interrogator.ready.is_set():
+        return JSONResponse({'ready': False, 'model': default_model}, status_code=503)
+    return {'ready': True, 'model': default_model}
+
+
+@app.get('/models')
+def models() -> Dict:
+    stats = pool.stats()
+    return {
+        'default': default_model,
+        'memory_bytes': stats['memory_bytes'],
+        'max_memory_bytes': stats['max_memory_bytes'],
+        'evictions': stats['evictions'],
+        'models': [
+            {
+                'name': name,
+                'loaded': interrogator.is_loaded(),
+                # the pool knows models by their own name, an ensemble by its members
+                'memory_bytes': sum(
+                    stats['models'].get(member.name, {}).get('memory_bytes', 0)
+                    for member in getattr(interrogator, 'members', [interrogator])),
+                'loads': interrogator.loads,
+                'unloads': interrogator.unloads,
+                'batching': _batchers[name].stats() if name in _batchers else None,
+            }
+            for name, interrogator in all_interrogators().items()
+        ],
+    }
+
+
+@app.get('/metrics')
+def prometheus_metrics():
+    if not metrics.enabled:
+        raise HTTPException(404, 'Metrics are disabled')
+    return PlainTextResponse(
+        metrics.prometheus_text(), media_type='text/plain; version=0.0.4')
+
+
+@app.post('/tag')
+async def tag(
+    files: List[UploadFile] = File(...),
+    model: Optional[str] = Query(None),
+    threshold: float = Query(0.35),
+) -> Dict:
+    model = model or default_model
+    interrogator = get_batcher(model).interrogator
+    uploads = [await f.read() for f in files]
+    return await tag_images(
+        [lambda data=data: decode_upload(data, interrogator) for data in uploads],
+        model, threshold)
+
+
+@app.post('/tag/paths')
+async def tag_paths(
+    request: PathsRequest,
+    model: Optional[str] = Query(None),
+    threshold: float = Query(0.35),
+) -> Dict:
+    model = model or default_model
+    interrogator = get_batcher(model).interrogator
+    return await tag_images(
+        [lambda path=path: load_image(path, interrogator.fits_input)
+         for path in request.paths],
+        model, threshold)
+
+
+def main() -> None:
+    global default_model, max_batch_size, max_latency, memory_budget, idle_unload_seconds
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description='Local tagging service')
+    # paths are read from this machine's disk, so only listen locally by default
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--model', default=default_model,
+                        help='model used when a request names none, preloaded at startup')
+    parser.add_argument('--max-batch-size', type=int, default=max_batch_size)
+    parser.add_argument('--max-latency-ms', type=float, default=max_latency * 1000)
+    parser.add_argument('--memory-budget-mb', type=int, default=memory_budget >> 20,
+                        help='unload least recently used models to stay within this, 0 for no limit')
+    parser.add_argument('--idle-unload-seconds', type=float, default=idle_unload_seconds,
+                        help='unload models unused for this long, 0 to keep them')
+    parser.add_argument('--metrics', action='store_true', help='record metrics for /metrics')
+    parser.add_argument('--profile-sample-rate', type=float, default=0.0,
+                        help='share of inference calls traced by the onnxruntime profiler')
+    args = parser.parse_args()
+
+    if args.metrics or args.profile_sample_rate:
+        metrics.configure(sample_rate=args.profile_sample_rate)
+
+    default_model = args.model
+    max_batch_size = args.max_batch_size
+    max_latency = args.max_latency_ms / 1000
+    memory_budget = args.memory_budget_mb << 20
+    idle_unload_seconds = args.idle_unload_seconds
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Dynamic micro-batching of concurrent inference requests"""
+
+import threading
+import time
+from concurrent.futures import Future
+from queue import Empty, Queue
+from typing import Dict
+
+import numpy as np
+
+from tagger.interrogator import Interrogator
+from tagger import metrics
+
+# sentinel that stops the batching thread
+_STOP = object()
+
+
+class MicroBatcher:
+    """
+    Collects preprocessed inputs submitted from many threads and runs them
+    through one interrogator in batches. A batch is started as soon as
+    max_batch_size inputs are waiting, or max_latency seconds after its
+    first input arrived, whichever comes first. An idle batcher therefore
+    adds at most max_latency to a lone request, while a busy one fills
+    whole batches.
+
+    Inference runs on a single thread, so the session is never entered
+    concurrently and every batch gets all of its intra-op threads.
+    """
+
+    def __init__(
+        self,
+        interrogator: Interrogator,
+        max_batch_size=8,
+        max_latency=0.01
+    ) -> None:
+        self.interrogator = interrogator
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_latency = max_latency
+        self.queue = Queue()
+        self.batches = 0
+        self.items = 0
+        self.thread = threading.Thread(
+            target=self._run, name=f'batcher-{interrogator.name}', daemon=True)
+        self.thread.start()
+
+    def submit(self, x) -> Future:
+        """ Queue one preprocessed input, the future resolves to its confidents row """
+        future = Future()
+        self.queue.put((x, future))
+        return future
+
+    def stats(self) -> Dict:
+        return {
+            'batches': self.batches,
+            'items': self.items,
+            'mean_batch_size': self.items / self.batches if self.batches else 0,
+            'queued': self.queue.qsize(),
+        }
+
+    def close(self) -> None:
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except Empty:
+                break
+            if item is _STOP:
+                # finish this batch first
+                self.queue.put(_STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            first = self.queue.get()
+            if first is _STOP:
+                return
+            batch = self._collect(first)
+            metrics.queue_depth(f'batcher-{self.interrogator.name}', self.queue.qsize())
+            # cancelled requests don't need a slot in the batch
+            batch = [
+                (x, future) for x, future in batch
+                if future.set_running_or_notify_cancel()
+            ]
+            if not batch:
+                continue
+
+            try:
+                confidents = self.interrogator.infer(
+                    [x for x, _ in batch], batch_size=self.max_batch_size)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.items += len(batch)
+            metrics.inc('images_total', len(batch), model=self.interrogator.name)
+            for (_, future), row in zip(batch, confidents):
+                # rows of one batch share a matrix, copy so results can outlive it
+                future.set_result(np.array(row))
@@ -0,0 +1,45 @@
+"""Timing helpers shared by benchmark.py and quantize.py"""
+
+import os
+import platform
+import statistics
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+
+
+def summarize(times: List[float]) -> Dict:
+    return {
+        'median_ms': statistics.median(times),
+        'min_ms': min(times),
+        'max_ms': max(times),
+    }
+
+
+def measure(fn: Callable[[], object], repeat: int, per: int = 1) -> Dict:
+    """ Median and spread of fn in milliseconds, divided by per items """
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000 / per)
+    return summarize(times)
+
+
+def environment() -> Dict:
+    """ Versions and machine the numbers were taken with """
+    import cv2
+    import onnxruntime
+    import PIL
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'onnxruntime': onnxruntime.__version__,
+        'pillow': PIL.__version__,
+        'opencv': cv2.__version__,
+    }
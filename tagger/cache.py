@@ -0,0 +1,176 @@
+"""Persistent content-addressed cache of raw model confidents"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+def image_digest(image: Image.Image) -> str:
+    """ Hash the decoded pixels, so re-encoded or renamed copies still match """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f'{image.mode}:{image.size[0]}x{image.size[1]}:'.encode())
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    Stores the raw confidence vector returned by Interrogator.infer, keyed by
+    image digest and model id, in a SQLite database. Thresholds and output
+    formats are applied after the lookup, so changing them never needs a new
+    inference.
+
+    The database runs in WAL mode, so several processes can share one cache
+    file. Once it grows past max_size bytes the least recently used entries
+    are evicted.
+
+    Hits don't write, their access times are collected and written together
+    every touch_batch hits or touch_interval seconds. The total size is kept
+    as a running sum, counted again from the table on every eviction and
+    every resync_interval seconds, to catch up with other processes.
+    """
+
+    def __init__(
+        self,
+        path='tag_cache.sqlite',
+        max_size=1 << 30,
+        touch_batch=256,
+        touch_interval=5.0,
+        resync_interval=60.0
+    ) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.touch_batch = touch_batch
+        self.touch_interval = touch_interval
+        self.resync_interval = resync_interval
+        self.lock = threading.Lock()
+        # (digest, model) -> access time not written yet
+        self.touched: Dict[Tuple[str, str], float] = {}
+        self.last_touch_write = time.monotonic()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            ' digest TEXT NOT NULL,'
+            ' model TEXT NOT NULL,'
+            ' data BLOB NOT NULL,'
+            ' size INTEGER NOT NULL,'
+            ' accessed REAL NOT NULL,'
+            ' PRIMARY KEY (digest, model))'
+        )
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS results_lru ON results (accessed, size)')
+        self.db.commit()
+        self._count_size()
+
+    def _count_size(self) -> None:
+        self.total_size, = self.db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM results').fetchone()
+        self.last_resync = time.monotonic()
+
+    def get(self, digest: str, model: str) -> Optional[np.ndarray]:
+        with self.lock:
+            row = self.db.execute(
+                'SELECT data FROM results WHERE digest = ? AND model = ?',
+                (digest, model)
+            ).fetchone()
+            if row is None:
+                return None
+            self.touched[(digest, model)] = time.time()
+            if (
+                len(self.touched) >= self.touch_batch
+                or time.monotonic() - self.last_touch_write >= self.touch_interval
+            ):
+                self._write_touched()
+                self.db.commit()
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def _write_touched(self) -> None:
+        """ Write the collected access times, the caller commits """
+        if self.touched:
+            self.db.executemany(
+                'UPDATE results SET accessed = ? WHERE digest = ? AND model = ?',
+                [(accessed, digest, model) for (digest, model), accessed in self.touched.items()]
+            )
+            self.touched.clear()
+        self.last_touch_write = time.monotonic()
+
+    def put(self, digest: str, model: str, confidents: np.ndarray) -> None:
+        self.put_many([(digest, model, confidents)])
+
+    def put_many(self, items: Iterable[Tuple[str, str, np.ndarray]]) -> None:
+        """ Insert several entries in one transaction """
+        now = time.time()
+        rows = []
+        for digest, model, confidents in items:
+            data = np.ascontiguousarray(confidents, dtype=np.float32).tobytes()
+            rows.append((digest, model, data, len(data), now))
+
+        with self.lock:
+            # replaced entries no longer count
+            for digest, model, _, size, _ in rows:
+                old = self.db.execute(
+                    'SELECT size FROM results WHERE digest = ? AND model = ?',
+                    (digest, model)
+                ).fetchone()
+                self.total_size += size - (old[0] if old else 0)
+            self.db.executemany(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)', rows)
+            if time.monotonic() - self.last_resync >= self.resync_interval:
+                self._count_size()
+            self.evict()
+            self.db.commit()
+
+    def evict(self) -> None:
+        """ Drop least recently used entries until the cache fits max_size """
+        if not self.max_size or self.total_size <= self.max_size:
+            return
+
+        # other processes may have added or evicted entries meanwhile
+        self._count_size()
+        if self.total_size <= self.max_size:
+            return
+        # the order has to see the latest hits
+        self._write_touched()
+
+        excess = self.total_size - self.max_size
+        cursor = self.db.execute(
+            'SELECT rowid, size FROM results ORDER BY accessed')
+        doomed = []
+        for rowid, size in cursor:
+            doomed.append((rowid,))
+            excess -= size
+            self.total_size -= size
+            if excess <= 0:
+                break
+        self.db.executemany('DELETE FROM results WHERE rowid = ?', doomed)
+
+    def flush(self) -> None:
+        """ Write the collected access times now """
+        with self.lock:
+            self._write_touched()
+            self.db.commit()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.db.execute('DELETE FROM results')
+            self.db.commit()
+            self.touched.clear()
+            self.total_size = 0
+
+    def close(self) -> None:
+        with self.lock:
+            self._write_touched()
+            self.db.commit()
+            self.db.close()
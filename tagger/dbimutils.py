@@ -4,6 +4,8 @@ import cv2
 import numpy as np
 from PIL import Image
 
+from tagger.preprocessing import cv2_reduced_flag
+
 
 def fill_transparent(image: Image.Image, color='WHITE'):
     image = image.convert('RGBA')
@@ -28,13 +30,19 @@ def resize(pic: Image.Image, size: int, keep_ratio=True) -> Image.Image:
     return pic.resize(target_size, resample=Image.Resampling.LANCZOS)
 
 
-def smart_imread(img, flag=cv2.IMREAD_UNCHANGED):
-    """ Read an image, convert to 24-bit if necessary """
+def smart_imread(img, flag=cv2.IMREAD_UNCHANGED, fits=None):
+    """ Read an image, convert to 24-bit if necessary
+
+    With fits(width, height), a JPEG read with IMREAD_COLOR or IMREAD_GRAYSCALE
+    is decoded at the largest IMREAD_REDUCED_* scale that still fits
+    """
     if img.endswith(".gif"):
         img = Image.open(img)
         img = img.convert("RGB")
         img = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
     else:
+        if fits is not None:
+            flag = cv2_reduced_flag(img, flag, fits)
         img = cv2.imread(img, flag)
     return img
 
@@ -0,0 +1,208 @@
+"""
+The tf.data pipeline of the former tf_data_reader.DataGenerator (credits to
+SmilingWolf), on PIL, OpenCV and a thread pool instead of TensorFlow.
+
+Every step does what its TensorFlow counterpart did: WebP and everything
+else decoded with their native channels, gray repeated to three channels,
+alpha blended onto white in float32 and truncated, RGB flipped to BGR,
+images larger than the target shrunk with AREA resampling keeping the
+aspect ratio and rounded half to even, then centered on white. Lossless
+formats come out the same, JPEGs can differ by the decoders' rounding.
+
+Like the TensorFlow version, no tagging path uses it: the GUI, wd_tagger
+and server.py go through tagger.pipeline and Interrogator.preprocess.
+It is kept for scripts, and measured by benchmark.py.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import TYPE_CHECKING, Iterable, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+if TYPE_CHECKING:
+    from tagger.interrogator import Interrogator
+
+
+def decode(contents: bytes) -> np.ndarray:
+    """
+    HxWxC uint8 with the image's own channels, like tf.io.decode_image with
+    channels=0: 1 gray, 2 gray and alpha, 3 RGB or 4 RGBA. Only the first
+    frame of an animation is decoded, and GIFs never have alpha.
+    """
+    image = Image.open(BytesIO(contents))
+    image.seek(0)
+
+    if image.format == 'GIF':
+        image = image.convert('RGB')
+    elif image.mode in ('I;16', 'I;16B', 'I;16L', 'I;16N'):
+        # libpng strips 16 bit samples to their high byte
+        pixels = (np.asarray(image, dtype=np.uint16) >> 8).astype(np.uint8)
+        return pixels[:, :, np.newaxis]
+    elif image.mode in ('L', 'LA', 'RGB', 'RGBA'):
+        if 'transparency' in image.info:
+            image = image.convert('LA' if image.mode == 'L' else 'RGBA')
+    elif image.mode == '1':
+        image = image.convert('L')
+    elif image.mode == 'P' or image.mode == 'PA':
+        has_alpha = image.mode == 'PA' or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+    else:
+        image = image.convert('RGB')
+
+    pixels = np.asarray(image)
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, np.newaxis]
+    return pixels
+
+
+class DataGenerator:
+    """
+    Batches of images read, decoded, resized and padded by a thread pool.
+    At most prefetch batches are prepared ahead of the one being consumed,
+    so memory stays bounded however long file_list is.
+
+    Iterating yields (filenames, images) with images an (N, target_height,
+    target_width, 3) uint8 BGR array. Files that can't be read are reported
+    and left out of their batch.
+    """
+    def __init__(
+        self,
+        file_list: Iterable,
+        target_height: int,
+        target_width: int,
+        batch_size: int,
+        workers: Optional[int] = None,
+        prefetch=2
+    ):
+        self.file_list = file_list
+        self.target_width = target_width
+        self.target_height = target_height
+        self.batch_size = max(1, batch_size)
+        self.workers = workers
+        self.prefetch = max(0, prefetch)
+
+    def read_image(self, filename) -> Tuple[object, bytes]:
+        with open(filename, 'rb') as f:
+            return filename, f.read()
+
+    def parse_single_image(self, filename, image_bytes: bytes) -> Tuple[object, np.ndarray]:
+        """ Parses a single image """
+        image = decode(image_bytes)
+
+        # Black and white image
+        if image.shape[2] == 1:
+            image = np.repeat(image, 3, axis=-1)
+
+        # Black and white image with alpha
+        elif image.shape[2] == 2:
+            image = np.concatenate([np.repeat(image[:, :, :1], 3, axis=-1), image[:, :, 1:]], axis=-1)
+
+        # Alpha to white
+        if image.shape[2] == 4:
+            alpha_mask = image[:, :, 3:].astype(np.float32) / 255
+            weighted_matte = np.float32(255) * (1 - alpha_mask)
+            weighted_image = image[:, :, :3].astype(np.float32) * alpha_mask
+            image = (weighted_image + weighted_matte).astype(np.uint8)
+
+        # Pillow RGB -> OpenCV BGR
+        image = image[:, :, ::-1]
+        return filename, image
+
+    def resize_single_image(self, filename, image: np.ndarray) -> Tuple[object, np.ndarray]:
+        """ Resizes a single image """
+        height, width, _ = image.shape
+
+        if height <= self.target_height and width <= self.target_width:
+            return filename, image
+
+        # the scale as tf.image.resize computes it with preserve_aspect_ratio, in float32
+        float_h = np.float32(height)
+        float_w = np.float32(width)
+        scale = min(np.float32(self.target_height) / float_h, np.float32(self.target_width) / float_w)
+        scaled_h = max(1, int(np.round(scale * float_h)))
+        scaled_w = max(1, int(np.round(scale * float_w)))
+
+        image = cv2.resize(
+            image.astype(np.float32), (scaled_w, scaled_h), interpolation=cv2.INTER_AREA)
+        # np.round rounds half to even, like tf.math.round
+        image = np.round(image).astype(np.uint8)
+        return filename, image
+
+    def pad_single_image(self, filename, image: np.ndarray) -> Tuple[object, np.ndarray]:
+        """ Pads a single image """
+        height, width, _ = image.shape
+
+        padding_top = (self.target_height - height) // 2
+        padding_left = (self.target_width - width) // 2
+
+        padded = np.full((self.target_height, self.target_width, 3), 255, dtype=np.uint8)
+        padded[padding_top:padding_top + height, padding_left:padding_left + width] = image
+        return filename, padded
+
+    def load(self, filename) -> np.ndarray:
+        """ Every step for one file """
+        filename, image_bytes = self.read_image(filename)
+        filename, image = self.parse_single_image(filename, image_bytes)
+        filename, image = self.resize_single_image(filename, image)
+        return self.pad_single_image(filename, image)[1]
+
+    def gen_ds(self) -> Iterator[Tuple[List, np.ndarray]]:
+        """ Generates the dataset """
+        window = self.batch_size * (self.prefetch + 1)
+        files = iter(self.file_list)
+        pending = deque()
+
+        with ThreadPoolExecutor(self.workers, thread_name_prefix='data-reader') as executor:
+            def fill():
+                while len(pending) < window:
+                    filename = next(files, None)
+                    if filename is None:
+                        return
+                    pending.append((filename, executor.submit(self.load, filename)))
+
+            fill()
+            filenames, images = [], []
+            while pending:
+                filename, future = pending.popleft()
+                fill()
+                try:
+                    images.append(future.result())
+                except Exception as e:
+                    print(f'Error reading {filename}: {e}')
+                    continue
+                filenames.append(filename)
+                if len(images) == self.batch_size:
+                    yield filenames, np.stack(images)
+                    filenames, images = [], []
+            if images:
+                yield filenames, np.stack(images)
+
+    def __iter__(self):
+        return self.gen_ds()
+
+
+def interrogate_files(
+    interrogator: 'Interrogator',
+    file_list: Iterable,
+    batch_size=8,
+    workers: Optional[int] = None,
+    prefetch=2
+) -> Iterator[Tuple[List, np.ndarray]]:
+    """
+    (filenames, confidents) batch by batch, for models with a square input
+    such as WaifuDiffusionInterrogator. The next batches are decoded while
+    the current one runs.
+    """
+    from tagger.interrogator import WaifuDiffusionInterrogator
+
+    if not isinstance(interrogator, WaifuDiffusionInterrogator):
+        raise ValueError(f'{interrogator.name} does not take square padded inputs')
+
+    size = interrogator.input_size()
+    for filenames, images in DataGenerator(file_list, size, size, batch_size, workers, prefetch):
+        # infer takes RGB and flips it to BGR itself
+        yield filenames, interrogator.infer(list(images[:, :, :, ::-1]), batch_size)
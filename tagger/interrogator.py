@@ -1,24 +1,91 @@
 import os
-import pandas as pd
 import numpy as np
 
-from typing import Tuple, List, Dict
+from typing import Tuple, List, Dict, Union, Optional, Callable
 from io import BytesIO
 from PIL import Image
 
 from pathlib import Path
-from huggingface_hub import hf_hub_download
-import re
-import json
+import threading
+import time
 
-from numpy import asarray, float32, expand_dims, exp
+from numpy import exp
 
-tag_escape_pattern = re.compile(r'([\\()])')
-
-import tagger.dbimutils as dbimutils
+import tagger.preprocessing as preprocessing
+from tagger import metrics
+from tagger.options import SESSION_OPTION_TYPES
+from tagger.vocabulary import Vocabulary, load_vocabulary, tag_escape_pattern
 
 use_cpu = True
 
+# sessions inherited by a forked child, see Interrogator.after_fork
+_forked_sessions = []
+
+# never contact the hub, model files must already be local or cached
+offline = os.environ.get('HF_HUB_OFFLINE', '0') not in ('0', '', 'false', 'False')
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disable': 'ORT_DISABLE_ALL',
+    'basic': 'ORT_ENABLE_BASIC',
+    'extended': 'ORT_ENABLE_EXTENDED',
+    'all': 'ORT_ENABLE_ALL',
+}
+
+EXECUTION_MODES = {
+    'sequential': 'ORT_SEQUENTIAL',
+    'parallel': 'ORT_PARALLEL',
+}
+
+
+def create_session(name: str, model_path: os.PathLike, options: Optional[Dict] = None):
+    """ Create an InferenceSession for model_path tuned by session options """
+    import onnxruntime as ort
+
+    options = options or {}
+    for key in options:
+        if key not in SESSION_OPTION_TYPES:
+            raise ValueError(f'Unknown session option {key}')
+
+    # https://onnxruntime.ai/docs/execution-providers/
+    # https://github.com/toriato/stable-diffusion-webui-wd14-tagger/commit/e4ec460122cf674bbf984df30cdb10b4370c1224#r92654958
+    providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
+    if use_cpu:
+        providers.pop(0)
+
+    sess_options = ort.SessionOptions()
+    for key in ('intra_op_num_threads', 'inter_op_num_threads',
+                'enable_cpu_mem_arena', 'enable_mem_pattern'):
+        if key in options:
+            setattr(sess_options, key, SESSION_OPTION_TYPES[key](options[key]))
+
+    if 'execution_mode' in options:
+        sess_options.execution_mode = getattr(
+            ort.ExecutionMode, EXECUTION_MODES[options['execution_mode']])
+
+    level = options.get('graph_optimization_level', 'all')
+    sess_options.graph_optimization_level = getattr(
+        ort.GraphOptimizationLevel, GRAPH_OPTIMIZATION_LEVELS[level])
+
+    if options.get('profile_file_prefix'):
+        sess_options.enable_profiling = True
+        sess_options.profile_file_prefix = options['profile_file_prefix']
+
+    if options.get('optimized_model_dir'):
+        optimized_path = Path(options['optimized_model_dir']) / f'{name}.{level}.onnx'
+        if (
+            optimized_path.is_file()
+            and optimized_path.stat().st_mtime >= os.stat(model_path).st_mtime
+        ):
+            # already optimized, don't pay for it again
+            model_path = optimized_path
+            sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        else:
+            optimized_path.parent.mkdir(parents=True, exist_ok=True)
+            sess_options.optimized_model_filepath = str(optimized_path)
+
+    return ort.InferenceSession(
+        str(model_path), sess_options=sess_options, providers=providers)
+
 class Interrogator:
     @staticmethod
     def postprocess_tags(
@@ -30,38 +97,143 @@ class Interrogator:
         add_confident_as_weight=False,
         replace_underscore=False,
         replace_underscore_excludes: List[str] = [],
-        escape_tag=False
+        escape_tag=False,
+        vocabulary: Optional[Vocabulary] = None
     ) -> Dict[str, float]:
         for t in additional_tags:
             tags[t] = 1.0
 
-        # those lines are totally not "pythonic" but looks better to me
-        tags = {
-            t: c
-
-            # sort by tag name or confident
-            for t, c in sorted(
-                tags.items(),
-                key=lambda i: i[0 if sort_by_alphabetical_order else 1],
-                reverse=not sort_by_alphabetical_order
+        # filter tags first, so only the survivors get sorted
+        tags = [
+            (t, c) for t, c in tags.items()
+            if (
+                c >= threshold
+                and t not in exclude_tags
             )
+        ]
+
+        # sort by tag name or confident
+        tags = dict(sorted(
+            tags,
+            key=lambda i: i[0 if sort_by_alphabetical_order else 1],
+            reverse=not sort_by_alphabetical_order
+        ))
+
+        formatted = None
+        if vocabulary is not None and (replace_underscore or escape_tag):
+            formatted = dict(zip(tags, vocabulary.format_names(
+                tags, replace_underscore, escape_tag)))
+
+        return Interrogator.format_tags(
+            tags,
+            add_confident_as_weight,
+            replace_underscore,
+            replace_underscore_excludes,
+            escape_tag,
+            formatted
+        )
 
-            # filter tags
+    @staticmethod
+    def postprocess_confidents(
+        names: np.ndarray,
+        confidents: np.ndarray,
+        threshold=0.35,
+        additional_tags: List[str] = [],
+        exclude_tags: List[str] = [],
+        sort_by_alphabetical_order=False,
+        add_confident_as_weight=False,
+        replace_underscore=False,
+        replace_underscore_excludes: List[str] = [],
+        escape_tag=False,
+        formatted_names: Optional[np.ndarray] = None
+    ) -> Union[Dict[str, float], List[Dict[str, float]]]:
+        """
+        Same as postprocess_tags, but works on the raw confidence vector, or a
+        (N, tags) matrix of them, so only tags above the threshold ever
+        become Python objects. formatted_names are the names as formatted by
+        replace_underscore and escape_tag, see Vocabulary.tag_variant.
+        """
+        if confidents.ndim == 2:
+            return [
+                Interrogator.postprocess_confidents(
+                    names, row, threshold, additional_tags, exclude_tags,
+                    sort_by_alphabetical_order, add_confident_as_weight,
+                    replace_underscore, replace_underscore_excludes, escape_tag,
+                    formatted_names
+                )
+                for row in confidents
+            ]
+
+        indices = np.flatnonzero(confidents >= threshold)
+        if additional_tags:
+            # added tags the model knows keep their place, as in postprocess_tags
+            known = [np.flatnonzero(names == t)[:1] for t in additional_tags]
+            indices = np.union1d(indices, np.concatenate(known)).astype(np.intp)
+
+        # from here on the same steps as postprocess_tags, on the few survivors
+        survivors = names[indices].tolist()
+        tags = dict(zip(survivors, confidents[indices]))
+        for t in additional_tags:
+            tags[t] = 1.0
+
+        tags = [
+            (t, c) for t, c in tags.items()
             if (
                 c >= threshold
                 and t not in exclude_tags
             )
-        }
+        ]
+
+        # sort by tag name or confident
+        tags = dict(sorted(
+            tags,
+            key=lambda i: i[0 if sort_by_alphabetical_order else 1],
+            reverse=not sort_by_alphabetical_order
+        ))
+
+        formatted = None
+        if formatted_names is not None and (replace_underscore or escape_tag):
+            formatted = dict(zip(survivors, formatted_names[indices].tolist()))
+
+        return Interrogator.format_tags(
+            tags,
+            add_confident_as_weight,
+            replace_underscore,
+            replace_underscore_excludes,
+            escape_tag,
+            formatted
+        )
+
+    @staticmethod
+    def format_tags(
+        tags: Dict[str, float],
+        add_confident_as_weight=False,
+        replace_underscore=False,
+        replace_underscore_excludes: List[str] = [],
+        escape_tag=False,
+        formatted: Optional[Dict[str, str]] = None
+    ) -> Dict[str, float]:
+        """ formatted maps tags to their precomputed replace_underscore and
+        escape_tag form, tags missing from it are formatted here """
+        if not (add_confident_as_weight or replace_underscore or escape_tag):
+            return tags
 
         new_tags = []
         for tag in list(tags):
             new_tag = tag
 
-            if replace_underscore and tag not in replace_underscore_excludes:
-                new_tag = new_tag.replace('_', ' ')
-
-            if escape_tag:
-                new_tag = tag_escape_pattern.sub(r'\\\1', new_tag)
+            if (
+                formatted is not None
+                and tag in formatted
+                and not (replace_underscore and tag in replace_underscore_excludes)
+            ):
+                new_tag = formatted[tag]
+            else:
+                if replace_underscore and tag not in replace_underscore_excludes:
+                    new_tag = new_tag.replace('_', ' ')
+
+                if escape_tag:
+                    new_tag = tag_escape_pattern.sub(r'\\\1', new_tag)
 
             if add_confident_as_weight:
                 new_tag = f'({new_tag}:{tags[tag]})'
@@ -73,23 +245,340 @@ class Interrogator:
 
     def __init__(self, name: str) -> None:
         self.name = name
+        # optional tagger.cache.ResultCache used by interrogate_confidents
+        self.cache = None
+        # guards against the preload thread and a request loading at once
+        self.load_lock = threading.RLock()
+        # set once the model is loaded, and warmed up if preloaded
+        self.ready = threading.Event()
+        # float32 input tensor reused across inference calls
+        self.batch_buffer = preprocessing.BatchBuffer()
+        # directory holding the model files, the hub is never used when set
+        self.model_dir = None
+        # file name -> local path, pinned by the registry in tagger.interrogators
+        self.local_paths: Dict[str, str] = {}
+        # called after a file had to be fetched through the hub
+        self.on_resolved: Optional[Callable[['Interrogator'], None]] = None
+        # see SESSION_OPTION_TYPES, applied the next time the model loads
+        self.session_options: Dict = {}
+        # names, categories and formatted variants of every output, ratings first
+        self.vocabulary: Optional[Vocabulary] = None
+        # times the model was loaded and unloaded, see tagger.pool
+        self.loads = 0
+        self.unloads = 0
+        # session with the profiler on, shared by sampled calls until its trace is written
+        self.profile_lock = threading.Lock()
+        self.profile_session = None
+        self.profiled_calls = 0
+
+    def model_id(self) -> str:
+        """ Identifies the model weights, used as part of result cache keys """
+        return self.name
+
+    def hub_download(self, filename: str) -> str:
+        raise NotImplementedError()
+
+    def resolve(self, filename: str) -> Path:
+        """
+        Find a model file, trying pinned paths and model_dir before the hub.
+        Once a file is found it is pinned, so later loads skip the hub entirely.
+        """
+        path = self.local_paths.get(filename)
+        if path is not None and os.path.isfile(path):
+            return Path(path)
+
+        if self.model_dir is not None:
+            path = Path(self.model_dir) / filename
+            if not path.is_file():
+                raise FileNotFoundError(f'{filename} not found in {self.model_dir}')
+            return path
+
+        path = self.hub_download(filename)
+        self.local_paths[filename] = str(path)
+        if self.on_resolved is not None:
+            self.on_resolved(self)
+        return Path(path)
 
     def load(self):
         raise NotImplementedError()
 
+    def load_tags(self, tags_path=None) -> None:
+        """ Load tag names only, downloading the tags file if no path is given """
+        raise NotImplementedError()
+
     def unload(self) -> bool:
         unloaded = False
+        self.end_profiling()
 
-        if hasattr(self, 'model') and self.model is not None:
-            del self.model
-            unloaded = True
-            print(f'Unloaded {self.name}')
+        with self.load_lock:
+            self.ready.clear()
 
-        if hasattr(self, 'tags'):
-            del self.tags
+            if hasattr(self, 'model') and self.model is not None:
+                del self.model
+                unloaded = True
+                self.unloads += 1
+                metrics.inc('model_unloads_total', model=self.name)
+                print(f'Unloaded {self.name}')
+
+            if hasattr(self, 'tags'):
+                del self.tags
+
+            if hasattr(self, 'ratings'):
+                del self.ratings
+
+            self.vocabulary = None
 
         return unloaded
 
+    def is_loaded(self) -> bool:
+        return getattr(self, 'model', None) is not None
+
+    def set_session_options(self, options: Dict) -> None:
+        """ Change session options, a loaded model is unloaded to pick them up """
+        for key in options:
+            if key not in SESSION_OPTION_TYPES:
+                raise ValueError(f'Unknown session option {key}')
+        with self.load_lock:
+            if options == self.session_options:
+                return
+            self.session_options = dict(options)
+            self.unload()
+
+    def release_session(self) -> None:
+        """ Drop the onnxruntime session but keep the tags and resolved files,
+        the next use builds a new session without downloading anything """
+        with self.load_lock:
+            self.ready.clear()
+            self.model = None
+
+    def after_fork(self, keep_session=False) -> None:
+        """
+        Prepare a forked child process to use the model. With keep_session,
+        the inherited session is used as is, its weights stay shared with the
+        parent as inference never writes them. Its thread pool only exists in
+        the parent though, so it runs on the calling thread alone.
+        Otherwise the child loads its own session on next use. The inherited
+        one is kept referenced but never used, destroying it here would wait
+        on the parent's threads forever.
+        """
+        if not keep_session:
+            model = getattr(self, 'model', None)
+            if model is not None:
+                _forked_sessions.append(model)
+            self.model = None
+        if self.profile_session is not None:
+            _forked_sessions.append(self.profile_session)
+            self.profile_session = None
+        # a lock held by another parent thread at fork time is never released
+        self.load_lock = threading.RLock()
+        self.profile_lock = threading.Lock()
+        self.ready = threading.Event()
+        if keep_session and self.is_loaded():
+            self.ready.set()
+
+    def load_timed(self) -> None:
+        """ load, counted and timed when metrics are on """
+        start = time.perf_counter()
+        self.load()
+        self.loads += 1
+        metrics.observe('model_load_seconds', time.perf_counter() - start, model=self.name)
+        metrics.inc('model_loads_total', model=self.name)
+
+    def ensure_loaded(self) -> None:
+        with self.load_lock:
+            if not self.is_loaded():
+                self.load_timed()
+                self.ready.set()
+
+    def dummy_input(self) -> np.ndarray:
+        """ A blank input at the model's input size, used for warm-up """
+        raise NotImplementedError()
+
+    def warmup(self) -> None:
+        """ Run one dummy inference so first-call graph allocation is paid up front """
+        self.infer([self.dummy_input()], batch_size=1)
+
+    def preload(
+        self,
+        warmup=True,
+        on_ready: Optional[Callable[[], None]] = None
+    ) -> threading.Thread:
+        """
+        Load, and optionally warm up, the model on a background thread.
+        on_ready is called from that thread once the model can be used.
+        """
+        def run():
+            try:
+                with self.load_lock:
+                    self.ready.clear()
+                    if not self.is_loaded():
+                        self.load_timed()
+                    if warmup:
+                        self.warmup()
+                    self.ready.set()
+            except Exception as e:
+                print(f'Failed to preload {self.name}: {e}')
+                return
+
+            print(f'{self.name} is ready')
+            if on_ready is not None:
+                on_ready()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def preprocess(self, image: Image) -> np.ndarray:
+        """ Turn an image into a single model input, without the batch axis """
+        raise NotImplementedError()
+
+    def preprocess_key(self) -> Tuple:
+        """ Models with equal keys take identical preprocessed inputs """
+        return (type(self).__name__, self.name)
+
+    def fits_input(self, width: int, height: int) -> bool:
+        """
+        Whether an image of this size still has at least model resolution
+        after preprocessing, so it may be decoded at a reduced scale
+        """
+        return False
+
+    def infer(self, inputs: List[np.ndarray], batch_size=8) -> np.ndarray:
+        """
+        Run preprocessed inputs through the model, batch_size at a time.
+        Returns an (N, ratings + tags) matrix of confidents, ratings first.
+        """
+        raise NotImplementedError()
+
+    def run_model(self, output_names: List[str], feed: Dict[str, np.ndarray]) -> List:
+        """ self.model.run, timed and occasionally profiled when metrics are on """
+        if not metrics.enabled:
+            return self.model.run(output_names, feed)
+        if metrics.sample_profile():
+            return self.run_profiled(output_names, feed)
+        with metrics.stage('session_run', model=self.name):
+            return self.model.run(output_names, feed)
+
+    def run_profiled(self, output_names: List[str], feed: Dict[str, np.ndarray]) -> List:
+        """
+        Run on a separate session with the onnxruntime profiler on, so its
+        trace holds sampled calls alone. The session is kept for
+        metrics.profile_calls_per_trace calls, or until the model unloads,
+        then its trace is written and the next sampled call builds a new one.
+        """
+        with self.profile_lock:
+            if self.profile_session is None:
+                os.makedirs(metrics.profile_dir, exist_ok=True)
+                options = {
+                    **self.session_options,
+                    'profile_file_prefix': os.path.join(metrics.profile_dir, self.name),
+                }
+                self.profile_session = create_session(
+                    self.model_id().replace('@', '-'), self.model_file, options)
+                self.profiled_calls = 0
+            outputs = self.profile_session.run(output_names, feed)
+            self.profiled_calls += 1
+            full = self.profiled_calls >= metrics.profile_calls_per_trace
+        if full:
+            self.end_profiling()
+        return outputs
+
+    def end_profiling(self) -> None:
+        """ Write the trace of the profiling session, if there is one, and record where """
+        with self.profile_lock:
+            session, self.profile_session = self.profile_session, None
+        if session is None:
+            return
+        path = session.end_profiling()
+        metrics.add_trace(self.name, path)
+        print(f'Wrote onnxruntime profile of {self.name} to {path}')
+
+    def split_confidents(
+        self,
+        confidents: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """ Split confidents from infer into rating and tag columns """
+        if getattr(self, 'tags', None) is None:
+            self.load_tags()
+
+        offset = len(self.ratings)
+        return confidents[..., :offset], confidents[..., offset:]
+
+    def postprocess(
+        self,
+        confidents: np.ndarray,
+        threshold=0.35,
+        **kwargs
+    ) -> Union[Dict[str, float], List[Dict[str, float]]]:
+        """ Threshold and format the tag confidents returned by infer """
+        _, tags = self.split_confidents(confidents)
+        if self.vocabulary is not None and (
+            kwargs.get('replace_underscore') or kwargs.get('escape_tag')
+        ):
+            kwargs['formatted_names'] = self.vocabulary.tag_variant(
+                kwargs.get('replace_underscore', False), kwargs.get('escape_tag', False))
+        return Interrogator.postprocess_confidents(
+            self.tags, tags, threshold, **kwargs)
+
+    def set_vocabulary(self, vocabulary: Vocabulary) -> None:
+        self.vocabulary = vocabulary
+        self.ratings = vocabulary.ratings
+        self.tags = vocabulary.tags
+
+    def interrogate_confidents(
+        self,
+        images: List[Image],
+        batch_size=8,
+        cache=None
+    ) -> np.ndarray:
+        """
+        Like infer, but takes images and answers from the result cache where
+        possible, only running the model for the misses.
+        """
+        cache = cache or self.cache
+        if cache is None:
+            with metrics.stage('preprocess'):
+                inputs = [self.preprocess(image) for image in images]
+            with metrics.stage('infer', model=self.name):
+                return self.infer(inputs, batch_size=batch_size)
+
+        from tagger.cache import image_digest
+
+        model = self.model_id()
+        digests = [image_digest(image) for image in images]
+        hits = [cache.get(digest, model) for digest in digests]
+        misses = [i for i, hit in enumerate(hits) if hit is None]
+        metrics.inc('cache_requests_total', len(images) - len(misses), result='hit')
+        metrics.inc('cache_requests_total', len(misses), result='miss')
+
+        if misses:
+            with metrics.stage('preprocess'):
+                inputs = [self.preprocess(images[i]) for i in misses]
+            with metrics.stage('infer', model=self.name):
+                computed = self.infer(inputs, batch_size=batch_size)
+            cache.put_many(
+                (digests[i], model, row) for i, row in zip(misses, computed))
+            for i, row in zip(misses, computed):
+                hits[i] = row
+
+        return np.stack(hits)
+
+    def to_dicts(
+        self,
+        confidents: np.ndarray
+    ) -> List[Tuple[
+        Dict[str, float],  # rating confidents
+        Dict[str, float]  # tag confidents
+    ]]:
+        """ Expand a confidents matrix into full (ratings, tags) dicts """
+        ratings, tags = self.split_confidents(confidents)
+        rating_names = self.ratings.tolist()
+        tag_names = self.tags.tolist()
+        return [
+            (dict(zip(rating_names, r)), dict(zip(tag_names, t)))
+            for r, t in zip(ratings, tags)
+        ]
+
     def interrogate(
         self,
         image: Image
@@ -97,7 +586,28 @@ class Interrogator:
         Dict[str, float],  # rating confidents
         Dict[str, float]  # tag confidents
     ]:
-        raise NotImplementedError()
+        return self.interrogate_batch([image], batch_size=1)[0]
+
+    def run_batch(
+        self,
+        inputs: List[np.ndarray],
+        batch_size=8
+    ) -> List[Tuple[
+        Dict[str, float],  # rating confidents
+        Dict[str, float]  # tag confidents
+    ]]:
+        return self.to_dicts(self.infer(inputs, batch_size=batch_size))
+
+    def interrogate_batch(
+        self,
+        images: List[Image],
+        batch_size=8
+    ) -> List[Tuple[
+        Dict[str, float],  # rating confidents
+        Dict[str, float]  # tag confidents
+    ]]:
+        return self.to_dicts(
+            self.interrogate_confidents(images, batch_size=batch_size))
 
 class WaifuDiffusionInterrogator(Interrogator):
     def __init__(
@@ -105,160 +615,378 @@ class WaifuDiffusionInterrogator(Interrogator):
         name: str,
         model_path='model.onnx',
         tags_path='selected_tags.csv',
+        model_dir=None,
         **kwargs
     ) -> None:
         super().__init__(name)
         self.model_path = model_path
         self.tags_path = tags_path
+        self.model_dir = model_dir
         self.kwargs = kwargs
+        self.input_height = None
+
+    def model_id(self) -> str:
+        if self.model_dir is not None:
+            return f"{self.name}@local"
+        return f"{self.name}@{self.kwargs.get('revision', 'main')}"
+
+    def hub_download(self, filename: str) -> str:
+        # huggingface_hub takes a while to import, and pinned models never need it
+        from huggingface_hub import hf_hub_download
+
+        return hf_hub_download(
+            **self.kwargs, filename=filename, local_files_only=offline)
 
     def download(self) -> Tuple[os.PathLike, os.PathLike]:
-        print(f"Loading {self.name} model file from {self.kwargs['repo_id']}")
+        print(f"Loading {self.name} model file from {self.model_dir or self.kwargs['repo_id']}")
 
-        model_path = Path(hf_hub_download(
-            **self.kwargs, filename=self.model_path))
-        tags_path = Path(hf_hub_download(
-            **self.kwargs, filename=self.tags_path))
+        model_path = self.resolve(self.model_path)
+        tags_path = self.resolve(self.tags_path)
         return model_path, tags_path
 
     def load(self) -> None:
         model_path, tags_path = self.download()
+        self.model_file = model_path
 
-        from onnxruntime import InferenceSession
+        self.model = create_session(
+            self.model_id().replace('@', '-'), model_path, self.session_options)
 
-        # https://onnxruntime.ai/docs/execution-providers/
-        # https://github.com/toriato/stable-diffusion-webui-wd14-tagger/commit/e4ec460122cf674bbf984df30cdb10b4370c1224#r92654958
-        providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
-        if use_cpu:
-            providers.pop(0)
+        print(f'Loaded {self.name} model from {model_path}')
 
-        self.model = InferenceSession(str(model_path), providers=providers)
+        self.load_tags(tags_path)
 
-        print(f'Loaded {self.name} model from {model_path}')
+    def load_tags(self, tags_path=None) -> None:
+        if tags_path is None:
+            tags_path = self.resolve(self.tags_path)
 
-        self.tags = pd.read_csv(tags_path)
+        # first 4 items are for rating (general, sensitive, questionable, explicit)
+        # rest are regular tags, parsed once and cached as arrays after that
+        self.set_vocabulary(load_vocabulary(tags_path))
 
-    def interrogate(
-        self,
-        image: Image
-    ) -> Tuple[
-        Dict[str, float],  # rating confidents
-        Dict[str, float]  # tag confidents
-    ]:
-        # init model
-        if not hasattr(self, 'model') or self.model is None:
-            self.load()
+    def input_size(self) -> int:
+        # the input size outlives unload, so cache hits never reload the model
+        if self.input_height is None:
+            # init model
+            self.ensure_loaded()
 
-        # code for converting the image and running the model is taken from the link below
-        # thanks, SmilingWolf!
-        # https://huggingface.co/spaces/SmilingWolf/wd-v1-4-tags/blob/main/app.py
+            _, self.input_height, _, _ = self.model.get_inputs()[0].shape
+        return self.input_height
+
+    def fits_input(self, width: int, height: int) -> bool:
+        # the longest side is shrunk to the input size
+        return max(width, height) >= self.input_size()
 
-        # convert an image to fit the model
-        _, height, _, _ = self.model.get_inputs()[0].shape
+    def preprocess_key(self) -> Tuple:
+        return (type(self).__name__, self.input_size())
 
-        # alpha to white
-        image = image.convert('RGBA')
-        new_image = Image.new('RGBA', image.size, 'WHITE')
-        new_image.paste(image, mask=image)
-        image = new_image.convert('RGB')
-        image = np.asarray(image)
+    def dummy_input(self) -> np.ndarray:
+        height = self.input_size()
+        return np.full((height, height, 3), 255, dtype=np.uint8)
 
-        # PIL RGB to OpenCV BGR
-        image = image[:, :, ::-1]
+    def preprocess(self, image: Image) -> np.ndarray:
+        # code for converting the image and running the model is based on the link below
+        # thanks, SmilingWolf!
+        # https://huggingface.co/spaces/SmilingWolf/wd-v1-4-tags/blob/main/app.py
 
-        image = dbimutils.make_square(image, height)
-        image = dbimutils.smart_resize(image, height)
-        image = image.astype(np.float32)
-        image = np.expand_dims(image, 0)
+        # alpha to white, then fit into a white square of the model input size
+        return preprocessing.square_input(image, self.input_size())
 
-        # evaluate model
-        input_name = self.model.get_inputs()[0].name
+    def infer(self, inputs: List[np.ndarray], batch_size=8) -> np.ndarray:
+        # init model
+        self.ensure_loaded()
+
+        input_ = self.model.get_inputs()[0]
         label_name = self.model.get_outputs()[0].name
-        confidents = self.model.run([label_name], {input_name: image})[0]
+        max_batch, height, _, _ = input_.shape
 
-        tags = self.tags[:][['name']]
-        tags['confidents'] = confidents[0]
+        # models exported with a fixed batch dimension can't take more
+        if isinstance(max_batch, int) and max_batch > 0:
+            batch_size = min(batch_size, max_batch)
+        batch_size = max(1, batch_size)
 
-        # first 4 items are for rating (general, sensitive, questionable, explicit)
-        ratings = dict(tags[:4].values)
+        confidents = []
+        for start in range(0, len(inputs), batch_size):
+            chunk = inputs[start:start + batch_size]
 
-        # rest are regular tags
-        tags = dict(tags[4:].values)
+            # stack into one contiguous float32 tensor of shape (N, H, W, 3),
+            # flipping PIL RGB to the OpenCV BGR order the model expects
+            batch = self.batch_buffer.get((len(chunk), height, height, 3))
+            for i, x in enumerate(chunk):
+                batch[i] = x[:, :, ::-1]
 
-        return ratings, tags
+            # evaluate model
+            confidents.append(
+                self.run_model([label_name], {input_.name: batch})[0])
+            metrics.observe('batch_fill_ratio', len(chunk) / batch_size, model=self.name)
+
+        return np.concatenate(confidents)
 
 class MLDanbooruInterrogator(Interrogator):
     """ Interrogator for the MLDanbooru model. """
+    # the shortest side of the input, the rest follows the aspect ratio
+    input_height = 448
+
     def __init__(
         self,
         name: str,
         repo_id: str,
         model_path: str,
         tags_path='classes.json',
+        model_dir=None,
     ) -> None:
         super().__init__(name)
         self.model_path = model_path
         self.tags_path = tags_path
+        self.model_dir = model_dir
         self.repo_id = repo_id
         self.tags = None
+        self.ratings = None
         self.model = None
 
-    def download(self) -> Tuple[str, str]:
-        print(f"Loading {self.name} model file from {self.repo_id}")
+    def model_id(self) -> str:
+        if self.model_dir is not None:
+            return f"{self.name}@local"
+        return self.name
 
-        model_path = hf_hub_download(
-            repo_id=self.repo_id,
-            filename=self.model_path
-        )
-        tags_path = hf_hub_download(
+    def hub_download(self, filename: str) -> str:
+        from huggingface_hub import hf_hub_download
+
+        return hf_hub_download(
             repo_id=self.repo_id,
-            filename=self.tags_path,
+            filename=filename,
+            local_files_only=offline
         )
+
+    def download(self) -> Tuple[str, str]:
+        print(f"Loading {self.name} model file from {self.model_dir or self.repo_id}")
+
+        model_path = str(self.resolve(self.model_path))
+        tags_path = str(self.resolve(self.tags_path))
         return model_path, tags_path
 
     def load(self) -> None:
         model_path, tags_path = self.download()
+        self.model_file = model_path
 
-        from onnxruntime import InferenceSession
-        providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
-        if use_cpu:
-            providers.pop(0)
-        self.model = InferenceSession(model_path,
-                                          providers=providers)
+        self.model = create_session(
+            self.model_id().replace('@', '-'), model_path, self.session_options)
         print(f'Loaded {self.name} model from {model_path}')
 
-        with open(tags_path, 'r', encoding='utf-8') as filen:
-            self.tags = json.load(filen)
+        self.load_tags(tags_path)
 
-    def interrogate(
-        self,
-        image: Image
-    ) -> Tuple[
-        Dict[str, float],  # rating confidents
-        Dict[str, float]  # tag confidents
-    ]:
-        # init model
-        if self.model is None:
-            self.load()
+    def load_tags(self, tags_path=None) -> None:
+        if tags_path is None:
+            tags_path = self.resolve(self.tags_path)
+
+        self.set_vocabulary(load_vocabulary(tags_path))
+
+    def input_size(self) -> int:
+        return self.input_height
+
+    def preprocess(self, image: Image) -> np.ndarray:
+        return preprocessing.short_side_input(image, self.input_size())
+
+    def preprocess_key(self) -> Tuple:
+        return (type(self).__name__, self.input_size())
 
-        image = dbimutils.fill_transparent(image)
-        image = dbimutils.resize(image, 448)  # TODO CUSTOMIZE
+    def fits_input(self, width: int, height: int) -> bool:
+        # the shortest side is scaled to the input size
+        return min(width, height) >= self.input_size()
 
-        x = asarray(image, dtype=float32) / 255
-        # HWC -> 1CHW
-        x = x.transpose((2, 0, 1))
-        x = expand_dims(x, 0)
+    def dummy_input(self) -> np.ndarray:
+        size = self.input_size()
+        return np.full((size, size, 3), 255, dtype=np.uint8)
+
+    def infer(self, inputs: List[np.ndarray], batch_size=8) -> np.ndarray:
+        # init model
+        self.ensure_loaded()
 
         input_ = self.model.get_inputs()[0]
         output = self.model.get_outputs()[0]
-        # evaluate model
-        y, = self.model.run([output.name], {input_.name: x})
+        batch_size = max(1, batch_size)
+
+        # resize keeps the aspect ratio, so only images that end up with
+        # the same shape can share a batch
+        buckets: Dict[Tuple[int, ...], List[int]] = {}
+        for i, x in enumerate(inputs):
+            buckets.setdefault(x.shape, []).append(i)
+
+        confidents = np.empty((len(inputs), len(self.tags)), dtype=np.float32)
+        for indices in buckets.values():
+            for start in range(0, len(indices), batch_size):
+                chunk = indices[start:start + batch_size]
+                height, width, _ = inputs[chunk[0]].shape
+                x = self.batch_buffer.get((len(chunk), 3, height, width))
+                for i, j in enumerate(chunk):
+                    # HWC -> CHW, scaled to 0..1
+                    np.multiply(inputs[j].transpose((2, 0, 1)), 1 / 255, out=x[i])
+
+                # evaluate model
+                y, = self.run_model([output.name], {input_.name: x})
+                metrics.observe('batch_fill_ratio', len(chunk) / batch_size, model=self.name)
+
+                # Softmax
+                confidents[chunk] = 1 / (1 + exp(-y.reshape(len(chunk), -1)))
+
+        return confidents
+
+    def large_batch_interrogate(self, images: List, batch_size=8) -> List[Tuple[
+        Dict[str, float],  # rating confidents
+        Dict[str, float]  # tag confidents
+    ]]:
+        return self.interrogate_batch(images, batch_size=batch_size)
 
-        # Softmax
-        y = 1 / (1 + exp(-y))
+class EnsembleInterrogator(Interrogator):
+    """
+    Runs several models on each image and merges their confidents into one
+    tag set. Models that take the same input share one preprocessed image,
+    and the sessions run concurrently.
+    """
+    merge_modes = ('mean', 'max')
 
-        tags = {tag: float(conf) for tag, conf in zip(self.tags, y.flatten())}
-        return {}, tags
+    def __init__(
+        self,
+        name: str,
+        members: List[Interrogator],
+        merge='mean',
+        weights: Optional[List[float]] = None
+    ) -> None:
+        super().__init__(name)
+        if merge not in self.merge_modes:
+            raise ValueError(f'Unknown merge mode {merge}, use one of {self.merge_modes}')
+        if weights is not None and len(weights) != len(members):
+            raise ValueError('Need exactly one weight per ensemble member')
+        self.members = members
+        self.merge = merge
+        self.weights = weights or [1.0] * len(members)
+        self.executor = None
+        self.tags = None
+        self.ratings = None
+        # per member, the merged column of every column it outputs
+        self.columns = None
 
-    def large_batch_interrogate(self, images: List, dry_run=False) -> str:
-        raise NotImplementedError()
+    def model_id(self) -> str:
+        members = ','.join(member.model_id() for member in self.members)
+        weights = ','.join(str(w) for w in self.weights)
+        return f'ensemble({members})/{self.merge}/{weights}'
+
+    def run_members(self, fn: Callable[[Interrogator], object]) -> List:
+        from concurrent.futures import ThreadPoolExecutor
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=len(self.members), thread_name_prefix=self.name)
+        return list(self.executor.map(fn, self.members))
+
+    def is_loaded(self) -> bool:
+        return self.columns is not None and all(
+            member.is_loaded() for member in self.members)
+
+    def load(self) -> None:
+        self.run_members(lambda member: member.ensure_loaded())
+        self.build_columns()
+        print(f'Loaded {self.name} ensemble')
+
+    def load_tags(self, tags_path=None) -> None:
+        for member in self.members:
+            if getattr(member, 'tags', None) is None:
+                member.load_tags()
+        self.build_columns()
+
+    def build_columns(self) -> None:
+        """ Union the member vocabularies, ratings first, in first seen order """
+        ratings: Dict[str, int] = {}
+        tags: Dict[str, int] = {}
+        for member in self.members:
+            for name in member.ratings:
+                ratings.setdefault(name, len(ratings))
+            for name in member.tags:
+                tags.setdefault(name, len(tags))
+
+        categories: Dict[str, int] = {}
+        for member in self.members:
+            if member.vocabulary is not None:
+                categories.update(zip(
+                    member.vocabulary.names.tolist(), member.vocabulary.categories.tolist()))
+
+        names = list(ratings) + list(tags)
+        self.set_vocabulary(Vocabulary(
+            np.array(names, dtype=object),
+            np.array([categories.get(name, -1) for name in names]),
+            len(ratings)))
+        offset = len(ratings)
+        self.columns = [
+            np.array(
+                [ratings[name] for name in member.ratings]
+                + [offset + tags[name] for name in member.tags],
+                dtype=np.intp
+            )
+            for member in self.members
+        ]
+
+    def unload(self) -> bool:
+        with self.load_lock:
+            self.ready.clear()
+            unloaded = any([member.unload() for member in self.members])
+            self.columns = None
+            self.tags = None
+            self.ratings = None
+        return unloaded
+
+    def set_session_options(self, options: Dict) -> None:
+        # there's no session of its own, members are configured one by one
+        pass
+
+    def release_session(self) -> None:
+        with self.load_lock:
+            self.ready.clear()
+            for member in self.members:
+                member.release_session()
+
+    def after_fork(self, keep_session=False) -> None:
+        for member in self.members:
+            member.after_fork(keep_session)
+        if not keep_session:
+            self.columns = None
+        super().after_fork(keep_session)
+        # the pool's threads stayed in the parent
+        self.executor = None
+
+    def preprocess(self, image: Image) -> Dict[Tuple, np.ndarray]:
+        inputs = {}
+        for member in self.members:
+            key = member.preprocess_key()
+            if key not in inputs:
+                inputs[key] = member.preprocess(image)
+        return inputs
+
+    def fits_input(self, width: int, height: int) -> bool:
+        return all(member.fits_input(width, height) for member in self.members)
+
+    def dummy_input(self) -> Dict[Tuple, np.ndarray]:
+        return {
+            member.preprocess_key(): member.dummy_input()
+            for member in self.members
+        }
+
+    def infer(self, inputs: List[Dict[Tuple, np.ndarray]], batch_size=8) -> np.ndarray:
+        # init model
+        self.ensure_loaded()
+
+        results = self.run_members(lambda member: member.infer(
+            [x[member.preprocess_key()] for x in inputs], batch_size=batch_size))
+
+        width = len(self.ratings) + len(self.tags)
+        merged = np.zeros((len(inputs), width), dtype=np.float32)
+        total_weight = np.zeros(width, dtype=np.float32)
+        for columns, weight, confidents in zip(self.columns, self.weights, results):
+            if self.merge == 'max':
+                merged[:, columns] = np.maximum(merged[:, columns], confidents)
+            else:
+                merged[:, columns] += weight * confidents
+                total_weight[columns] += weight
+
+        # tags only some members know are averaged over those members
+        if self.merge == 'mean':
+            merged /= np.maximum(total_weight, np.finfo(np.float32).tiny)
+        return merged
@@ -1,6 +1,10 @@
-from typing import List, Dict
+import json
+import os
+import threading
+from typing import List, Dict, Optional, Tuple
 
-from tagger.interrogator import Interrogator, WaifuDiffusionInterrogator, MLDanbooruInterrogator
+from tagger.interrogator import Interrogator, WaifuDiffusionInterrogator, MLDanbooruInterrogator, EnsembleInterrogator
+from tagger.paths import user_config_dir
 
 interrogators: Dict[str, Interrogator] = {
     'wd-convnext-v3': WaifuDiffusionInterrogator(
@@ -33,3 +37,159 @@ interrogators: Dict[str, Interrogator] = {
         revision='v2.0'
     ),
 }
+
+# Ensembles are named by joining member names with '+', for example
+# 'wd-swinv2-v3+wd-convnext-v3+wd-vit-v3', and are created on first use
+_ensembles: Dict[Tuple, EnsembleInterrogator] = {}
+
+
+def get_interrogator(name: str, merge='mean', weights: Optional[List[float]] = None) -> Interrogator:
+    """ Look up a registered model, or the ensemble of several joined with '+' """
+    ensure_manifest()
+    if '+' not in name:
+        return interrogators[name]
+
+    names = name.split('+')
+    key = (name, merge, tuple(weights) if weights else None)
+    if key not in _ensembles:
+        _ensembles[key] = EnsembleInterrogator(
+            name, [interrogators[n] for n in names], merge=merge, weights=weights)
+    return _ensembles[key]
+
+
+# Local model registry
+#
+# The manifest pins every model to files on disk, so once a model has been
+# downloaded it is loaded straight from those paths without asking the hub.
+# It can also register models that only exist in a local directory:
+#
+#   {
+#     "models": {
+#       "wd-swinv2-v3": {"revision": "main", "files": {"model.onnx": "/path/to/model.onnx", ...}},
+#       "my-tagger": {"type": "wd", "dir": "/models/my-tagger"}
+#     }
+#   }
+#
+# Pinned files are only used while the model's revision matches. The
+# manifest is read on first use of the registry, not on import.
+
+manifest_path = os.environ.get('BOORUVISION_MODELS') or str(user_config_dir() / 'models.json')
+
+interrogator_types = {
+    'wd': WaifuDiffusionInterrogator,
+    'mldanbooru': MLDanbooruInterrogator,
+}
+
+_manifest_lock = threading.Lock()
+# re-entrant, loading the manifest registers its local models
+_load_lock = threading.RLock()
+_manifest_loaded = False
+# entries for locally registered models, kept to write them back out
+_local_models: Dict[str, Dict] = {}
+
+
+def ensure_manifest() -> None:
+    """ Read the manifest, once, before the registry is first used """
+    global _manifest_loaded
+    with _load_lock:
+        if not _manifest_loaded:
+            _manifest_loaded = True
+            load_manifest()
+
+
+def all_interrogators() -> Dict[str, Interrogator]:
+    """ Every registered model by name, including those from the manifest """
+    ensure_manifest()
+    return interrogators
+
+
+def revision(interrogator: Interrogator) -> str:
+    return getattr(interrogator, 'kwargs', {}).get('revision', 'main')
+
+
+def register_local_model(name: str, model_dir: str, kind='wd', **kwargs) -> Interrogator:
+    """ Register a model whose files live in model_dir, it never touches the hub """
+    if kind not in interrogator_types:
+        raise ValueError(f'Unknown model type {kind}, use one of {list(interrogator_types)}')
+    if kind == 'mldanbooru':
+        if not kwargs.get('model_path'):
+            raise ValueError(
+                f'Local mldanbooru model {name} needs model_path, the name of '
+                f'its .onnx file in {model_dir}')
+        kwargs.setdefault('repo_id', None)
+    ensure_manifest()
+    interrogator = interrogator_types[kind](name, model_dir=model_dir, **kwargs)
+    interrogator.on_resolved = _pin
+    interrogators[name] = interrogator
+    _local_models[name] = {'type': kind, 'dir': str(model_dir), **kwargs}
+    return interrogator
+
+
+def load_manifest(path: Optional[str] = None) -> None:
+    path = path or manifest_path
+    if not os.path.isfile(path):
+        return
+
+    with open(path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+
+    for name, entry in manifest.get('models', {}).items():
+        entry = dict(entry)
+        files = entry.pop('files', {})
+        pinned = entry.pop('revision', None)
+        if 'dir' in entry:
+            kind = entry.pop('type', 'wd')
+            try:
+                register_local_model(name, entry.pop('dir'), kind, **entry)
+            except (TypeError, ValueError) as e:
+                print(f'Skipping model {name} in {path}: {e}')
+                continue
+        elif name in interrogators and pinned != revision(interrogators[name]):
+            # pinned for another revision, resolve the current one again
+            continue
+        if name in interrogators:
+            interrogators[name].local_paths.update(files)
+
+
+def save_manifest(path: Optional[str] = None) -> None:
+    path = path or manifest_path
+    # never write out a registry that's missing the manifest's own entries
+    ensure_manifest()
+    models = {}
+    for name, interrogator in interrogators.items():
+        entry = dict(_local_models.get(name, {}))
+        if interrogator.local_paths:
+            if name not in _local_models:
+                entry['revision'] = revision(interrogator)
+            entry['files'] = dict(interrogator.local_paths)
+        if entry:
+            models[name] = entry
+
+    # write to a temporary file first, other processes may be reading it
+    with _manifest_lock:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'models': models}, f, indent=2)
+        os.replace(tmp_path, path)
+
+
+def pin_models(names: Optional[List[str]] = None) -> None:
+    """ Resolve the files of the given models, downloading what's missing, and pin them """
+    ensure_manifest()
+    for name in names or list(interrogators):
+        interrogator = interrogators[name]
+        interrogator.resolve(interrogator.model_path)
+        interrogator.resolve(interrogator.tags_path)
+    save_manifest()
+
+
+def _pin(interrogator: Interrogator) -> None:
+    try:
+        save_manifest()
+    except OSError as e:
+        print(f'Could not write model manifest {manifest_path}: {e}')
+
+
+for _interrogator in interrogators.values():
+    _interrogator.on_resolved = _pin
@@ -0,0 +1,194 @@
+"""Record of tagged files, so re-runs only tag what changed"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, Optional
+
+MANIFEST_NAME = 'tag_manifest.sqlite'
+
+
+def file_hash(path: os.PathLike) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class TaggingManifest:
+    """
+    A SQLite table of every file tagged so far, with its size, modification
+    time and content hash, and the model, revision, threshold and output it
+    was tagged with. The revision is Interrogator.model_id, which tells the
+    weights apart: the hub revision, a local model, or an ensemble's members
+    and merge.
+
+    pending() passes only the files that are new, changed, or were tagged
+    with other settings. A file whose size and modification time match is
+    never read. One that was only touched is hashed, and skipped if its
+    content is unchanged. Files are recorded as their results are written,
+    and committed at least every commit_interval seconds, so an interrupted
+    run resumes with at most that much work lost.
+
+    Paths under the manifest's directory are stored relative to it, so a
+    dataset keeps its manifest when it moves.
+    """
+
+    def __init__(
+        self,
+        path: os.PathLike,
+        model: str,
+        revision: str,
+        threshold: float,
+        output='',
+        commit_interval=1.0
+    ) -> None:
+        self.path = Path(path)
+        self.root = self.path.parent.resolve()
+        self.settings = (model, revision, float(threshold), output)
+        self.commit_interval = commit_interval
+        self.lock = threading.Lock()
+        self.last_commit = time.monotonic()
+        self.skipped = 0
+        # hashes computed while checking files, reused when they are recorded
+        self.hashes: Dict[str, str] = {}
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            ' path TEXT PRIMARY KEY,'
+            ' size INTEGER NOT NULL,'
+            ' mtime_ns INTEGER NOT NULL,'
+            ' hash TEXT NOT NULL,'
+            ' model TEXT NOT NULL,'
+            ' revision TEXT NOT NULL,'
+            ' threshold REAL NOT NULL,'
+            ' output TEXT NOT NULL,'
+            ' tagged REAL NOT NULL)'
+        )
+        self.db.commit()
+
+    @classmethod
+    def for_interrogator(cls, path: os.PathLike, interrogator, threshold: float, output='', **kwargs):
+        return cls(path, interrogator.name, interrogator.model_id(), threshold, output, **kwargs)
+
+    def key(self, path: os.PathLike) -> str:
+        path = Path(path).resolve()
+        try:
+            return path.relative_to(self.root).as_posix()
+        except ValueError:
+            return str(path)
+
+    def needs_tagging(self, path: os.PathLike) -> bool:
+        key = self.key(path)
+        stat = os.stat(path)
+        with self.lock:
+            row = self.db.execute(
+                'SELECT size, mtime_ns, hash, model, revision, threshold, output'
+                ' FROM files WHERE path = ?', (key,)).fetchone()
+        if row is None:
+            return True
+        size, mtime_ns, digest = row[:3]
+        if tuple(row[3:]) != self.settings:
+            return True
+        if size == stat.st_size and mtime_ns == stat.st_mtime_ns:
+            return False
+        if size != stat.st_size:
+            return True
+
+        # touched, copied or restored, the content decides
+        current = file_hash(path)
+        if current != digest:
+            self.hashes[key] = current
+            return True
+        with self.lock:
+            self.db.execute(
+                'UPDATE files SET mtime_ns = ? WHERE path = ?', (stat.st_mtime_ns, key))
+            self._maybe_commit()
+        return False
+
+    def pending(
+        self,
+        paths: Iterable[Path],
+        output_exists: Optional[Callable[[Path], bool]] = None
+    ) -> Iterator[Path]:
+        """ The paths that need tagging. With output_exists, files whose output
+        went missing are tagged again too. """
+        for path in paths:
+            try:
+                if self.needs_tagging(path) or (
+                    output_exists is not None and not output_exists(path)
+                ):
+                    yield path
+                    continue
+            except OSError as e:
+                print(f'Error checking {path}: {e}')
+                continue
+            self.skipped += 1
+
+    def record(self, path: os.PathLike) -> None:
+        """ Mark path as tagged with the current settings """
+        key = self.key(path)
+        stat = os.stat(path)
+        digest = self.hashes.pop(key, None) or file_hash(path)
+        model, revision, threshold, output = self.settings
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, stat.st_size, stat.st_mtime_ns, digest,
+                 model, revision, threshold, output, time.time()))
+            self._maybe_commit()
+
+    def record_written(self, paths: Iterable[os.PathLike]) -> None:
+        """ Record paths and commit, as a buffered sink wrote them out """
+        for path in paths:
+            try:
+                self.record(path)
+            except OSError as e:
+                print(f'Error recording {path}: {e}')
+        self.commit()
+
+    def recorder(self, on_result: Callable) -> Callable:
+        """ Wrap an on_result callback to record each path once it succeeded.
+        A buffered sink has its paths recorded once they are written out. """
+        flushed = getattr(on_result, 'flushed', None)
+        if flushed is not None:
+            flushed.append(self.record_written)
+            return on_result
+
+        def write(path, confidents):
+            on_result(path, confidents)
+            self.record(path)
+        return write
+
+    def _maybe_commit(self) -> None:
+        now = time.monotonic()
+        if now - self.last_commit >= self.commit_interval:
+            self.db.commit()
+            self.last_commit = now
+
+    def commit(self) -> None:
+        with self.lock:
+            self.db.commit()
+            self.last_commit = time.monotonic()
+
+    def forget(self, path: os.PathLike) -> None:
+        with self.lock:
+            self.db.execute('DELETE FROM files WHERE path = ?', (self.key(path),))
+            self.db.commit()
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.commit()
+            self.db.close()
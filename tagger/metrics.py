@@ -0,0 +1,331 @@
+"""Optional latency and throughput instrumentation
+
+Off by default. While disabled every hook is a check of one module global,
+and timer() hands back a shared no-op context, so instrumented code runs at
+full speed. Turn it on with enable() or BOORUVISION_METRICS=1.
+
+Recorded:
+    stage_seconds         histogram per stage (decode, preprocess, infer, ...)
+    model_load_seconds    histogram per model, plus load and unload counters
+    queue_depth           gauge per queue
+    batch_fill_ratio      histogram of how full inference batches were
+    cache_requests_total  result cache hits and misses
+    model_memory_bytes    gauge per model loaded through tagger.pool, and evictions
+
+Exported as Prometheus text (prometheus_text, start_http_server, or the
+/metrics endpoint of server.py) or as a JSON line appended to a file every
+few seconds (start_json_log). With a profile sample rate, that share of
+inference calls also runs on a session with the onnxruntime profiler on,
+profile_calls_per_trace calls per trace file, and the trace files are
+listed under "traces".
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+enabled = os.environ.get('BOORUVISION_METRICS', '0') not in ('0', '', 'false', 'False')
+
+# share of inference calls traced by the onnxruntime profiler
+profile_sample_rate = 0.0
+profile_dir = 'profiles'
+# sampled calls written to one trace, they share one profiling session
+profile_calls_per_trace = 20
+
+# seconds, Prometheus style upper bounds
+TIME_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATIO_BUCKETS = (0.125, 0.25, 0.375, 0.5, 0.625, 0.75, 0.875, 1.0)
+
+HELP = {
+    'stage_seconds': 'Time spent in each tagging stage',
+    'model_load_seconds': 'Time to load a model',
+    'model_loads_total': 'Models loaded',
+    'model_unloads_total': 'Models unloaded',
+    'queue_depth': 'Items waiting in a queue',
+    'batch_fill_ratio': 'Inputs in an inference batch relative to the batch size',
+    'cache_requests_total': 'Result cache lookups',
+    'images_total': 'Images tagged',
+    'gui_stale_requests_total': 'GUI analysis requests dropped for a newer one',
+    'model_memory_bytes': 'Resident memory held by a loaded model, see tagger.pool',
+    'pool_memory_bytes': 'Resident memory held by all models loaded through the pool',
+    'pool_evictions_total': 'Models unloaded by the pool, for the memory budget or when idle',
+}
+
+_lock = threading.Lock()
+# name -> labels -> value, labels are sorted (key, value) tuples
+_histograms: Dict[str, Dict[Tuple, 'Histogram']] = {}
+_counters: Dict[str, Dict[Tuple, float]] = {}
+_gauges: Dict[str, Dict[Tuple, float]] = {}
+_traces: List[Dict] = []
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self) -> List[int]:
+        total = 0
+        counts = []
+        for count in self.counts:
+            total += count
+            counts.append(total)
+        return counts
+
+
+class _Timer:
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name: str, labels: Dict) -> None:
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+def enable(on=True) -> None:
+    global enabled
+    enabled = on
+
+
+def _key(labels: Dict) -> Tuple:
+    return tuple(sorted(labels.items()))
+
+
+def timer(name='stage_seconds', **labels):
+    """ Context manager recording its duration into a histogram """
+    if not enabled:
+        return _null_timer
+    return _Timer(name, labels)
+
+
+def stage(stage_name: str, **labels):
+    """ timer() for one of the tagging stages """
+    if not enabled:
+        return _null_timer
+    return _Timer('stage_seconds', {'stage': stage_name, **labels})
+
+
+def observe(name: str, value: float, **labels) -> None:
+    if not enabled:
+        return
+    buckets = RATIO_BUCKETS if name.endswith('_ratio') else TIME_BUCKETS
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        key = _key(labels)
+        if key not in series:
+            series[key] = Histogram(buckets)
+        series[key].observe(value)
+
+
+def inc(name: str, value=1.0, **labels) -> None:
+    if not enabled:
+        return
+    with _lock:
+        series = _counters.setdefault(name, {})
+        key = _key(labels)
+        series[key] = series.get(key, 0.0) + value
+
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    if not enabled:
+        return
+    with _lock:
+        _gauges.setdefault(name, {})[_key(labels)] = value
+
+
+def queue_depth(queue_name: str, depth: int) -> None:
+    set_gauge('queue_depth', depth, queue=queue_name)
+
+
+def sample_profile() -> bool:
+    """ Whether the next inference call should be traced """
+    return enabled and profile_sample_rate > 0 and random.random() < profile_sample_rate
+
+
+def add_trace(model: str, path: str) -> None:
+    with _lock:
+        _traces.append({'model': model, 'path': path, 'time': time.time()})
+        # keep the newest, the files themselves stay on disk
+        del _traces[:-100]
+
+
+def reset() -> None:
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _gauges.clear()
+        _traces.clear()
+
+
+def _format_labels(key: Tuple, extra: Tuple = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ''
+    body = ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in pairs)
+    return '{' + body + '}'
+
+
+def prometheus_text(prefix='booruvision_') -> str:
+    """ Everything recorded so far in the Prometheus text exposition format """
+    lines = []
+    with _lock:
+        for name, series in sorted(_counters.items()):
+            lines.append(f'# HELP {prefix}{name} {HELP.get(name, name)}')
+            lines.append(f'# TYPE {prefix}{name} counter')
+            for key, value in series.items():
+                lines.append(f'{prefix}{name}{_format_labels(key)} {value}')
+        for name, series in sorted(_gauges.items()):
+            lines.append(f'# HELP {prefix}{name} {HELP.get(name, name)}')
+            lines.append(f'# TYPE {prefix}{name} gauge')
+            for key, value in series.items():
+                lines.append(f'{prefix}{name}{_format_labels(key)} {value}')
+        for name, series in sorted(_histograms.items()):
+            lines.append(f'# HELP {prefix}{name} {HELP.get(name, name)}')
+            lines.append(f'# TYPE {prefix}{name} histogram')
+            for key, histogram in series.items():
+                for bound, count in zip(histogram.buckets, histogram.cumulative()):
+                    labels = _format_labels(key, (('le', bound),))
+                    lines.append(f'{prefix}{name}_bucket{labels} {count}')
+                labels = _format_labels(key, (('le', '+Inf'),))
+                lines.append(f'{prefix}{name}_bucket{labels} {histogram.count}')
+                lines.append(f'{prefix}{name}_sum{_format_labels(key)} {histogram.sum}')
+                lines.append(f'{prefix}{name}_count{_format_labels(key)} {histogram.count}')
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot() -> Dict:
+    """ Everything recorded so far as plain data, with means and the cache hit rate """
+    def label_string(key):
+        return ','.join(f'{k}={v}' for k, v in key) or '_'
+
+    with _lock:
+        data = {
+            'time': time.time(),
+            'counters': {
+                name: {label_string(k): v for k, v in series.items()}
+                for name, series in _counters.items()
+            },
+            'gauges': {
+                name: {label_string(k): v for k, v in series.items()}
+                for name, series in _gauges.items()
+            },
+            'histograms': {
+                name: {
+                    label_string(k): {
+                        'count': h.count,
+                        'sum': h.sum,
+                        'mean': h.sum / h.count if h.count else 0.0,
+                        'buckets': dict(zip(map(str, h.buckets), h.cumulative())),
+                    }
+                    for k, h in series.items()
+                }
+                for name, series in _histograms.items()
+            },
+            'traces': list(_traces),
+        }
+
+    cache = data['counters'].get('cache_requests_total', {})
+    hits = sum(v for k, v in cache.items() if 'result=hit' in k)
+    total = sum(cache.values())
+    data['cache_hit_rate'] = hits / total if total else None
+    return data
+
+
+def start_json_log(path: str, interval=10.0) -> threading.Thread:
+    """ Append a snapshot as one JSON line to path every interval seconds """
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                with open(path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(snapshot()) + '\n')
+            except OSError as e:
+                print(f'Could not write metrics to {path}: {e}')
+
+    thread = threading.Thread(target=run, name='metrics-log', daemon=True)
+    thread.start()
+    return thread
+
+
+def start_http_server(port: int, host='127.0.0.1'):
+    """ Serve prometheus_text at http://host:port/metrics from a background thread """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = prometheus_text().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+
+def configure(
+    enable_metrics=True,
+    port: Optional[int] = None,
+    json_log: Optional[str] = None,
+    interval=10.0,
+    sample_rate: Optional[float] = None,
+    trace_dir: Optional[str] = None
+) -> None:
+    """ Turn metrics on and start the requested exporters """
+    global profile_sample_rate, profile_dir
+    enable(enable_metrics)
+    if not enable_metrics:
+        return
+    if sample_rate is not None:
+        profile_sample_rate = sample_rate
+    if trace_dir:
+        profile_dir = trace_dir
+    if port:
+        start_http_server(port)
+    if json_log:
+        start_json_log(json_log, interval)
@@ -0,0 +1,20 @@
+"""Settings shared by the interrogators and their callers
+
+Kept free of heavy imports, so the GUI and the command line can read and
+check their configuration before numpy, onnxruntime or the models load.
+"""
+
+# onnxruntime session settings an interrogator accepts in session_options,
+# named after the SessionOptions attributes they set
+SESSION_OPTION_TYPES = {
+    'intra_op_num_threads': int,
+    'inter_op_num_threads': int,
+    'graph_optimization_level': str,  # disable, basic, extended or all
+    'execution_mode': str,  # sequential or parallel
+    'enable_cpu_mem_arena': bool,
+    'enable_mem_pattern': bool,
+    # save the optimized graph here and load it next time, skipping optimization
+    'optimized_model_dir': str,
+    # trace every run with the onnxruntime profiler, into files with this prefix
+    'profile_file_prefix': str,
+}
@@ -0,0 +1,22 @@
+"""Per-user locations of the files kept between runs"""
+
+import os
+from pathlib import Path
+
+
+def user_cache_dir() -> Path:
+    """ Where rebuildable files go: %LOCALAPPDATA%\\booruvision on Windows,
+    $XDG_CACHE_HOME/booruvision or ~/.cache/booruvision elsewhere """
+    if os.name == 'nt' and os.environ.get('LOCALAPPDATA'):
+        return Path(os.environ['LOCALAPPDATA']) / 'booruvision'
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return Path(base) / 'booruvision'
+
+
+def user_config_dir() -> Path:
+    """ Where settings go: %APPDATA%\\booruvision on Windows,
+    $XDG_CONFIG_HOME/booruvision or ~/.config/booruvision elsewhere """
+    if os.name == 'nt' and os.environ.get('APPDATA'):
+        return Path(os.environ['APPDATA']) / 'booruvision'
+    base = os.environ.get('XDG_CONFIG_HOME') or os.path.join(os.path.expanduser('~'), '.config')
+    return Path(base) / 'booruvision'
@@ -0,0 +1,237 @@
+"""Streaming batch tagging pipeline"""
+
+import threading
+import time
+from pathlib import Path
+from queue import Empty, Queue
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+
+from PIL import Image
+
+from tagger.cache import ResultCache, image_digest
+from tagger.interrogator import Interrogator
+import tagger.preprocessing as preprocessing
+from tagger import metrics
+
+# sentinel passed down the queues once a stage has no more work
+_DONE = object()
+
+
+def load_image(path, fits: Optional[Callable[[int, int], bool]] = None) -> Image.Image:
+    """
+    Open and fully decode an image so the file handle can be closed. With
+    fits, usually Interrogator.fits_input, oversized JPEGs are decoded at
+    the smallest 1/2, 1/4 or 1/8 scale that fits(width, height) accepts.
+    """
+    image = Image.open(path)
+    if fits is not None:
+        preprocessing.draft(image, fits)
+    image.load()
+    return image
+
+
+class TaggingPipeline:
+    """
+    Tags a stream of image files in three stages connected by bounded queues:
+
+        decode workers -> batched inference -> result writer
+
+    The workers decode and preprocess images while the calling thread runs
+    the model, and a background writer hands results to the callback. Every
+    queue is bounded, so a slow stage blocks the ones feeding it and memory
+    stays flat no matter how many files are queued.
+
+    With a result cache, the workers look every decoded image up first and
+    cache hits skip preprocessing and inference entirely.
+
+    With reduced_decoding, large JPEGs are decoded straight at a fraction of
+    their size that still covers the model input.
+
+    With max_latency, a partial batch is run max_latency seconds after its
+    first image was decoded instead of waiting to be filled, for paths that
+    trickle in, such as a watched folder's.
+    """
+
+    def __init__(
+        self,
+        interrogator: Interrogator,
+        batch_size=8,
+        workers=4,
+        queue_size=None,
+        report_interval=5.0,
+        cache: ResultCache = None,
+        reduced_decoding=True,
+        max_latency: Optional[float] = None
+    ) -> None:
+        self.interrogator = interrogator
+        self.cache = cache or interrogator.cache
+        self.model_id = interrogator.model_id()
+        self.batch_size = max(1, batch_size)
+        self.workers = max(1, workers)
+        # enough to keep one batch in flight and the next one filling
+        self.queue_size = queue_size or self.batch_size * 2
+        self.report_interval = report_interval
+        self.fits = interrogator.fits_input if reduced_decoding else None
+        self.max_latency = max_latency
+
+    def _feed(self, paths: Iterable[Path], path_queue: Queue, errors: list) -> None:
+        try:
+            for path in paths:
+                path_queue.put(path)
+        except Exception as e:
+            # run() raises it once the paths listed so far are done
+            errors.append(e)
+        finally:
+            for _ in range(self.workers):
+                path_queue.put(_DONE)
+
+    def _decode(self, path_queue: Queue, input_queue: Queue) -> None:
+        while True:
+            path = path_queue.get()
+            if path is _DONE:
+                input_queue.put(_DONE)
+                return
+            try:
+                with metrics.stage('decode'):
+                    image = load_image(path, self.fits)
+                digest = None
+                if self.cache is not None:
+                    digest = image_digest(image)
+                    confidents = self.cache.get(digest, self.model_id)
+                    metrics.inc(
+                        'cache_requests_total',
+                        result='miss' if confidents is None else 'hit')
+                    if confidents is not None:
+                        input_queue.put((path, None, digest, confidents))
+                        continue
+                with metrics.stage('preprocess'):
+                    x = self.interrogator.preprocess(image)
+            except Exception as e:
+                print(f'Error reading {path}: {e}')
+                continue
+            input_queue.put((path, x, digest, None))
+
+    def _write(
+        self,
+        result_queue: Queue,
+        on_result: Callable[[Path, np.ndarray], None]
+    ) -> None:
+        while True:
+            item = result_queue.get()
+            if item is _DONE:
+                return
+            path, confidents = item
+            try:
+                with metrics.stage('write'):
+                    on_result(path, confidents)
+            except Exception as e:
+                print(f'Error writing result for {path}: {e}')
+
+    def run(
+        self,
+        paths: Iterable[Path],
+        on_result: Callable[[Path, np.ndarray], None]
+    ) -> int:
+        """ Tag every path, calling on_result(path, confidents) from the writer
+        thread as results arrive, where confidents is the row returned by
+        Interrogator.infer. Returns the number of tagged images. If paths
+        raises, the paths before the error are still tagged, then it is
+        raised here. """
+        # load once up front, the decode workers must not race to do it
+        self.interrogator.ensure_loaded()
+
+        path_queue = Queue(maxsize=self.queue_size)
+        input_queue = Queue(maxsize=self.queue_size)
+        result_queue = Queue(maxsize=self.queue_size)
+
+        feed_errors = []
+        threads = [threading.Thread(
+            target=self._feed, args=(paths, path_queue, feed_errors), daemon=True)]
+        threads += [
+            threading.Thread(
+                target=self._decode, args=(path_queue, input_queue), daemon=True)
+            for _ in range(self.workers)
+        ]
+        writer = threading.Thread(
+            target=self._write, args=(result_queue, on_result), daemon=True)
+        for thread in threads + [writer]:
+            thread.start()
+
+        start = time.perf_counter()
+        last_report = start
+        processed = 0
+        cache_hits = 0
+        batch = []
+
+        def report():
+            nonlocal last_report
+            now = time.perf_counter()
+            if now - last_report >= self.report_interval:
+                last_report = now
+                print(f'Processed {processed} images, '
+                      f'{processed / (now - start):.1f} images/sec')
+
+        def flush():
+            nonlocal processed
+            if metrics.enabled:
+                metrics.queue_depth('paths', path_queue.qsize())
+                metrics.queue_depth('inputs', input_queue.qsize())
+                metrics.queue_depth('results', result_queue.qsize())
+            with metrics.stage('infer', model=self.interrogator.name):
+                confidents = self.interrogator.infer(
+                    [x for _, x, _, _ in batch], batch_size=self.batch_size)
+            if self.cache is not None:
+                self.cache.put_many(
+                    (digest, self.model_id, row)
+                    for (_, _, digest, _), row in zip(batch, confidents))
+            for (path, _, _, _), row in zip(batch, confidents):
+                result_queue.put((path, row))
+            processed += len(batch)
+            metrics.inc('images_total', len(batch), model=self.interrogator.name)
+            batch.clear()
+            report()
+
+        finished = 0
+        deadline = None
+        while finished < self.workers:
+            timeout = None
+            if batch and self.max_latency is not None:
+                timeout = max(0, deadline - time.monotonic())
+            try:
+                item = input_queue.get(timeout=timeout)
+            except Empty:
+                flush()
+                continue
+            if item is _DONE:
+                finished += 1
+                continue
+            path, _, _, confidents = item
+            if confidents is not None:
+                result_queue.put((path, confidents))
+                processed += 1
+                cache_hits += 1
+                report()
+                continue
+            batch.append(item)
+            if len(batch) == 1 and self.max_latency is not None:
+                deadline = time.monotonic() + self.max_latency
+            if len(batch) >= self.batch_size:
+                flush()
+        if batch:
+            flush()
+
+        result_queue.put(_DONE)
+        writer.join()
+
+        elapsed = time.perf_counter() - start
+        print(f'Done: {processed} images in {elapsed:.1f}s, '
+              f'{processed / elapsed if elapsed > 0 else 0:.1f} images/sec')
+        if self.cache is not None:
+            # hits only collect their access times
+            self.cache.flush()
+            print(f'Result cache hits: {cache_hits}/{processed}')
+        if feed_errors:
+            raise feed_errors[0]
+        return processed
@@ -0,0 +1,254 @@
+"""Loaded models kept within a memory budget, unloaded when idle"""
+
+import contextlib
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+from tagger import metrics
+
+if TYPE_CHECKING:
+    from tagger.interrogator import Interrogator
+
+
+def resident_bytes() -> Optional[int]:
+    """ Resident memory of this process, None where /proc isn't available """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def model_file_bytes(interrogator: 'Interrogator') -> int:
+    path = getattr(interrogator, 'model_file', None)
+    try:
+        return os.path.getsize(path) if path else 0
+    except OSError:
+        return 0
+
+
+class _Entry:
+    def __init__(self, interrogator: 'Interrogator') -> None:
+        self.interrogator = interrogator
+        # resident size while loaded, known after the first load through the pool
+        self.memory = 0
+        self.last_used = time.monotonic()
+        # callers between acquire and release, an entry in use is never unloaded
+        self.users = 0
+        self.pinned = False
+
+
+class ModelPool:
+    """
+    Keeps the most recently used models loaded. When loading one would go
+    over max_memory bytes, the least recently used models nobody is using
+    are unloaded first, and models idle for idle_timeout seconds are
+    unloaded by a background thread. Without either limit, loaded models
+    simply stay loaded.
+
+    The memory of a model is the growth of the process's resident memory
+    while loading it, but at least the size of its model file, which is all
+    that can be told where /proc is missing. Ensembles are accounted as
+    their members, so a model shared by several ensembles counts once.
+
+    Use acquire and release, or use(), around inference so that a model is
+    never unloaded while it runs.
+    """
+
+    def __init__(
+        self,
+        max_memory: Optional[int] = None,
+        idle_timeout: Optional[float] = None
+    ) -> None:
+        self.max_memory = max_memory
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        # one load at a time, so resident memory growth belongs to that model
+        self.load_lock = threading.Lock()
+        # name -> entry, least recently used first
+        self.entries: Dict[str, _Entry] = {}
+        self.evictions = 0
+        self.wakeup = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.configure(max_memory, idle_timeout)
+
+    def configure(self, max_memory: Optional[int] = None, idle_timeout: Optional[float] = None) -> None:
+        """ Change the limits, 0 or None turns a limit off """
+        self.max_memory = max_memory or None
+        self.idle_timeout = idle_timeout or None
+        if self.idle_timeout and (self.thread is None or not self.thread.is_alive()):
+            self.thread = threading.Thread(target=self._unload_idle, name='model-pool', daemon=True)
+            self.thread.start()
+        self.wakeup.set()
+        with self.lock:
+            self._evict(0, [])
+
+    @staticmethod
+    def _members(interrogator: 'Interrogator') -> List['Interrogator']:
+        return getattr(interrogator, 'members', [interrogator])
+
+    def _entries(self, interrogator: 'Interrogator') -> List[_Entry]:
+        entries = []
+        for member in self._members(interrogator):
+            entry = self.entries.pop(member.name, None) or _Entry(member)
+            entry.interrogator = member
+            entry.last_used = time.monotonic()
+            # most recently used go last
+            self.entries[member.name] = entry
+            entries.append(entry)
+        return entries
+
+    def loaded_memory(self) -> int:
+        return sum(
+            entry.memory or model_file_bytes(entry.interrogator)
+            for entry in self.entries.values() if entry.interrogator.is_loaded())
+
+    def _evict(self, needed: int, keep: List[_Entry], reason='budget') -> None:
+        """ Unload least recently used models until needed more bytes fit the budget """
+        if self.max_memory is None:
+            return
+        total = self.loaded_memory()
+        for entry in list(self.entries.values()):
+            if total + needed <= self.max_memory:
+                return
+            if entry in keep or entry.users or entry.pinned:
+                continue
+            if not entry.interrogator.is_loaded():
+                continue
+            print(f'Unloading {entry.interrogator.name} to stay within the model memory budget')
+            total -= entry.memory or model_file_bytes(entry.interrogator)
+            self._unload(entry, reason)
+
+    def _unload(self, entry: _Entry, reason: str) -> None:
+        if entry.interrogator.unload():
+            self.evictions += 1
+            metrics.inc('pool_evictions_total', model=entry.interrogator.name, reason=reason)
+        metrics.set_gauge('model_memory_bytes', 0, model=entry.interrogator.name)
+
+    def acquire(self, interrogator: 'Interrogator') -> 'Interrogator':
+        """ Load interrogator if needed and mark it in use until release """
+        with self.lock:
+            entries = self._entries(interrogator)
+            for entry in entries:
+                entry.users += 1
+            needed = sum(
+                entry.memory for entry in entries if not entry.interrogator.is_loaded())
+            self._evict(needed, entries)
+
+        try:
+            if not interrogator.is_loaded():
+                with self.load_lock:
+                    for entry in entries:
+                        self._load(entry)
+                    # an ensemble still has to build its columns
+                    interrogator.ensure_loaded()
+        except BaseException:
+            self.release(interrogator)
+            raise
+
+        with self.lock:
+            self._evict(0, entries)
+            metrics.set_gauge('pool_memory_bytes', self.loaded_memory())
+        return interrogator
+
+    def _load(self, entry: _Entry) -> None:
+        member = entry.interrogator
+        if member.is_loaded():
+            return
+        # imported up front, so the first model isn't charged for onnxruntime itself
+        import onnxruntime  # noqa: F401
+
+        before = resident_bytes()
+        member.ensure_loaded()
+        after = resident_bytes()
+        grown = after - before if before is not None and after is not None else 0
+        entry.memory = max(grown, model_file_bytes(member))
+        metrics.set_gauge('model_memory_bytes', entry.memory, model=member.name)
+
+    def release(self, interrogator: 'Interrogator') -> None:
+        with self.lock:
+            for member in self._members(interrogator):
+                entry = self.entries.get(member.name)
+                if entry is not None and entry.users:
+                    entry.users -= 1
+                    entry.last_used = time.monotonic()
+
+    @contextlib.contextmanager
+    def use(self, interrogator: 'Interrogator'):
+        """ acquire and release around a block """
+        self.acquire(interrogator)
+        try:
+            yield interrogator
+        finally:
+            self.release(interrogator)
+
+    def pin(self, interrogator: 'Interrogator', pinned=True) -> None:
+        """ A pinned model is never unloaded by the pool """
+        with self.lock:
+            for entry in self._entries(interrogator):
+                entry.pinned = pinned
+
+    def unload(self, interrogator: 'Interrogator') -> bool:
+        """ Unload interrogator now, unless it's in use """
+        with self.lock:
+            entries = [self.entries.get(m.name) for m in self._members(interrogator)]
+            if any(entry is not None and entry.users for entry in entries):
+                return False
+            unloaded = interrogator.unload()
+            for member in self._members(interrogator):
+                metrics.set_gauge('model_memory_bytes', 0, model=member.name)
+            metrics.set_gauge('pool_memory_bytes', self.loaded_memory())
+            return unloaded
+
+    def _unload_idle(self) -> None:
+        while True:
+            timeout = self.idle_timeout
+            if not timeout:
+                return
+            self.wakeup.wait(min(max(timeout / 4, 0.05), 30))
+            self.wakeup.clear()
+            now = time.monotonic()
+            with self.lock:
+                for entry in list(self.entries.values()):
+                    if (
+                        self.idle_timeout
+                        and not entry.users and not entry.pinned
+                        and entry.interrogator.is_loaded()
+                        and now - entry.last_used >= self.idle_timeout
+                    ):
+                        print(f'Unloading {entry.interrogator.name}, '
+                              f'idle for {now - entry.last_used:.1f}s')
+                        self._unload(entry, 'idle')
+                metrics.set_gauge('pool_memory_bytes', self.loaded_memory())
+
+    def stats(self) -> Dict:
+        """ Loaded models, their memory and load counts, and the pool's limits """
+        with self.lock:
+            now = time.monotonic()
+            models = {
+                name: {
+                    'loaded': entry.interrogator.is_loaded(),
+                    'memory_bytes': (
+                        entry.memory or model_file_bytes(entry.interrogator)
+                        if entry.interrogator.is_loaded() else 0),
+                    'loads': entry.interrogator.loads,
+                    'unloads': entry.interrogator.unloads,
+                    'idle_seconds': now - entry.last_used,
+                    'in_use': entry.users,
+                    'pinned': entry.pinned,
+                }
+                for name, entry in self.entries.items()
+            }
+            return {
+                'memory_bytes': self.loaded_memory(),
+                'max_memory_bytes': self.max_memory,
+                'idle_timeout': self.idle_timeout,
+                'evictions': self.evictions,
+                'models': models,
+            }
+
+
+# shared by wd_tagger and server.py, the registry's models are shared as well
+default_pool = ModelPool()
@@ -0,0 +1,215 @@
+"""Single-pass image preprocessing shared by the interrogators
+
+Every interrogator used to composite alpha, convert and pad the image at
+full resolution before shrinking it to the model input size. Here each
+image is reduced to model size first and copied as little as possible:
+
+- alpha is composited onto white only when the image actually has it
+- the image is resized before it is padded, so padding is done at model size
+- preprocessed images stay uint8, and are written once into a reused
+  float32 batch buffer right before inference
+- JPEGs much larger than the model input are decoded at a reduced scale by
+  the decoder itself, as long as the result still covers the model input
+"""
+
+import threading
+from typing import Callable, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+ALPHA_MODES = ('RGBA', 'RGBa', 'LA', 'La', 'PA')
+
+# scales libjpeg can decode at directly, largest reduction first
+REDUCTION_FACTORS = (8, 4, 2)
+
+CV2_REDUCED_FLAGS = {
+    cv2.IMREAD_COLOR: {
+        2: cv2.IMREAD_REDUCED_COLOR_2,
+        4: cv2.IMREAD_REDUCED_COLOR_4,
+        8: cv2.IMREAD_REDUCED_COLOR_8,
+    },
+    cv2.IMREAD_GRAYSCALE: {
+        2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+        4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+        8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    },
+}
+
+
+def has_alpha(image: Image.Image) -> bool:
+    return image.mode in ALPHA_MODES or 'transparency' in image.info
+
+
+def reduction_factor(
+    size: Tuple[int, int],
+    fits: Callable[[int, int], bool]
+) -> int:
+    """
+    Largest decoder reduction whose output still fits, 1 if none does.
+    fits(width, height) tells whether an image of that size still has at
+    least model resolution, so a reduced decode never has to be enlarged.
+    """
+    width, height = size
+    for factor in REDUCTION_FACTORS:
+        # the decoder rounds reduced sizes up
+        if fits(-(-width // factor), -(-height // factor)):
+            return factor
+    return 1
+
+
+def draft(image: Image.Image, fits: Callable[[int, int], bool]) -> int:
+    """
+    Make an opened, not yet loaded, JPEG decode at the largest reduction that
+    still fits. Other formats are left alone. Returns the factor used.
+    """
+    if image.format != 'JPEG':
+        return 1
+    factor = reduction_factor(image.size, fits)
+    if factor > 1:
+        width, height = image.size
+        image.draft(image.mode, (-(-width // factor), -(-height // factor)))
+    return factor
+
+
+def cv2_reduced_flag(path: str, flag: int, fits: Callable[[int, int], bool]) -> int:
+    """
+    The IMREAD_REDUCED_* variant of flag for reading path, if it is a JPEG
+    that can be reduced and still fit. OpenCV only decodes JPEGs at reduced
+    scale, everything else would be fully decoded and resized afterwards.
+    """
+    if flag not in CV2_REDUCED_FLAGS:
+        return flag
+    with Image.open(path) as image:
+        if image.format != 'JPEG':
+            return flag
+        factor = reduction_factor(image.size, fits)
+    return CV2_REDUCED_FLAGS[flag].get(factor, flag)
+
+
+def premultiply(image: Image.Image) -> np.ndarray:
+    """
+    Decoded image -> HxWx3 uint8 RGB, or HxWx4 RGBA premultiplied by alpha if
+    it has any transparency. Compositing over white is linear in the
+    premultiplied values, so those can be resized first and flattened after.
+    """
+    if has_alpha(image):
+        rgba = np.asarray(image if image.mode == 'RGBA' else image.convert('RGBA'))
+        if rgba[:, :, 3].min() == 255:
+            return cv2.cvtColor(rgba, cv2.COLOR_RGBA2RGB)
+        return cv2.cvtColor(rgba, cv2.COLOR_RGBA2mRGBA)
+
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return np.asarray(image)
+
+
+def flatten(pixels: np.ndarray) -> np.ndarray:
+    """ Composite premultiplied RGBA over white, RGB passes through """
+    if pixels.shape[2] == 3:
+        return pixels
+    # over white: premultiplied rgb + (255 - alpha), saturating since
+    # resampling filters that ring can push rgb slightly above alpha
+    background = cv2.bitwise_not(np.ascontiguousarray(pixels[:, :, 3]))
+    return cv2.add(
+        np.ascontiguousarray(pixels[:, :, :3]),
+        cv2.merge([background, background, background]))
+
+
+def to_rgb(image: Image.Image) -> np.ndarray:
+    """ Decoded image -> HxWx3 uint8 RGB array, with transparency filled white """
+    return flatten(premultiply(image))
+
+
+def fit_square(pixels: np.ndarray, size: int) -> np.ndarray:
+    """
+    Shrink the longest side to size (never enlarge) and pad with white to a
+    size x size square. Takes the output of premultiply. Same as
+    dbimutils.make_square followed by dbimutils.smart_resize, within a level
+    of rounding: the long side is shrunk at full resolution, and the short
+    side is padded only then, at that reduced size, to be shrunk as part of
+    the square. INTER_AREA is separable, so the image's edges are filtered
+    exactly where resizing the padded full resolution square puts them.
+    """
+    height, width = pixels.shape[:2]
+    longest = max(height, width)
+    if longest > size:
+        # transparent padding flattens to white, like white padding
+        pad = [255] * 3 if pixels.shape[2] == 3 else [0] * 4
+        if width > height:
+            pixels = cv2.resize(pixels, (size, height), interpolation=cv2.INTER_AREA)
+            top = (longest - height) // 2
+            pixels = cv2.copyMakeBorder(
+                pixels, top, longest - height - top, 0, 0, cv2.BORDER_CONSTANT, value=pad)
+        elif height > width:
+            pixels = cv2.resize(pixels, (width, size), interpolation=cv2.INTER_AREA)
+            left = (longest - width) // 2
+            pixels = cv2.copyMakeBorder(
+                pixels, 0, 0, left, longest - width - left, cv2.BORDER_CONSTANT, value=pad)
+        pixels = cv2.resize(pixels, (size, size), interpolation=cv2.INTER_AREA)
+        return flatten(pixels)
+    rgb = flatten(pixels)
+
+    top = (size - height) // 2
+    left = (size - width) // 2
+    square = np.full((size, size, 3), 255, dtype=np.uint8)
+    square[top:top + height, left:left + width] = rgb
+    return square
+
+
+def fit_short_side(image: Image.Image, size: int) -> np.ndarray:
+    """
+    Same as dbimutils.fill_transparent followed by dbimutils.resize with
+    keep_ratio. Transparent images are resized premultiplied and flattened
+    afterwards, so the full resolution image is never composited.
+    """
+    width, height = image.size
+    min_edge = min(width, height)
+    target_size = (
+        int(width / min_edge * size) & ~3,
+        int(height / min_edge * size) & ~3,
+    )
+
+    if has_alpha(image) and min_edge > size:
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        image = image.convert('RGBa')
+    elif has_alpha(image):
+        # enlarging, flattening the small source first is cheap and keeps
+        # the filter's ringing out of the premultiplied values
+        image = Image.fromarray(to_rgb(image))
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    if target_size != image.size:
+        image = image.resize(target_size, resample=Image.Resampling.LANCZOS)
+    return flatten(np.asarray(image))
+
+
+def square_input(image: Image.Image, size: int) -> np.ndarray:
+    """ Input for WaifuDiffusion models, size x size x 3 uint8 RGB """
+    return fit_square(premultiply(image), size)
+
+
+def short_side_input(image: Image.Image, size: int) -> np.ndarray:
+    """ Input for MLDanbooru models, HxWx3 uint8 RGB with the short side at size """
+    return fit_short_side(image, size)
+
+
+class BatchBuffer:
+    """
+    A float32 batch tensor reused across calls. Storage only grows, and every
+    thread gets its own so concurrent callers never share a buffer.
+    """
+
+    def __init__(self) -> None:
+        self.local = threading.local()
+
+    def get(self, shape: Tuple[int, ...]) -> np.ndarray:
+        size = int(np.prod(shape))
+        storage = getattr(self.local, 'storage', None)
+        if storage is None or storage.size < size:
+            storage = np.empty(size, dtype=np.float32)
+            self.local.storage = storage
+        return storage[:size].reshape(shape)
@@ -0,0 +1,308 @@
+"""Multi-process tagging with preprocessed batches in shared memory"""
+
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+
+from tagger.interrogator import Interrogator
+from tagger.pipeline import load_image
+
+# a batch too big for a shared memory slot travels pickled instead, so
+# slots hold this many model inputs of the dummy input size per image
+SLOT_HEADROOM = 2
+
+
+class ShardedTagger:
+    """
+    Tags image files with two pools of forked processes:
+
+        decoders -> shared memory slots -> runners -> ordered collector
+
+    Decoders read a batch of paths, preprocess them and write the inputs
+    straight into a free shared memory slot, only the slot number and the
+    array layout go through the queue. Runners each own an onnxruntime
+    session pinned to threads_per_runner threads, infer the batch in place
+    from the slot and hand the slot back. The calling process collects the
+    results and calls on_result in input order.
+
+    The model is loaded before forking, so tags, resolved model files and
+    the input size are inherited. With one thread per runner, the default,
+    the session is built once in the calling process and every runner uses
+    it as inherited, so the weights are shared copy-on-write between all of
+    them. A session's thread pool can't cross a fork, so with more threads
+    per runner every runner builds its own session from the already
+    resolved files instead, and the calling process drops its session
+    before forking. Needs the fork start method.
+    """
+
+    def __init__(
+        self,
+        interrogator: Interrogator,
+        batch_size=8,
+        runners: Optional[int] = None,
+        threads_per_runner: Optional[int] = None,
+        decoders: Optional[int] = None,
+        slots: Optional[int] = None,
+        reduced_decoding=True,
+        report_interval=5.0
+    ) -> None:
+        cores = os.cpu_count() or 1
+        self.interrogator = interrogator
+        self.batch_size = max(1, batch_size)
+        self.threads_per_runner = threads_per_runner or 1
+        self.runners = runners or max(1, cores // (2 * self.threads_per_runner))
+        self.decoders = decoders or max(1, cores // 2)
+        # one batch being decoded and one being run per process
+        self.slots = slots or 2 * (self.runners + self.decoders)
+        self.reduced_decoding = reduced_decoding
+        self.report_interval = report_interval
+        # the runners use the calling process' session
+        self.share_session = self.threads_per_runner == 1
+
+    @staticmethod
+    def available() -> bool:
+        return 'fork' in mp.get_all_start_methods()
+
+    def _decode(self, tasks, free_slots, ready, results, memory) -> None:
+        interrogator = self.interrogator
+        interrogator.after_fork()
+        fits = interrogator.fits_input if self.reduced_decoding else None
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            index, paths = task
+            done, inputs, errors = [], [], []
+            for path in paths:
+                try:
+                    inputs.append(interrogator.preprocess(load_image(path, fits)))
+                    done.append(path)
+                except Exception as e:
+                    errors.append(f'Error reading {path}: {e}')
+            if not inputs:
+                results.put((index, [], None, errors))
+                continue
+
+            arrays = [
+                list(x.items()) if isinstance(x, dict) else [(None, x)]
+                for x in inputs
+            ]
+            size = sum(a.nbytes for item in arrays for _, a in item)
+            slot = free_slots.get()
+            if size > memory[slot].size:
+                # too big for a slot, rare enough to pickle
+                free_slots.put(slot)
+                ready.put((index, done, None, inputs, errors))
+                continue
+
+            buffer = memory[slot].buf
+            layout = []
+            offset = 0
+            for item in arrays:
+                entries = []
+                for key, a in item:
+                    view = np.ndarray(a.shape, a.dtype, buffer=buffer, offset=offset)
+                    view[...] = a
+                    entries.append((key, a.shape, a.dtype.str, offset))
+                    offset += a.nbytes
+                layout.append(entries)
+            ready.put((index, done, slot, layout, errors))
+
+    def _set_threads(self) -> Dict:
+        """ Give the sessions threads_per_runner threads, returns the options
+        of the members that had others before by name. Changing the options
+        of a loaded model unloads it, so members already set up are left alone. """
+        options = {
+            'intra_op_num_threads': self.threads_per_runner,
+            'inter_op_num_threads': 1,
+        }
+        previous = {}
+        for member in getattr(self.interrogator, 'members', [self.interrogator]):
+            changed = {**member.session_options, **options}
+            if changed != member.session_options:
+                previous[member.name] = member.session_options
+                member.set_session_options(changed)
+        return previous
+
+    def _run(self, ready, free_slots, results, memory) -> None:
+        interrogator = self.interrogator
+        interrogator.after_fork(keep_session=self.share_session)
+        if not self.share_session:
+            self._set_threads()
+        interrogator.ensure_loaded()
+
+        while True:
+            item = ready.get()
+            if item is None:
+                return
+            index, paths, slot, layout, errors = item
+            try:
+                if slot is None:
+                    inputs = layout
+                else:
+                    buffer = memory[slot].buf
+                    inputs = []
+                    for entries in layout:
+                        views = {
+                            key: np.ndarray(shape, np.dtype(dtype), buffer=buffer, offset=offset)
+                            for key, shape, dtype, offset in entries
+                        }
+                        inputs.append(views[None] if None in views else views)
+                confidents = interrogator.infer(inputs, batch_size=self.batch_size)
+                del inputs
+            except Exception as e:
+                confidents = None
+                errors = errors + [f'Error tagging {len(paths)} images: {e}']
+            finally:
+                if slot is not None:
+                    free_slots.put(slot)
+            results.put((index, paths, confidents, errors))
+
+    def _feed(self, paths: Iterable[Path], tasks, counter: Dict) -> None:
+        batch = []
+        try:
+            for path in paths:
+                batch.append(path)
+                if len(batch) >= self.batch_size:
+                    tasks.put((counter['batches'], batch))
+                    counter['batches'] += 1
+                    batch = []
+        except Exception as e:
+            # run() raises it once the paths listed so far are done
+            counter['error'] = e
+        finally:
+            if batch:
+                tasks.put((counter['batches'], batch))
+                counter['batches'] += 1
+            counter['done'] = True
+            for _ in range(self.decoders):
+                tasks.put(None)
+
+    def run(
+        self,
+        paths: Iterable[Path],
+        on_result: Callable[[Path, np.ndarray], None]
+    ) -> int:
+        """ Tag every path, calling on_result(path, confidents) in input order
+        from the calling thread. Returns the number of tagged images. If
+        paths raises, the paths before the error are still tagged, then it
+        is raised here. """
+        context = mp.get_context('fork')
+
+        # load in the parent, so every child inherits tags and resolved files,
+        # and the session itself when it is shared
+        previous = self._set_threads() if self.share_session else {}
+        self.interrogator.ensure_loaded()
+        dummy = self.interrogator.dummy_input()
+        dummies = dummy.values() if isinstance(dummy, dict) else [dummy]
+        slot_size = self.batch_size * SLOT_HEADROOM * sum(d.nbytes for d in dummies)
+        if not self.share_session:
+            # every runner builds its own, don't keep a copy of the weights here
+            self.interrogator.release_session()
+
+        memory: List[shared_memory.SharedMemory] = []
+        processes = []
+        try:
+            for _ in range(self.slots):
+                memory.append(shared_memory.SharedMemory(create=True, size=slot_size))
+
+            tasks = context.Queue(maxsize=self.slots)
+            free_slots = context.Queue()
+            for slot in range(self.slots):
+                free_slots.put(slot)
+            ready = context.Queue()
+            results = context.Queue()
+
+            processes += [
+                context.Process(
+                    target=self._decode,
+                    args=(tasks, free_slots, ready, results, memory), daemon=True)
+                for _ in range(self.decoders)
+            ]
+            processes += [
+                context.Process(
+                    target=self._run,
+                    args=(ready, free_slots, results, memory), daemon=True)
+                for _ in range(self.runners)
+            ]
+            for process in processes:
+                process.start()
+            print(f'Tagging with {self.decoders} decoders and {self.runners} runners '
+                  f'of {self.threads_per_runner} threads'
+                  f"{', sharing one session' if self.share_session else ''}")
+
+            counter = {'batches': 0, 'done': False, 'error': None}
+            feeder = threading.Thread(
+                target=self._feed, args=(paths, tasks, counter), daemon=True)
+            feeder.start()
+
+            processed = self._collect(results, counter, processes, on_result)
+            # every batch is in, let the runners go
+            for _ in range(self.runners):
+                ready.put(None)
+            for process in processes:
+                process.join(timeout=10)
+            if counter['error'] is not None:
+                raise counter['error']
+            return processed
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+            for block in memory:
+                block.close()
+                block.unlink()
+            # back to the caller's threading, the next use loads again
+            for member in getattr(self.interrogator, 'members', [self.interrogator]):
+                if member.name in previous:
+                    member.set_session_options(previous[member.name])
+
+    def _collect(self, results, counter: Dict, processes, on_result) -> int:
+        start = time.perf_counter()
+        last_report = start
+        processed = 0
+        collected = 0
+        # results that arrived ahead of an earlier batch
+        pending = {}
+
+        while not counter['done'] or collected < counter['batches']:
+            try:
+                item = results.get(timeout=1.0)
+            except queue.Empty:
+                if any(p.exitcode not in (None, 0) for p in processes):
+                    raise RuntimeError('A tagging process died')
+                continue
+            pending[item[0]] = item
+
+            while collected in pending:
+                _, paths, confidents, errors = pending.pop(collected)
+                collected += 1
+                for error in errors:
+                    print(error)
+                if confidents is None:
+                    continue
+                for path, row in zip(paths, confidents):
+                    try:
+                        on_result(path, row)
+                    except Exception as e:
+                        print(f'Error writing result for {path}: {e}')
+                processed += len(paths)
+
+            now = time.perf_counter()
+            if now - last_report >= self.report_interval:
+                last_report = now
+                print(f'Processed {processed} images, '
+                      f'{processed / (now - start):.1f} images/sec')
+
+        elapsed = time.perf_counter() - start
+        print(f'Done: {processed} images in {elapsed:.1f}s, '
+              f'{processed / elapsed if elapsed > 0 else 0:.1f} images/sec')
+        return processed
@@ -0,0 +1,406 @@
+"""
+Where tagging results go. A sink is called as on_result(path, confidents)
+and is closed at the end of the run.
+
+SidecarSink writes a text file next to every image. The others collect
+results and write them in bulk to one file: JSONL, CSV, a SQLite table or
+Parquet. They write out once buffer_size results are waiting, or
+flush_interval seconds after the oldest of them arrived, and tell the
+callbacks in flushed which paths they wrote, which is when the manifest
+records them. With confidences, the full row of every rating and tag
+confidence is stored as well, in the order of the model's vocabulary.
+
+numpy is not imported here, rows only use their own methods, so that
+importing wd_tagger stays cheap.
+"""
+
+import csv
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional
+
+if TYPE_CHECKING:
+    from tagger.interrogator import Interrogator
+
+SINK_FORMATS = ['txt', 'jsonl', 'csv', 'sqlite', 'parquet']
+
+
+class Sink:
+    """ Receives results one by one """
+
+    def __init__(self, interrogator: 'Interrogator', threshold: float) -> None:
+        self.interrogator = interrogator
+        self.threshold = threshold
+        # what the manifest compares to tell outputs apart
+        self.target = ''
+        self._names: Optional[List[str]] = None
+
+    def __call__(self, path: Path, confidents) -> None:
+        self.write(path, confidents)
+
+    def write(self, path: Path, confidents) -> None:
+        raise NotImplementedError()
+
+    def exists(self, path: Path) -> bool:
+        """ Whether the output of path is still there """
+        return True
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def names(self) -> List[str]:
+        """ What each column of confidents is, ratings first. Kept, the model
+        may be unloaded by the time the last results are written out. """
+        if self._names is None:
+            self._names = self.interrogator.ratings.tolist() + self.interrogator.tags.tolist()
+        return self._names
+
+    def record(self, path: Path, confidents) -> Dict:
+        """ Every rating and the tags above threshold, rounded like the GUI shows them """
+        ratings, _ = self.interrogator.split_confidents(confidents)
+        return {
+            'path': str(path),
+            'ratings': {
+                name: round(float(c), 4)
+                for name, c in zip(self.interrogator.ratings.tolist(), ratings)
+            },
+            'tags': {
+                name: round(float(c), 4)
+                for name, c in self.interrogator.postprocess(confidents, self.threshold).items()
+            },
+        }
+
+
+class SidecarSink(Sink):
+    """ A text file of comma separated tags next to every image """
+
+    def __init__(self, interrogator: 'Interrogator', threshold: float, ext='.txt') -> None:
+        super().__init__(interrogator, threshold)
+        self.ext = ext
+        self.target = ext
+
+    def sidecar(self, path: Path) -> Path:
+        return path.parent / f"{path.stem}{self.ext}"
+
+    def write(self, path: Path, confidents) -> None:
+        tags = self.interrogator.postprocess(confidents, self.threshold)
+        with open(self.sidecar(path), "w") as fp:
+            fp.write(", ".join(tags.keys()))
+
+    def exists(self, path: Path) -> bool:
+        return self.sidecar(path).is_file()
+
+
+class BufferedSink(Sink):
+    """ Collects rows made by row() and hands them to write_rows in bulk """
+
+    def __init__(
+        self,
+        interrogator: 'Interrogator',
+        threshold: float,
+        buffer_size=256,
+        flush_interval: Optional[float] = 1.0
+    ) -> None:
+        super().__init__(interrogator, threshold)
+        self.buffer_size = max(1, buffer_size)
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.paths: List[Path] = []
+        self.rows: List = []
+        self.oldest = 0.0
+        self.written = 0
+        # called with the paths of every bulk write, after it
+        self.flushed: List[Callable[[List[Path]], None]] = []
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def row(self, path: Path, confidents):
+        raise NotImplementedError()
+
+    def write_rows(self, rows: List) -> None:
+        raise NotImplementedError()
+
+    def write(self, path: Path, confidents) -> None:
+        row = self.row(path, confidents)
+        with self.lock:
+            if not self.rows:
+                self.oldest = time.monotonic()
+            self.paths.append(path)
+            self.rows.append(row)
+            if len(self.rows) >= self.buffer_size:
+                self._flush()
+        if self.flush_interval and self.thread is None:
+            # results that trickle in still go out within flush_interval
+            self.thread = threading.Thread(
+                target=self._flush_stale, name=f'{type(self).__name__}-flush', daemon=True)
+            self.thread.start()
+
+    def _flush(self) -> None:
+        if not self.rows:
+            return
+        rows, paths = self.rows, self.paths
+        self.rows, self.paths = [], []
+        self.write_rows(rows)
+        self.written += len(rows)
+        for callback in self.flushed:
+            callback(paths)
+
+    def flush(self) -> None:
+        with self.lock:
+            self._flush()
+
+    def _flush_stale(self) -> None:
+        while not self.stopped.wait(self.flush_interval / 2):
+            with self.lock:
+                if self.rows and time.monotonic() - self.oldest >= self.flush_interval:
+                    try:
+                        self._flush()
+                    except Exception as e:
+                        print(f'Error writing results: {e}')
+
+    def close(self) -> None:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+
+class JsonlSink(BufferedSink):
+    """
+    One JSON object per image appended to out, with every rating and the
+    tags above threshold. With confidences, "confidents" holds the full row,
+    and the names of its columns are written to vocabulary_path once.
+    """
+
+    def __init__(
+        self,
+        interrogator: 'Interrogator',
+        threshold: float,
+        out,
+        confidences=False,
+        vocabulary_path: Optional[os.PathLike] = None,
+        **kwargs
+    ) -> None:
+        super().__init__(interrogator, threshold, **kwargs)
+        self.out = out
+        self.confidences = confidences
+        self.vocabulary_path = vocabulary_path
+        self.target = f'jsonl:{getattr(out, "name", "")}'
+
+    def row(self, path: Path, confidents) -> str:
+        record = self.record(path, confidents)
+        if self.confidences:
+            self.names()
+            record['confidents'] = confidents.astype('float32').round(6).tolist()
+        return json.dumps(record, ensure_ascii=False)
+
+    def write_rows(self, rows: List[str]) -> None:
+        if self.confidences and self.vocabulary_path is not None:
+            write_vocabulary(self.vocabulary_path, self.interrogator.model_id(), self.names())
+            self.vocabulary_path = None
+        self.out.write('\n'.join(rows) + '\n')
+        self.out.flush()
+
+
+class CsvSink(BufferedSink):
+    """ A path,rating,tags row per image """
+
+    def __init__(self, interrogator: 'Interrogator', threshold: float, out, header=True, **kwargs) -> None:
+        super().__init__(interrogator, threshold, **kwargs)
+        self.out = out
+        self.writer = csv.writer(out)
+        self.target = f'csv:{getattr(out, "name", "")}'
+        if header:
+            self.writer.writerow(['path', 'rating', 'tags'])
+
+    def row(self, path: Path, confidents) -> List[str]:
+        ratings, _ = self.interrogator.split_confidents(confidents)
+        rating = self.interrogator.ratings[ratings.argmax()] if len(ratings) else ''
+        tags = self.interrogator.postprocess(confidents, self.threshold)
+        return [str(path), rating, ", ".join(tags.keys())]
+
+    def write_rows(self, rows: List[List[str]]) -> None:
+        self.writer.writerows(rows)
+        self.out.flush()
+
+
+class SqliteSink(BufferedSink):
+    """
+    A results table keyed by path, so tagging an image again replaces its
+    row, written one transaction per bulk write. ratings and tags are JSON
+    objects, confidents the float32 bytes of the full row, whose column
+    names are in the vocabularies table.
+    """
+
+    def __init__(
+        self,
+        interrogator: 'Interrogator',
+        threshold: float,
+        path: os.PathLike,
+        confidences=False,
+        **kwargs
+    ) -> None:
+        super().__init__(interrogator, threshold, **kwargs)
+        self.path = Path(path)
+        self.confidences = confidences
+        self.target = f'sqlite:{self.path}'
+        self.model_id = None
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            ' path TEXT PRIMARY KEY,'
+            ' model TEXT NOT NULL,'
+            ' threshold REAL NOT NULL,'
+            ' rating TEXT,'
+            ' ratings TEXT NOT NULL,'
+            ' tags TEXT NOT NULL,'
+            ' confidents BLOB,'
+            ' tagged REAL NOT NULL)'
+        )
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS vocabularies ('
+            ' model TEXT PRIMARY KEY,'
+            ' names TEXT NOT NULL)'
+        )
+        self.db.commit()
+
+    def row(self, path: Path, confidents):
+        if self.model_id is None:
+            self.model_id = self.interrogator.model_id()
+        if self.confidences:
+            self.names()
+        record = self.record(path, confidents)
+        ratings = record['ratings']
+        return (
+            record['path'], self.model_id, self.threshold,
+            max(ratings, key=ratings.get) if ratings else None,
+            json.dumps(ratings, ensure_ascii=False),
+            json.dumps(record['tags'], ensure_ascii=False),
+            confidents.astype('float32').tobytes() if self.confidences else None,
+            time.time(),
+        )
+
+    def write_rows(self, rows: List) -> None:
+        with self.db:
+            if self.confidences:
+                self.db.execute(
+                    'INSERT OR IGNORE INTO vocabularies VALUES (?, ?)',
+                    (self.model_id, json.dumps(self.names(), ensure_ascii=False)))
+            self.db.executemany(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def close(self) -> None:
+        super().close()
+        self.db.close()
+
+
+class ParquetSink(BufferedSink):
+    """
+    A Parquet file with a row group per bulk write. ratings and tags are
+    maps of name to confidence, confidents a fixed size list, and the
+    file's metadata holds the model, threshold and, with confidences, the
+    column names. Parquet files can't be appended to, so given a
+    directory, every run adds a part file to it, which readers such as
+    pyarrow.dataset take as one table. Needs pyarrow.
+    """
+
+    def __init__(
+        self,
+        interrogator: 'Interrogator',
+        threshold: float,
+        path: os.PathLike,
+        confidences=False,
+        buffer_size=1024,
+        **kwargs
+    ) -> None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError('Parquet output needs pyarrow, install it with pip install pyarrow') from e
+        super().__init__(interrogator, threshold, buffer_size=buffer_size, **kwargs)
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.confidences = confidences
+        self.target = f'parquet:{path}'
+        path = Path(path)
+        if path.is_dir():
+            path = path / f'part-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}.parquet'
+        self.path = path
+        self.writer = None
+
+    def row(self, path: Path, confidents):
+        record = self.record(path, confidents)
+        if self.confidences:
+            self.names()
+        return (
+            record['path'],
+            list(record['ratings'].items()),
+            list(record['tags'].items()),
+            confidents.astype('float32') if self.confidences else None,
+        )
+
+    def _open(self, width: int) -> None:
+        pa = self.pa
+        self.width = width
+        confidence_map = pa.map_(pa.string(), pa.float32())
+        fields = [
+            ('path', pa.string()),
+            ('ratings', confidence_map),
+            ('tags', confidence_map),
+        ]
+        metadata = {
+            'model': self.interrogator.model_id(),
+            'threshold': str(self.threshold),
+        }
+        if self.confidences:
+            fields.append(('confidents', pa.list_(pa.float32(), width)))
+            metadata['vocabulary'] = json.dumps(self.names(), ensure_ascii=False)
+        self.schema = pa.schema(fields, metadata=metadata)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.writer = self.pq.ParquetWriter(str(self.path), self.schema)
+
+    def write_rows(self, rows: List) -> None:
+        pa = self.pa
+        if self.writer is None:
+            self._open(len(rows[0][3]) if self.confidences else 0)
+        columns = [
+            pa.array([r[0] for r in rows], pa.string()),
+            pa.array([r[1] for r in rows], self.schema.field('ratings').type),
+            pa.array([r[2] for r in rows], self.schema.field('tags').type),
+        ]
+        if self.confidences:
+            # one flat buffer, cut into rows of the vocabulary's width
+            data = pa.py_buffer(b''.join(r[3].tobytes() for r in rows))
+            flat = pa.Array.from_buffers(pa.float32(), len(data) // 4, [None, data])
+            columns.append(pa.FixedSizeListArray.from_arrays(flat, self.width))
+        self.writer.write_table(pa.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self) -> None:
+        super().close()
+        if self.writer is not None:
+            self.writer.close()
+
+
+def write_vocabulary(path: os.PathLike, model_id: str, names: List[str]) -> None:
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'model': model_id, 'names': names}, f, ensure_ascii=False)
+    os.replace(tmp, path)
@@ -0,0 +1,221 @@
+"""Precomputed tag vocabularies, cached on disk as NumPy arrays"""
+
+import csv
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from tagger.paths import user_cache_dir
+
+tag_escape_pattern = re.compile(r'([\\()])')
+
+# category of the rating rows in selected_tags.csv
+RATING_CATEGORY = 9
+# tags of unknown category, such as everything in an MLDanbooru classes.json
+UNKNOWN_CATEGORY = -1
+
+# parsed vocabularies are kept here, keyed by the source file's path,
+# size and modification time
+vocab_cache_dir = os.environ.get('BOORUVISION_VOCAB_CACHE') or str(user_cache_dir() / 'vocab')
+
+# bump when the cached layout changes
+CACHE_VERSION = 1
+
+# names are stored as one utf-8 blob, separated by a character no tag has
+_SEPARATOR = '\x00'
+
+
+def escape_tag(tag: str) -> str:
+    return tag_escape_pattern.sub(r'\\\1', tag)
+
+
+def _pack(names: Iterable[str]) -> np.ndarray:
+    return np.frombuffer(_SEPARATOR.join(names).encode('utf-8'), dtype=np.uint8)
+
+
+def _unpack(blob: np.ndarray, count: int) -> np.ndarray:
+    if count == 0:
+        return np.array([], dtype=object)
+    return np.array(blob.tobytes().decode('utf-8').split(_SEPARATOR), dtype=object)
+
+
+class Vocabulary:
+    """
+    Every name a model outputs, ratings first, with its category and the
+    formatted variants postprocessing can ask for, computed once so that
+    formatting a result is an array lookup.
+
+    names, categories and the variants are parallel arrays over all outputs,
+    ratings and tags hold the two parts of names.
+    """
+
+    def __init__(
+        self,
+        names: np.ndarray,
+        categories: Optional[np.ndarray] = None,
+        rating_count=0,
+        variants: Optional[Dict[str, np.ndarray]] = None
+    ) -> None:
+        self.names = np.asarray(names, dtype=object)
+        if categories is None:
+            categories = np.full(len(self.names), UNKNOWN_CATEGORY, dtype=np.int16)
+        self.categories = np.asarray(categories, dtype=np.int16)
+        self.rating_count = rating_count
+
+        if variants is None:
+            underscore = [name.replace('_', ' ') for name in self.names]
+            variants = {
+                'underscore': np.array(underscore, dtype=object),
+                'escaped': np.array([escape_tag(n) for n in self.names], dtype=object),
+                'underscore_escaped': np.array([escape_tag(n) for n in underscore], dtype=object),
+            }
+        self.variants = variants
+        self._index: Optional[Dict[str, int]] = None
+
+    @property
+    def ratings(self) -> np.ndarray:
+        return self.names[:self.rating_count]
+
+    @property
+    def tags(self) -> np.ndarray:
+        return self.names[self.rating_count:]
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def variant(self, replace_underscore=False, escape=False) -> np.ndarray:
+        """ All names as formatted by Interrogator.format_tags with these flags """
+        if replace_underscore and escape:
+            return self.variants['underscore_escaped']
+        if replace_underscore:
+            return self.variants['underscore']
+        if escape:
+            return self.variants['escaped']
+        return self.names
+
+    def tag_variant(self, replace_underscore=False, escape=False) -> np.ndarray:
+        """ Same as variant, for the tag part only """
+        return self.variant(replace_underscore, escape)[self.rating_count:]
+
+    def index(self) -> Dict[str, int]:
+        """ Name -> position in names, built on first use """
+        if self._index is None:
+            self._index = {name: i for i, name in enumerate(self.names.tolist())}
+        return self._index
+
+    def format_names(
+        self,
+        names: Iterable[str],
+        replace_underscore=False,
+        escape=False
+    ) -> List[str]:
+        """ Look up formatted names, names outside the vocabulary are formatted on the spot """
+        index = self.index()
+        formatted = self.variant(replace_underscore, escape)
+        result = []
+        for name in names:
+            i = index.get(name)
+            if i is None:
+                if replace_underscore:
+                    name = name.replace('_', ' ')
+                result.append(escape_tag(name) if escape else name)
+            else:
+                result.append(formatted[i])
+        return result
+
+    def save(self, path: os.PathLike) -> None:
+        """ Write as an uncompressed .npz, atomically so readers never see half of it """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                version=np.array(CACHE_VERSION),
+                count=np.array(len(self.names)),
+                rating_count=np.array(self.rating_count),
+                categories=self.categories,
+                names=_pack(self.names),
+                **{key: _pack(values) for key, values in self.variants.items()}
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: os.PathLike) -> 'Vocabulary':
+        with np.load(path, allow_pickle=False) as data:
+            if int(data['version']) != CACHE_VERSION:
+                raise ValueError(f'{path} has an outdated layout')
+            count = int(data['count'])
+            return cls(
+                _unpack(data['names'], count),
+                data['categories'],
+                int(data['rating_count']),
+                {
+                    key: _unpack(data[key], count)
+                    for key in ('underscore', 'escaped', 'underscore_escaped')
+                })
+
+    @classmethod
+    def from_csv(cls, path: os.PathLike) -> 'Vocabulary':
+        """
+        Parse a selected_tags.csv. The leading rows of the rating category
+        are the ratings, everything after them is a tag.
+        """
+        names = []
+        categories = []
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            for row in csv.DictReader(f):
+                names.append(row['name'])
+                categories.append(int(row.get('category') or UNKNOWN_CATEGORY))
+
+        rating_count = 0
+        while rating_count < len(categories) and categories[rating_count] == RATING_CATEGORY:
+            rating_count += 1
+        if all(c == UNKNOWN_CATEGORY for c in categories):
+            # no category column, the WD layout has 4 ratings first
+            rating_count = min(4, len(names))
+        return cls(np.array(names, dtype=object), np.array(categories), rating_count)
+
+    @classmethod
+    def from_json(cls, path: os.PathLike) -> 'Vocabulary':
+        """ Parse a JSON list of tag names, as MLDanbooru ships, there are no ratings """
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(np.array(json.load(f), dtype=object))
+
+
+def cache_path(source: os.PathLike) -> Path:
+    source = Path(source)
+    stat = source.stat()
+    key = f'{source.resolve()}:{stat.st_size}:{stat.st_mtime_ns}:{CACHE_VERSION}'
+    digest = hashlib.blake2b(key.encode(), digest_size=10).hexdigest()
+    return Path(vocab_cache_dir) / f'{source.stem}-{digest}.npz'
+
+
+def load_vocabulary(source: os.PathLike) -> Vocabulary:
+    """
+    The vocabulary of a tags file, from the on disk cache if it was parsed
+    before. A changed file gets a new cache entry, since its size or
+    modification time is part of the key.
+    """
+    cached = cache_path(source)
+    if cached.is_file():
+        try:
+            return Vocabulary.load(cached)
+        except (OSError, ValueError, KeyError) as e:
+            print(f'Ignoring unreadable vocabulary cache {cached}: {e}')
+
+    if str(source).endswith('.json'):
+        vocabulary = Vocabulary.from_json(source)
+    else:
+        vocabulary = Vocabulary.from_csv(source)
+
+    try:
+        vocabulary.save(cached)
+    except OSError as e:
+        print(f'Could not cache vocabulary in {cached}: {e}')
+    return vocabulary
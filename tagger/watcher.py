@@ -0,0 +1,264 @@
+"""Watching directories for new images, through inotify or polling"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from tagger import metrics
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_MOVED_FROM
+
+_EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+    """ The inotify calls of libc, on Linux only """
+
+    def __init__(self) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        # watch descriptor -> directory
+        self.watches: Dict[int, Path] = {}
+
+    def add_watch(self, path: Path, mask=WATCH_MASK) -> None:
+        wd = self._add_watch(self.fd, os.fsencode(str(path)), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), str(path))
+        self.watches[wd] = path
+
+    def read(self, timeout: float) -> Iterator[Tuple[Optional[Path], int]]:
+        """ (path, mask) of the events arriving within timeout seconds,
+        path is None for a queue overflow, and the directory for IN_IGNORED """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + _EVENT.size <= len(buf):
+            wd, mask, _, length = _EVENT.unpack_from(buf, offset)
+            name = buf[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+            offset += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                yield None, mask
+                continue
+            if mask & IN_IGNORED:
+                # the directory went away
+                directory = self.watches.pop(wd, None)
+                if directory is not None:
+                    yield directory, mask
+                continue
+            directory = self.watches.get(wd)
+            if directory is not None and name:
+                yield directory / os.fsdecode(name), mask
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class FolderWatcher:
+    """
+    Yields the image files that appear in, or are rewritten in, the watched
+    directories, once they are completely written. Files already there are
+    yielded first, unless scan_existing is off.
+
+    A file counts as complete when its size and modification time haven't
+    changed for settle seconds. Files are noticed through inotify where it
+    is available, and by listing the directories every poll_interval
+    seconds otherwise, or with polling on. Hidden files, as many downloaders
+    write to before renaming, are ignored.
+
+    Iteration ends once stop() is called, from any thread.
+    """
+
+    def __init__(
+        self,
+        directories: Iterable[os.PathLike],
+        extensions: Iterable[str],
+        recursive=False,
+        settle=0.5,
+        poll_interval=2.0,
+        polling=False,
+        scan_existing=True
+    ) -> None:
+        self.directories = [Path(d) for d in directories]
+        self.extensions = {e.lower() for e in extensions}
+        self.recursive = recursive
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.scan_existing = scan_existing
+        self.stopped = threading.Event()
+        # path -> (size, mtime_ns) and when it last changed
+        self.pending: Dict[Path, Tuple[Tuple[int, int], float]] = {}
+        # what every file yielded looked like then, while it still exists,
+        # so rescans don't yield it again
+        self.seen: Dict[Path, Tuple[int, int]] = {}
+
+        self.inotify: Optional[Inotify] = None
+        if not polling:
+            try:
+                self.inotify = Inotify()
+            except (OSError, AttributeError) as e:
+                print(f'inotify is not available ({e}), polling every {poll_interval}s')
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def wanted(self, path: Path) -> bool:
+        return path.suffix.lower() in self.extensions and not path.name.startswith('.')
+
+    def _signature(self, path: Path) -> Optional[Tuple[int, int]]:
+        try:
+            stat = path.stat()
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def _notice(self, path: Path, now: float) -> None:
+        """ Track a file that may have been written """
+        if not self.wanted(path):
+            return
+        signature = self._signature(path)
+        if signature is None or signature == self.seen.get(path):
+            return
+        previous = self.pending.get(path)
+        if previous is None or previous[0] != signature:
+            self.pending[path] = (signature, now)
+
+    def _forget(self, path: Path, directory=False) -> None:
+        """ Drop a file that was deleted or moved away, or everything under a directory """
+        if not directory:
+            self.seen.pop(path, None)
+            self.pending.pop(path, None)
+            return
+        for known in (self.seen, self.pending):
+            for p in [p for p in known if path in p.parents]:
+                del known[p]
+
+    def _directories(self, directory: Path) -> List[Path]:
+        if not self.recursive:
+            return [directory]
+        return [directory] + [p for p in directory.rglob('*') if p.is_dir()]
+
+    def _scan(self, directory: Path, now: float) -> None:
+        found = set()
+        try:
+            for path in directory.rglob('*') if self.recursive else directory.iterdir():
+                if path.is_file():
+                    found.add(path)
+                    self._notice(path, now)
+        except OSError as e:
+            print(f'Cannot list {directory}: {e}')
+            return
+        # what's gone since the last scan, polling gets no delete events
+        for path in [
+            p for p in self.seen
+            if p not in found and (directory in p.parents if self.recursive else p.parent == directory)
+        ]:
+            del self.seen[path]
+
+    def _watch(self, directory: Path, now: float) -> None:
+        """ Watch directory and its subdirectories, and pick up what is already there """
+        for d in self._directories(directory):
+            try:
+                self.inotify.add_watch(d)
+            except OSError as e:
+                print(f'Cannot watch {d}: {e}')
+        # files may have landed before the watch was added
+        self._scan(directory, now)
+
+    def _ready(self, now: float) -> List[Path]:
+        ready = []
+        for path, (signature, changed) in list(self.pending.items()):
+            current = self._signature(path)
+            if current is None:
+                # deleted or renamed away before it was done
+                del self.pending[path]
+            elif current != signature:
+                self.pending[path] = (current, now)
+            elif now - changed >= self.settle:
+                del self.pending[path]
+                self.seen[path] = current
+                ready.append(path)
+        metrics.queue_depth('watch', len(self.pending))
+        return sorted(ready)
+
+    def _wait(self, timeout: float) -> None:
+        """ Collect changes for up to timeout seconds """
+        if self.inotify is None:
+            self.stopped.wait(timeout)
+            now = time.monotonic()
+            for directory in self.directories:
+                self._scan(directory, now)
+            return
+
+        for path, mask in self.inotify.read(timeout):
+            now = time.monotonic()
+            if path is None:
+                print('inotify queue overflowed, rescanning')
+                for directory in self.directories:
+                    self._scan(directory, now)
+            elif mask & (IN_DELETE | IN_MOVED_FROM | IN_IGNORED):
+                self._forget(path, directory=bool(mask & (IN_ISDIR | IN_IGNORED)))
+            elif mask & IN_ISDIR:
+                if self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch(path, now)
+            else:
+                self._notice(path, now)
+
+    def __iter__(self) -> Iterator[Path]:
+        now = time.monotonic()
+        for directory in self.directories:
+            if self.inotify is not None:
+                self._watch(directory, now)
+            elif self.scan_existing:
+                self._scan(directory, now)
+        if not self.scan_existing:
+            # only what changes from now on
+            for path, (signature, _) in self.pending.items():
+                self.seen[path] = signature
+            self.pending.clear()
+        # files already there are complete
+        for path in list(self.pending):
+            self.pending[path] = (self.pending[path][0], now - self.settle)
+
+        try:
+            while not self.stopped.is_set():
+                for path in self._ready(time.monotonic()):
+                    yield path
+                # wake up in time for the next file to settle
+                timeout = self.poll_interval
+                if self.pending:
+                    oldest = min(changed for _, changed in self.pending.values())
+                    timeout = min(timeout, max(0.05, oldest + self.settle - time.monotonic()))
+                if self.inotify is not None:
+                    # stop() is noticed at least this often
+                    timeout = min(timeout, 0.5)
+                self._wait(timeout)
+        finally:
+            if self.inotify is not None:
+                self.inotify.close()
+                self.inotify = None
@@ -0,0 +1,94 @@
+"""Fixtures shared by the tests: a stub WD-style ONNX model and a few images"""
+
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+# the stub takes 32x32 inputs, and has the 4 WD ratings and 16 tags
+INPUT_SIZE = 32
+RATINGS = ['general', 'sensitive', 'questionable', 'explicit']
+TAGS = [f'tag_{i}' for i in range(16)]
+
+
+def write_stub_model(path: Path, outputs: int) -> None:
+    """ sigmoid(mean colour @ W), so differently coloured images get different tags """
+    onnx = pytest.importorskip('onnx')
+    from onnx import TensorProto, helper, numpy_helper
+
+    weights = np.random.default_rng(0).standard_normal((3, outputs)).astype(np.float32) / 64
+    nodes = [
+        helper.make_node('ReduceMean', ['x', 'axes'], ['mean'], keepdims=0),
+        helper.make_node('MatMul', ['mean', 'weights'], ['logits']),
+        helper.make_node('Sigmoid', ['logits'], ['y']),
+    ]
+    graph = helper.make_graph(
+        nodes, 'stub',
+        [helper.make_tensor_value_info(
+            'x', TensorProto.FLOAT, ['batch', INPUT_SIZE, INPUT_SIZE, 3])],
+        [helper.make_tensor_value_info('y', TensorProto.FLOAT, ['batch', outputs])],
+        [numpy_helper.from_array(weights, 'weights'),
+         numpy_helper.from_array(np.array([1, 2], dtype=np.int64), 'axes')])
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 18)])
+    # readable by every onnxruntime the requirements allow
+    model.ir_version = 8
+    onnx.save(model, str(path))
+
+
+@pytest.fixture(scope='session')
+def stub_model_dir(tmp_path_factory) -> Path:
+    pytest.importorskip('onnxruntime')
+    directory = tmp_path_factory.mktemp('stub-model')
+    write_stub_model(directory / 'model.onnx', len(RATINGS) + len(TAGS))
+    with open(directory / 'selected_tags.csv', 'w', encoding='utf-8') as f:
+        f.write('tag_id,name,category,count\n')
+        for i, name in enumerate(RATINGS):
+            f.write(f'{i},{name},9,0\n')
+        for i, name in enumerate(TAGS, len(RATINGS)):
+            f.write(f'{i},{name},0,0\n')
+    return directory
+
+
+@pytest.fixture(autouse=True)
+def isolated_user_dirs(tmp_path, monkeypatch) -> None:
+    """ Keep the vocabulary cache and the model manifest out of the user's directories """
+    import tagger.interrogators
+    import tagger.vocabulary
+
+    monkeypatch.setattr(tagger.vocabulary, 'vocab_cache_dir', str(tmp_path / 'vocab'))
+    monkeypatch.setattr(tagger.interrogators, 'manifest_path', str(tmp_path / 'models.json'))
+
+
+@pytest.fixture
+def stub_interrogator(stub_model_dir):
+    from tagger.interrogator import WaifuDiffusionInterrogator
+
+    interrogator = WaifuDiffusionInterrogator('stub', model_dir=str(stub_model_dir))
+    yield interrogator
+    interrogator.unload()
+
+
+@pytest.fixture
+def image_dir(tmp_path) -> Path:
+    """ A few plain coloured images, each tagged differently by the stub """
+    directory = tmp_path / 'images'
+    directory.mkdir()
+    colours = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0), (40, 40, 40)]
+    for i, colour in enumerate(colours):
+        Image.new('RGB', (48, 40), colour).save(directory / f'{i}.png')
+    return directory
+
+
+@pytest.fixture
+def registered_stub(stub_model_dir, monkeypatch):
+    """ The stub registered as local model 'stub', in a registry thrown away afterwards """
+    import tagger.interrogators
+
+    monkeypatch.setattr(tagger.interrogators, 'interrogators', dict(tagger.interrogators.interrogators))
+    monkeypatch.setattr(tagger.interrogators, '_local_models', {})
+    monkeypatch.setattr(tagger.interrogators, '_ensembles', {})
+    monkeypatch.setattr(tagger.interrogators, '_manifest_loaded', True)
+    interrogator = tagger.interrogators.register_local_model('stub', str(stub_model_dir))
+    yield interrogator
+    interrogator.unload()
@@ -0,0 +1,111 @@
+import time
+
+import numpy as np
+
+from tagger.cache import ResultCache
+
+# 16 float32 confidents, 64 bytes an entry
+ROW = np.linspace(0, 1, 16, dtype=np.float32)
+ENTRY_SIZE = ROW.nbytes
+
+
+def keys(cache):
+    return {digest for digest, in cache.db.execute('SELECT digest FROM results')}
+
+
+def put(cache, *digests):
+    for digest in digests:
+        cache.put(digest, 'stub@local', ROW)
+        # distinct access times, eviction goes by them
+        time.sleep(0.002)
+
+
+def test_round_trip(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache.sqlite'))
+    put(cache, 'a')
+    assert np.array_equal(cache.get('a', 'stub@local'), ROW)
+    assert cache.get('a', 'other@local') is None
+    assert cache.get('b', 'stub@local') is None
+    cache.close()
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache.sqlite'), max_size=4 * ENTRY_SIZE)
+    put(cache, *'abcdef')
+    assert keys(cache) == set('cdef')
+    assert cache.total_size == 4 * ENTRY_SIZE
+    cache.close()
+
+
+def test_hit_keeps_entry(tmp_path):
+    # hits are only collected, eviction has to write them out first
+    cache = ResultCache(
+        str(tmp_path / 'cache.sqlite'), max_size=4 * ENTRY_SIZE,
+        touch_batch=1000, touch_interval=1000)
+    put(cache, *'abcd')
+    assert cache.get('a', 'stub@local') is not None
+    time.sleep(0.002)
+    put(cache, 'e', 'f')
+    assert keys(cache) == {'a', 'd', 'e', 'f'}
+    cache.close()
+
+
+def test_hits_are_written_in_batches(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache.sqlite'), touch_batch=3, touch_interval=1000)
+    put(cache, *'abc')
+
+    def accessed():
+        return dict(cache.db.execute('SELECT digest, accessed FROM results'))
+
+    stored = accessed()
+    cache.get('a', 'stub@local')
+    cache.get('b', 'stub@local')
+    cache.get('b', 'stub@local')
+    assert accessed() == stored
+    # the third entry hit fills the batch
+    cache.get('c', 'stub@local')
+    assert all(accessed()[d] > stored[d] for d in 'abc')
+
+    stored = accessed()
+    time.sleep(0.002)
+    cache.get('a', 'stub@local')
+    cache.flush()
+    assert accessed()['a'] > stored['a']
+    cache.close()
+
+
+def test_replacing_counts_once(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache.sqlite'), max_size=4 * ENTRY_SIZE)
+    put(cache, 'a', 'b', 'a', 'a')
+    assert cache.total_size == 2 * ENTRY_SIZE
+    put(cache, 'c', 'd')
+    assert keys(cache) == set('abcd')
+    cache.close()
+
+
+def test_shared_file_evicts_other_writers(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    first = ResultCache(path, max_size=4 * ENTRY_SIZE)
+    second = ResultCache(path, max_size=4 * ENTRY_SIZE)
+    put(first, *'abc')
+    # second only knows its own entries until it counts again
+    put(second, *'de')
+    put(second, *'fgh')
+    assert keys(second) == set('efgh')
+    assert second.total_size == 4 * ENTRY_SIZE
+    first.close()
+    second.close()
+
+
+def test_reopen_counts_size(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    cache = ResultCache(path)
+    put(cache, *'abc')
+    cache.close()
+
+    cache = ResultCache(path)
+    assert cache.total_size == 3 * ENTRY_SIZE
+    cache.clear()
+    assert cache.total_size == 0
+    assert cache.get('a', 'stub@local') is None
+    cache.close()
@@ -0,0 +1,86 @@
+import io
+import json
+import os
+import shutil
+
+from tagger.manifest import MANIFEST_NAME, TaggingManifest
+from tagger.pipeline import TaggingPipeline
+from tagger.pool import ModelPool
+from tagger.sinks import JsonlSink
+from wd_tagger import wd_tagger
+
+
+def tagger_for(threshold=0.35) -> wd_tagger:
+    return wd_tagger(threshold, model='stub', pool=ModelPool())
+
+
+def test_second_run_skips_everything(registered_stub, image_dir):
+    assert tagger_for().tag_images(image_dir, incremental=True) == 5
+    assert len(list(image_dir.glob('*.txt'))) == 5
+    assert tagger_for().tag_images(image_dir, incremental=True) == 0
+    # without the manifest, everything is tagged again
+    assert tagger_for().tag_images(image_dir) == 5
+
+
+def test_changed_files_are_tagged_again(registered_stub, image_dir):
+    tagger_for().tag_images(image_dir, incremental=True)
+
+    # touched only, it is hashed and still skipped
+    stat = os.stat(image_dir / '0.png')
+    os.utime(image_dir / '0.png', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    # new content, and a sidecar gone missing
+    shutil.copyfile(image_dir / '2.png', image_dir / '1.png')
+    (image_dir / '3.txt').unlink()
+
+    assert tagger_for().tag_images(image_dir, incremental=True) == 2
+    assert (image_dir / '3.txt').is_file()
+    assert tagger_for().tag_images(image_dir, incremental=True) == 0
+
+
+def test_other_settings_tag_again(registered_stub, image_dir):
+    tagger_for().tag_images(image_dir, incremental=True)
+    assert tagger_for(0.5).tag_images(image_dir, incremental=True) == 5
+    assert tagger_for(0.5).tag_images(image_dir, ext='.tags', incremental=True) == 5
+    assert tagger_for(0.5).tag_images(image_dir, ext='.tags', incremental=True) == 0
+
+
+def test_interrupted_run_resumes(registered_stub, image_dir):
+    """ Only results a buffered sink wrote out are recorded, the rest are
+    tagged again by the next run """
+    paths = sorted(image_dir.glob('*.png'))
+    out = io.StringIO()
+    sink = JsonlSink(registered_stub, 0.35, out, buffer_size=2, flush_interval=None)
+    manifest = TaggingManifest.for_interrogator(
+        image_dir / MANIFEST_NAME, registered_stub, 0.35, output=sink.target)
+    pipeline = TaggingPipeline(registered_stub, batch_size=2, workers=1)
+    assert pipeline.run(manifest.pending(paths), manifest.recorder(sink)) == 5
+
+    # stopped before the sink was closed, the fifth result was never written
+    assert len(out.getvalue().splitlines()) == 4
+    manifest.close()
+
+    manifest = TaggingManifest.for_interrogator(
+        image_dir / MANIFEST_NAME, registered_stub, 0.35, output=sink.target)
+    assert len(manifest) == 4
+    pending = list(manifest.pending(paths))
+    assert len(pending) == 1
+    assert manifest.skipped == 4
+    written = {json.loads(line)['path'] for line in out.getvalue().splitlines()}
+    assert str(pending[0]) not in written
+    manifest.close()
+
+
+def test_manifest_moves_with_the_dataset(registered_stub, image_dir, tmp_path):
+    tagger_for().tag_images(image_dir, incremental=True)
+    moved = tmp_path / 'moved'
+    image_dir.rename(moved)
+    assert tagger_for().tag_images(moved, incremental=True) == 0
+
+
+def test_forget(registered_stub, image_dir):
+    tagger_for().tag_images(image_dir, incremental=True)
+    manifest = TaggingManifest.for_interrogator(
+        image_dir / MANIFEST_NAME, registered_stub, 0.35, output='.txt')
+    manifest.forget(image_dir / '4.png')
+    assert list(manifest.pending(sorted(image_dir.glob('*.png')))) == [image_dir / '4.png']
+    manifest.close()
@@ -0,0 +1,26 @@
+import pytest
+
+from tagger.pipeline import TaggingPipeline
+
+
+def test_run_tags_every_path(stub_interrogator, image_dir):
+    results = {}
+    pipeline = TaggingPipeline(stub_interrogator, batch_size=2, workers=2)
+    paths = sorted(image_dir.glob('*.png'))
+    assert pipeline.run(paths, results.__setitem__) == len(paths)
+    assert sorted(results) == paths
+
+
+def test_failing_paths_are_raised(stub_interrogator, image_dir):
+    """ An error listing the paths must not leave run() waiting for the decoders """
+    paths = sorted(image_dir.glob('*.png'))
+
+    def listing():
+        yield from paths[:3]
+        raise PermissionError('cannot list')
+
+    results = {}
+    pipeline = TaggingPipeline(stub_interrogator, batch_size=2, workers=2)
+    with pytest.raises(PermissionError):
+        pipeline.run(listing(), results.__setitem__)
+    assert sorted(results) == paths[:3]
@@ -0,0 +1,134 @@
+import os
+import time
+
+import pytest
+
+import tagger.pool
+from tagger.interrogator import WaifuDiffusionInterrogator
+from tagger.pool import ModelPool
+
+
+@pytest.fixture
+def stubs(stub_model_dir, monkeypatch):
+    """ Two models on the stub's files, each accounted as the size of its model file """
+    monkeypatch.setattr(tagger.pool, 'resident_bytes', lambda: None)
+    models = [
+        WaifuDiffusionInterrogator(name, model_dir=str(stub_model_dir))
+        for name in ('first', 'second')
+    ]
+    yield models
+    for model in models:
+        model.unload()
+
+
+def model_size(stub_model_dir):
+    return os.path.getsize(stub_model_dir / 'model.onnx')
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def test_without_limits_models_stay_loaded(stubs):
+    pool = ModelPool()
+    for model in stubs:
+        with pool.use(model):
+            pass
+    assert all(model.is_loaded() for model in stubs)
+    assert pool.stats()['memory_bytes'] == sum(os.path.getsize(m.model_file) for m in stubs)
+
+
+def test_budget_unloads_least_recently_used(stubs, stub_model_dir):
+    first, second = stubs
+    pool = ModelPool(max_memory=model_size(stub_model_dir) * 3 // 2)
+    with pool.use(first):
+        pass
+    with pool.use(second):
+        pass
+    assert not first.is_loaded()
+    assert second.is_loaded()
+    assert pool.evictions == 1
+
+    stats = pool.stats()
+    assert stats['memory_bytes'] <= stats['max_memory_bytes']
+    assert not stats['models']['first']['loaded']
+    assert stats['models']['first']['memory_bytes'] == 0
+    assert stats['models']['first']['unloads'] == 1
+
+    # used again, it is loaded again and the other one goes
+    with pool.use(first):
+        assert first.is_loaded()
+    assert not second.is_loaded()
+    assert first.loads == 2
+
+
+def test_budget_keeps_models_in_use(stubs, stub_model_dir):
+    first, second = stubs
+    pool = ModelPool(max_memory=model_size(stub_model_dir) * 3 // 2)
+    pool.acquire(first)
+    with pool.use(second):
+        pass
+    # nothing could go while first runs, so the pool is over budget for now
+    assert first.is_loaded() and second.is_loaded()
+    pool.release(first)
+    with pool.use(second):
+        pass
+    assert not first.is_loaded()
+    assert second.is_loaded()
+
+
+def test_budget_keeps_pinned_models(stubs, stub_model_dir):
+    first, second = stubs
+    pool = ModelPool(max_memory=model_size(stub_model_dir) * 3 // 2)
+    pool.pin(first)
+    for model in (first, second, second, first, second):
+        with pool.use(model):
+            pass
+    assert first.is_loaded()
+    assert first.loads == 1
+    assert pool.evictions == 1
+    assert pool.stats()['models']['first']['pinned']
+
+
+def test_lowering_budget_unloads(stubs, stub_model_dir):
+    pool = ModelPool()
+    for model in stubs:
+        with pool.use(model):
+            pass
+    pool.configure(max_memory=model_size(stub_model_dir) * 3 // 2)
+    assert [model.is_loaded() for model in stubs] == [False, True]
+
+
+def test_idle_models_are_unloaded(stubs):
+    first, second = stubs
+    pool = ModelPool(idle_timeout=0.2)
+    with pool.use(first):
+        pass
+    pool.acquire(second)
+    try:
+        assert wait_for(lambda: not first.is_loaded())
+        # in use, second is never idle
+        time.sleep(0.4)
+        assert second.is_loaded()
+    finally:
+        pool.release(second)
+    assert wait_for(lambda: not second.is_loaded())
+    assert pool.evictions == 2
+    assert pool.stats()['memory_bytes'] == 0
+    pool.configure(idle_timeout=None)
+
+
+def test_unload_refuses_models_in_use(stubs):
+    first, _ = stubs
+    pool = ModelPool()
+    pool.acquire(first)
+    assert not pool.unload(first)
+    assert first.is_loaded()
+    pool.release(first)
+    assert pool.unload(first)
+    assert not first.is_loaded()
@@ -0,0 +1,98 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from tagger.interrogator import Interrogator
+
+from conftest import TAGS
+
+
+def as_tag_dict(names, confidents):
+    """ What the GUI hands to postprocess_tags """
+    return dict(zip(names.tolist(), confidents))
+
+
+@pytest.mark.parametrize(
+    'additional_tags, exclude_tags, sort_by_alphabetical_order, add_confident_as_weight',
+    list(itertools.product(
+        [[], ['tag_3'], ['tag_3', 'not_a_tag']],
+        [[], ['tag_1', 'tag_3']],
+        [False, True],
+        [False, True],
+    ))
+)
+def test_postprocess_confidents_matches_postprocess_tags(
+    additional_tags, exclude_tags, sort_by_alphabetical_order, add_confident_as_weight
+):
+    names = np.array(TAGS, dtype=object)
+    rng = np.random.default_rng(1)
+    for _ in range(50):
+        confidents = rng.random(len(names)).astype(np.float32)
+        # ties have to keep the same order too
+        confidents[5] = confidents[6]
+        kwargs = dict(
+            threshold=0.35,
+            additional_tags=additional_tags,
+            exclude_tags=exclude_tags,
+            sort_by_alphabetical_order=sort_by_alphabetical_order,
+            add_confident_as_weight=add_confident_as_weight,
+        )
+        expected = Interrogator.postprocess_tags(as_tag_dict(names, confidents), **kwargs)
+        actual = Interrogator.postprocess_confidents(names, confidents, **kwargs)
+        assert list(actual.items()) == list(expected.items())
+
+
+def test_postprocess_confidents_batch():
+    names = np.array(TAGS, dtype=object)
+    confidents = np.random.default_rng(2).random((3, len(names))).astype(np.float32)
+    rows = Interrogator.postprocess_confidents(names, confidents, 0.5)
+    assert rows == [Interrogator.postprocess_confidents(names, row, 0.5) for row in confidents]
+
+
+@pytest.mark.parametrize('replace_underscore, escape_tag', [(True, False), (False, True), (True, True)])
+def test_postprocess_formats_like_postprocess_tags(stub_interrogator, replace_underscore, escape_tag):
+    stub_interrogator.load_tags()
+    confidents = np.random.default_rng(3).random(
+        len(stub_interrogator.ratings) + len(stub_interrogator.tags)).astype(np.float32)
+    _, tags = stub_interrogator.split_confidents(confidents)
+
+    expected = Interrogator.postprocess_tags(
+        as_tag_dict(stub_interrogator.tags, tags), 0.3,
+        replace_underscore=replace_underscore, escape_tag=escape_tag,
+        vocabulary=stub_interrogator.vocabulary)
+    actual = stub_interrogator.postprocess(
+        confidents, 0.3, replace_underscore=replace_underscore, escape_tag=escape_tag)
+    assert list(actual.items()) == list(expected.items())
+    assert expected and all('_' not in t for t in expected) == replace_underscore
+
+
+def test_stub_model_output(stub_interrogator, image_dir):
+    from tagger.pipeline import load_image
+
+    images = [load_image(p) for p in sorted(image_dir.iterdir())]
+    confidents = stub_interrogator.infer([stub_interrogator.preprocess(i) for i in images])
+    assert confidents.shape == (len(images), len(stub_interrogator.ratings) + len(TAGS))
+    names = stub_interrogator.tags
+    _, tags = stub_interrogator.split_confidents(confidents)
+    for row in tags:
+        assert list(stub_interrogator.postprocess_confidents(names, row, 0.35).items()) == \
+            list(Interrogator.postprocess_tags(as_tag_dict(names, row), 0.35).items())
+
+
+def test_stable_diffusion_format_escapes_backslashes():
+    """ The GUI's Stable Diffusion format, the same escaping as escape_tag """
+    from tagger.vocabulary import Vocabulary
+
+    vocabulary = Vocabulary(['general', '\\m/', 'hatsune_miku_(cosplay)', 'smile'], rating_count=1)
+    tags = ['hatsune_miku_(cosplay)', '\\m/', 'smile', 'not_in_(vocabulary)\\']
+    expected = ['hatsune miku \\(cosplay\\)', '\\\\m/', 'smile', 'not in \\(vocabulary\\)\\\\']
+    assert vocabulary.format_names(tags, replace_underscore=True, escape=True) == expected
+    # without a loaded model the GUI formats every tag on the spot
+    assert Vocabulary([]).format_names(tags, replace_underscore=True, escape=True) == expected
+
+    confidents = np.array([0.9, 0.8, 0.7], dtype=np.float32)
+    formatted = Interrogator.postprocess_tags(
+        dict(zip(vocabulary.tags.tolist(), confidents)),
+        replace_underscore=True, escape_tag=True, vocabulary=vocabulary)
+    assert list(formatted) == ['\\\\m/', 'hatsune miku \\(cosplay\\)', 'smile']
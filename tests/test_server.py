@@ -0,0 +1,86 @@
+import time
+
+import pytest
+
+from tagger.pipeline import load_image
+from tagger.pool import ModelPool
+
+pytest.importorskip('fastapi')
+pytest.importorskip('httpx')
+pytest.importorskip('multipart')
+
+
+@pytest.fixture
+def client(registered_stub, monkeypatch):
+    """ The server with the stub as its default model and a pool of its own """
+    from fastapi.testclient import TestClient
+    import server
+
+    monkeypatch.setattr(server, 'default_model', 'stub')
+    monkeypatch.setattr(server, 'pool', ModelPool())
+    monkeypatch.setattr(server, '_batchers', {})
+    with TestClient(server.app) as client:
+        yield client
+
+
+def upload(*paths):
+    return [('files', (path.name, path.read_bytes(), 'image/png')) for path in paths]
+
+
+def expected(interrogator, paths, threshold):
+    confidents = interrogator.infer([interrogator.preprocess(load_image(p)) for p in paths])
+    return [interrogator.postprocess(row, threshold) for row in confidents]
+
+
+def test_tag(client, registered_stub, image_dir):
+    paths = sorted(image_dir.glob('*.png'))
+    response = client.post('/tag', files=upload(*paths))
+    assert response.status_code == 200
+    body = response.json()
+    assert body['model'] == 'stub'
+    results = body['results']
+    # in input order
+    assert len(results) == len(paths)
+    for result, tags in zip(results, expected(registered_stub, paths, 0.35)):
+        assert list(result['ratings']) == registered_stub.ratings.tolist()
+        assert list(result['tags']) == list(tags)
+        assert list(result['tags'].values()) == pytest.approx([float(c) for c in tags.values()])
+
+
+def test_tag_threshold_and_model(client, registered_stub, image_dir):
+    path = image_dir / '0.png'
+    response = client.post('/tag', params={'model': 'stub', 'threshold': 0.6}, files=upload(path))
+    assert response.status_code == 200
+    tags, = expected(registered_stub, [path], 0.6)
+    assert list(response.json()['results'][0]['tags']) == list(tags)
+
+
+def test_tag_paths(client, registered_stub, image_dir):
+    paths = sorted(image_dir.glob('*.png'))[:2]
+    response = client.post('/tag/paths', json={'paths': [str(p) for p in paths]})
+    assert response.status_code == 200
+    results = response.json()['results']
+    assert [list(r['tags']) for r in results] == [
+        list(tags) for tags in expected(registered_stub, paths, 0.35)]
+
+
+def test_tag_errors(client, image_dir, tmp_path):
+    response = client.post('/tag', params={'model': 'no-such-model'}, files=upload(image_dir / '0.png'))
+    assert response.status_code == 404
+
+    broken = tmp_path / 'broken.png'
+    broken.write_bytes(b'not an image')
+    assert client.post('/tag', files=upload(broken)).status_code == 400
+
+
+def test_ready_and_models(client):
+    deadline = time.monotonic() + 10
+    while client.get('/ready').status_code != 200:
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+    models = {model['name']: model for model in client.get('/models').json()['models']}
+    assert models['stub']['loaded']
+    assert models['stub']['loads'] == 1
+    assert models['stub']['memory_bytes'] > 0
+    assert not models['wd-swinv2-v3']['loaded']
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from tagger.pipeline import TaggingPipeline
+from tagger.sharded import ShardedTagger
+
+pytestmark = pytest.mark.skipif(not ShardedTagger.available(), reason='needs fork')
+
+RUNNER_OPTIONS = {'intra_op_num_threads': 1, 'inter_op_num_threads': 1}
+
+
+def tag(pipeline, paths):
+    results = []
+    pipeline.run(paths, lambda path, row: results.append((path, row)))
+    return results
+
+
+def test_matches_single_process(stub_interrogator, image_dir):
+    paths = sorted(image_dir.glob('*.png'))
+    expected = tag(TaggingPipeline(stub_interrogator, batch_size=2, workers=1), paths)
+    sharded = ShardedTagger(stub_interrogator, batch_size=2, runners=2, decoders=1)
+    results = tag(sharded, paths)
+    # in input order
+    assert [path for path, _ in results] == paths
+    for (_, row), (_, expected_row) in zip(results, expected):
+        assert np.allclose(row, expected_row, atol=1e-6)
+
+
+def test_matching_options_keep_the_model_loaded(stub_interrogator, image_dir):
+    stub_interrogator.set_session_options(RUNNER_OPTIONS)
+    stub_interrogator.ensure_loaded()
+    tag(ShardedTagger(stub_interrogator, batch_size=2, runners=1, decoders=1),
+        sorted(image_dir.glob('*.png')))
+    assert stub_interrogator.is_loaded()
+    assert stub_interrogator.loads == 1
+    assert stub_interrogator.session_options == RUNNER_OPTIONS
+
+
+def test_other_options_are_restored(stub_interrogator, image_dir):
+    tag(ShardedTagger(stub_interrogator, batch_size=2, runners=1, decoders=1),
+        sorted(image_dir.glob('*.png')))
+    assert stub_interrogator.session_options == {}
+
+
+def test_failing_paths_are_raised(stub_interrogator, image_dir):
+    """ An error listing the paths must not leave the collector waiting """
+    paths = sorted(image_dir.glob('*.png'))
+
+    def listing():
+        yield from paths[:3]
+        raise PermissionError('cannot list')
+
+    results = []
+    sharded = ShardedTagger(stub_interrogator, batch_size=2, runners=1, decoders=1)
+    with pytest.raises(PermissionError):
+        sharded.run(listing(), lambda path, row: results.append(path))
+    assert results == paths[:3]
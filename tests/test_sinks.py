@@ -0,0 +1,157 @@
+import csv
+import io
+import json
+import sqlite3
+import time
+
+import numpy as np
+import pytest
+
+from tagger.pipeline import load_image
+from tagger.sinks import CsvSink, JsonlSink, SidecarSink, SqliteSink
+
+THRESHOLD = 0.35
+
+
+@pytest.fixture
+def results(stub_interrogator, image_dir):
+    """ (path, confidents) of every image, as the pipeline hands them to a sink """
+    paths = sorted(image_dir.glob('*.png'))
+    confidents = stub_interrogator.infer(
+        [stub_interrogator.preprocess(load_image(p)) for p in paths])
+    return list(zip(paths, confidents))
+
+
+def expected_tags(interrogator, confidents):
+    return interrogator.postprocess(confidents, THRESHOLD)
+
+
+def expected_rating(interrogator, confidents):
+    ratings, _ = interrogator.split_confidents(confidents)
+    return interrogator.ratings[ratings.argmax()]
+
+
+def test_sidecar(stub_interrogator, results):
+    sink = SidecarSink(stub_interrogator, THRESHOLD, '.txt')
+    path, confidents = results[0]
+    assert not sink.exists(path)
+    with sink:
+        for path, confidents in results:
+            sink(path, confidents)
+    for path, confidents in results:
+        assert sink.exists(path)
+        text = path.with_suffix('.txt').read_text()
+        assert text == ', '.join(expected_tags(stub_interrogator, confidents))
+    # the stub tells the images apart
+    assert len({path.with_suffix('.txt').read_text() for path, _ in results}) > 1
+
+
+def test_jsonl(stub_interrogator, results, tmp_path):
+    out = io.StringIO()
+    vocabulary_path = tmp_path / 'vocabulary.json'
+    with JsonlSink(
+        stub_interrogator, THRESHOLD, out, confidences=True, vocabulary_path=vocabulary_path
+    ) as sink:
+        for path, confidents in results:
+            sink(path, confidents)
+
+    lines = out.getvalue().splitlines()
+    assert len(lines) == len(results)
+    vocabulary = json.loads(vocabulary_path.read_text())
+    assert vocabulary['model'] == stub_interrogator.model_id()
+    assert vocabulary['names'] == stub_interrogator.ratings.tolist() + stub_interrogator.tags.tolist()
+    for line, (path, confidents) in zip(lines, results):
+        record = json.loads(line)
+        assert record['path'] == str(path)
+        assert list(record['ratings']) == stub_interrogator.ratings.tolist()
+        assert list(record['tags']) == list(expected_tags(stub_interrogator, confidents))
+        assert record['confidents'] == pytest.approx(confidents.tolist(), abs=1e-6)
+
+
+def test_csv(stub_interrogator, results):
+    out = io.StringIO()
+    with CsvSink(stub_interrogator, THRESHOLD, out) as sink:
+        for path, confidents in results:
+            sink(path, confidents)
+
+    rows = list(csv.reader(io.StringIO(out.getvalue())))
+    assert rows[0] == ['path', 'rating', 'tags']
+    assert rows[1:] == [
+        [str(path),
+         expected_rating(stub_interrogator, confidents),
+         ', '.join(expected_tags(stub_interrogator, confidents))]
+        for path, confidents in results
+    ]
+
+
+def test_sqlite(stub_interrogator, results, tmp_path):
+    path = tmp_path / 'out' / 'results.sqlite'
+    with SqliteSink(stub_interrogator, THRESHOLD, path, confidences=True) as sink:
+        for image, confidents in results:
+            sink(image, confidents)
+    # tagged again, the rows are replaced
+    with SqliteSink(stub_interrogator, THRESHOLD, path, confidences=True) as sink:
+        sink(*results[0])
+
+    db = sqlite3.connect(str(path))
+    rows = db.execute(
+        'SELECT path, model, threshold, rating, ratings, tags, confidents FROM results'
+        ' ORDER BY path').fetchall()
+    assert len(rows) == len(results)
+    for row, (image, confidents) in zip(rows, results):
+        assert row[:4] == (
+            str(image), stub_interrogator.model_id(), THRESHOLD,
+            expected_rating(stub_interrogator, confidents))
+        assert list(json.loads(row[5])) == list(expected_tags(stub_interrogator, confidents))
+        assert np.array_equal(np.frombuffer(row[6], dtype=np.float32), confidents)
+    names, = db.execute('SELECT names FROM vocabularies').fetchone()
+    assert json.loads(names)[:4] == stub_interrogator.ratings.tolist()
+    db.close()
+
+
+def test_parquet(stub_interrogator, results, tmp_path):
+    pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+    from tagger.sinks import ParquetSink
+
+    with ParquetSink(
+        stub_interrogator, THRESHOLD, tmp_path, confidences=True, buffer_size=2
+    ) as sink:
+        for path, confidents in results:
+            sink(path, confidents)
+
+    part, = tmp_path.glob('part-*.parquet')
+    table = pyarrow.parquet.read_table(str(part))
+    metadata = table.schema.metadata
+    assert metadata[b'model'].decode() == stub_interrogator.model_id()
+    assert json.loads(metadata[b'vocabulary'])[4:] == stub_interrogator.tags.tolist()
+    rows = table.to_pylist()
+    assert [row['path'] for row in rows] == [str(path) for path, _ in results]
+    for row, (_, confidents) in zip(rows, results):
+        assert [t for t, _ in row['tags']] == list(expected_tags(stub_interrogator, confidents))
+        assert row['confidents'] == pytest.approx(confidents.tolist())
+
+
+def test_buffered_writes_in_bulk(stub_interrogator, results):
+    out = io.StringIO()
+    flushed = []
+    sink = JsonlSink(stub_interrogator, THRESHOLD, out, buffer_size=2, flush_interval=None)
+    sink.flushed.append(flushed.append)
+    for path, confidents in results:
+        sink(path, confidents)
+    assert [len(paths) for paths in flushed] == [2, 2]
+    assert len(out.getvalue().splitlines()) == 4
+    sink.close()
+    assert flushed[-1] == [results[-1][0]]
+    assert sink.written == len(results)
+
+
+def test_buffered_writes_stale_results(stub_interrogator, results):
+    out = io.StringIO()
+    sink = JsonlSink(stub_interrogator, THRESHOLD, out, buffer_size=100, flush_interval=0.1)
+    sink(*results[0])
+    deadline = time.monotonic() + 5
+    while not out.getvalue() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert len(out.getvalue().splitlines()) == 1
+    sink.close()
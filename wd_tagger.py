@@ -1,31 +1,237 @@
-from tagger.interrogator import Interrogator, WaifuDiffusionInterrogator
-from PIL import Image
+"""
+Tagging without the GUI. Run `python -m wd_tagger --help` for the command
+line, which never imports PyQt5 or the hotkey modules.
+
+Importing this module is cheap: numpy, onnxruntime, huggingface_hub and the
+model registry are only imported once a model is used, or ahead of time
+from a background thread with warm_up.
+"""
+
+import argparse
+import contextlib
+import glob
+import json
+import signal
+import sys
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, List
+
 from pathlib import Path
 
-from tagger.interrogators import interrogators
+from tagger import metrics
+from tagger.manifest import MANIFEST_NAME, TaggingManifest
+from tagger.options import SESSION_OPTION_TYPES
+from tagger.pool import ModelPool, default_pool
+from tagger.sinks import (
+    SINK_FORMATS, CsvSink, JsonlSink, ParquetSink, SidecarSink, Sink, SqliteSink)
+
+if TYPE_CHECKING:
+    from tagger.cache import ResultCache
+
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.webp']
+
+def warm_up() -> threading.Thread:
+    """ Import the tagging modules from a background thread, so the first
+    analysis doesn't wait for them. Returns the thread. """
+    def run():
+        start = time.perf_counter()
+        import tagger.interrogators  # noqa: F401
+        import tagger.pipeline  # noqa: F401
+        metrics.observe('stage_seconds', time.perf_counter() - start, stage='import')
+
+    thread = threading.Thread(target=run, name='warm-up', daemon=True)
+    thread.start()
+    return thread
+
+def read_session_options(config):
+    """
+    Read onnxruntime session options from a ConfigParser. [Session] applies to
+    every model and [Session.<model>] overrides it for one model.
+    Returns (defaults, {model: options}).
+    """
+    defaults = {}
+    per_model = {}
+    for section in config.sections():
+        if section == 'Session':
+            options = defaults
+        elif section.startswith('Session.'):
+            options = per_model.setdefault(section[len('Session.'):], {})
+        else:
+            continue
+
+        for key in config[section]:
+            kind = SESSION_OPTION_TYPES.get(key)
+            if kind is None:
+                print(f"Unknown session option {key} in [{section}]")
+            elif kind is bool:
+                options[key] = config[section].getboolean(key)
+            elif kind is int:
+                options[key] = config[section].getint(key)
+            else:
+                options[key] = config[section][key]
+    return defaults, per_model
 
 class wd_tagger:
+    def get_interrogator(self, model):
+        from tagger.interrogators import get_interrogator
+
+        self.apply_session_options()
+        return get_interrogator(model, self.ensemble_merge, self.ensemble_weights)
+
     def image_interrogate(self,image, threshold, model):
-        interrogator = interrogators[model]
+        interrogator = self.get_interrogator(model)
         print(f"Using model: {model}\n Threshold: {threshold}")
-        im = image
-        result = interrogator.interrogate(im)
+        with self.pool.use(interrogator):
+            with metrics.stage('interrogate', model=model):
+                confidents = interrogator.interrogate_confidents([image], cache=self.cache)[0]
+            with metrics.stage('postprocess'):
+                tags = interrogator.postprocess(confidents, threshold)
+        metrics.inc('images_total', model=model)
         if(self.unloadAfterAnalysis):
-            interrogator.unload()
+            self.pool.unload(interrogator)
 
-        return Interrogator.postprocess_tags(result[1], threshold)
+        return tags
 
-    def __init__(self, threshold=0.35, model='wd-swinv2-v3'):
+    def __init__(
+        self,
+        threshold=0.35,
+        model='wd-swinv2-v3',
+        cache: 'ResultCache' = None,
+        session_options=None,
+        model_session_options=None,
+        pool: ModelPool = None
+    ):
         self.threshold = threshold
+        # a registered model name, or several joined with '+' for an ensemble
         self.model = model
+        # how an ensemble merges confidents: 'mean' or 'max', and optional per model weights
+        self.ensemble_merge = 'mean'
+        self.ensemble_weights = None
         self.unloadAfterAnalysis = False
+        # loaded models, unloaded for a memory budget or when idle, see set_pool_limits
+        self.pool = pool or default_pool
+        # decode large JPEGs at a reduced scale that still covers the model input
+        self.reduced_decoding = True
+        # load and warm up the model in the background whenever it changes
+        self.preload = False
+        self.on_model_ready = None
+        self.preload_threads = {}
+        # raw confidents are cached, so threshold changes never re-run the model,
+        # the cache file is opened on first use
+        self._cache = cache
+        self.cache_path = cache.path if cache is not None else None
+        self.cache_max_size = cache.max_size if cache is not None else 1 << 30
+        # (defaults, per model) session options waiting for the registry to be imported
+        self.pending_session_options = None
+        self.lock = threading.Lock()
+        if session_options or model_session_options:
+            self.configure_sessions(session_options, model_session_options)
+
+    def configure_sessions(self, session_options=None, model_session_options=None):
+        """ Set onnxruntime session options for every model, with per model overrides.
+        They are applied the next time a model is looked up. """
+        with self.lock:
+            self.pending_session_options = (session_options or {}, model_session_options or {})
+        if 'tagger.interrogators' in sys.modules:
+            self.apply_session_options()
+
+    def apply_session_options(self):
+        with self.lock:
+            pending, self.pending_session_options = self.pending_session_options, None
+        if pending is None:
+            return
+        from tagger.interrogators import all_interrogators
+
+        interrogators = all_interrogators()
+        session_options, model_session_options = pending
+        for name in model_session_options:
+            if name not in interrogators:
+                print(f"Session options given for unknown model {name}")
+        for name, interrogator in interrogators.items():
+            interrogator.set_session_options(
+                {**session_options, **model_session_options.get(name, {})})
+
+    def set_pool_limits(self, max_memory=None, idle_timeout=None):
+        """ Keep loaded models within max_memory bytes, and unload those idle
+        for idle_timeout seconds. None or 0 turns a limit off. """
+        self.pool.configure(max_memory, idle_timeout)
+
+    def memory_report(self):
+        """ Memory and load counts of the models loaded so far, see ModelPool.stats """
+        return self.pool.stats()
+
+    @property
+    def cache(self) -> 'ResultCache':
+        with self.lock:
+            if self._cache is None and self.cache_path:
+                from tagger.cache import ResultCache
+
+                self._cache = ResultCache(self.cache_path, self.cache_max_size)
+            return self._cache
+
+    def set_cache(self, cache_path, max_size=1 << 30):
+        if cache_path == self.cache_path and max_size == self.cache_max_size:
+            return
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+        self.cache_path = cache_path
+        self.cache_max_size = max_size
+
+    def is_model_loaded(self):
+        return self.get_interrogator(self.model).is_loaded()
+
+    def vocabulary(self):
+        """ Vocabulary of the selected model, None until it has loaded """
+        return self.get_interrogator(self.model).vocabulary
+
+    def preload_model(self):
+        """ Load and warm up the selected model on a background thread. The
+        model lookup happens there too, so the caller never waits for imports. """
+        model = self.model
+
+        def on_ready():
+            if self.on_model_ready is not None:
+                self.on_model_ready(model)
+
+        # already on its way
+        thread = self.preload_threads.get(model)
+        if thread is not None and thread.is_alive():
+            return thread
+
+        def run():
+            interrogator = self.get_interrogator(model)
+            # already warm
+            if interrogator.ready.is_set():
+                on_ready()
+                return
+            try:
+                with self.pool.use(interrogator):
+                    interrogator.preload(on_ready=on_ready).join()
+            except Exception as e:
+                print(f"Failed to preload {model}: {e}")
+
+        thread = threading.Thread(target=run, name=f'preload-{model}', daemon=True)
+        self.preload_threads[model] = thread
+        thread.start()
+        return thread
 
     def set_threshold_and_model(self, threshold, model):
+        changed = model != self.model
         self.threshold = threshold
         self.model = model
+        if changed and self.preload:
+            self.preload_model()
 
     def tag_image_by_path(self, image_path):
-        image = Image.open(image_path)
+        from tagger.pipeline import load_image
+
+        fits = None
+        if self.reduced_decoding:
+            fits = self.get_interrogator(self.model).fits_input
+        with metrics.stage('decode'):
+            image = load_image(image_path, fits)
         tags = self.image_interrogate(image, threshold=self.threshold, model=self.model)
         return tags
     
@@ -33,19 +239,298 @@ class wd_tagger:
         tags = self.image_interrogate(image, threshold=self.threshold, model=self.model)
         return tags
 
-    def tag_images(self, image_dir, ext='.txt'):
+    def tag_images(self, image_dir, ext='.txt', batch_size=8, workers=4, incremental=False, sink: Sink = None):
+        """ Tag every image in image_dir into sink, a sidecar with ext by default.
+        With incremental, a manifest in image_dir records what was tagged, and
+        only new or changed images, images whose sidecar is gone, or all of
+        them after a model or threshold change are tagged again.
+        A sink passed in is flushed, not closed. """
+        interrogator = self.get_interrogator(self.model)
         d = Path(image_dir)
-        for f in d.iterdir():
-            if not f.is_file() or f.suffix not in ['.png', '.jpg', '.webp']:
-                continue
-            image_path = Path(f)
-            print('processing:', image_path)
-            tags = self.image_interrogate(image_path, threshold=self.threshold, model=self.model)
-            tags_str = ", ".join(tags.keys())
-            with open(f.parent / f"{f.stem}{ext}", "w") as fp:
-                fp.write(tags_str)
+        paths = (
+            f for f in d.iterdir()
+            if f.is_file() and f.suffix.lower() in IMAGE_EXTENSIONS
+        )
+        own_sink = sink is None
+        if own_sink:
+            sink = SidecarSink(interrogator, self.threshold, ext)
+        manifest = None
+        if incremental:
+            manifest = TaggingManifest.for_interrogator(
+                d / MANIFEST_NAME, interrogator, self.threshold, output=sink.target)
+        try:
+            return self.tag_paths(
+                paths, sink, batch_size=batch_size, workers=workers, manifest=manifest)
+        finally:
+            # written out before the manifest records it
+            if own_sink:
+                sink.close()
+            else:
+                sink.flush()
+            if manifest is not None:
+                manifest.close()
+
+    def tag_paths(
+        self,
+        paths: Iterable[Path],
+        on_result: Callable,
+        batch_size=8,
+        workers=4,
+        processes=0,
+        threads_per_process=None,
+        manifest: TaggingManifest = None,
+        max_latency: float = None
+    ) -> int:
+        """ Tag image files through the pipeline, calling on_result(path, confidents)
+        as each one completes, usually a Sink. Returns the number of tagged images.
+        With processes, inference is sharded over that many processes of
+        threads_per_process threads, see ShardedTagger.
+        With a manifest, only the paths it reports pending are tagged, and
+        each is recorded once on_result returned, or a buffered sink wrote it out.
+        With max_latency, partial batches are run after that many seconds,
+        see TaggingPipeline. """
+        from tagger.pipeline import TaggingPipeline
+        from tagger.sharded import ShardedTagger
+
+        interrogator = self.get_interrogator(self.model)
+        print(f"Using model: {self.model}\n Threshold: {self.threshold}")
+        if processes and not ShardedTagger.available():
+            print("Multi-process tagging needs fork, using a single process")
+            processes = 0
+        if processes and max_latency is not None:
+            print("Multi-process tagging always fills its batches, using a single process")
+            processes = 0
+        if processes:
+            # the processes decode too, so workers become decoder processes
+            pipeline = ShardedTagger(
+                interrogator, batch_size=batch_size, runners=processes,
+                threads_per_runner=threads_per_process, decoders=workers,
+                reduced_decoding=self.reduced_decoding)
+        else:
+            pipeline = TaggingPipeline(
+                interrogator, batch_size=batch_size, workers=workers, cache=self.cache,
+                reduced_decoding=self.reduced_decoding, max_latency=max_latency)
+        if manifest is not None:
+            paths = manifest.pending(paths, getattr(on_result, 'exists', None))
+            on_result = manifest.recorder(on_result)
+        with self.pool.use(interrogator):
+            processed = pipeline.run(paths, on_result)
+        if manifest is not None and manifest.skipped:
+            print(f"Skipped {manifest.skipped} images tagged before")
+        if(self.unloadAfterAnalysis):
+            self.pool.unload(interrogator)
+        return processed
 
     def tag_file(self, image_path):
-        tags = self.image_interrogate(Path(image_path), threshold=self.threshold, model=self.model)
+        tags = self.tag_image_by_path(image_path)
         tags_str = ", ".join(tags.keys())
         print(tags_str)
+
+
+def expand_inputs(inputs: Iterable[str], recursive=False) -> Iterator[Path]:
+    """ Image files named by file paths, glob patterns or directories """
+    for item in inputs:
+        path = Path(item)
+        if path.is_file():
+            yield path
+            continue
+        if path.is_dir():
+            candidates = sorted(path.glob('**/*' if recursive else '*'))
+        else:
+            candidates = sorted(Path(p) for p in glob.glob(item, recursive=recursive))
+            if not candidates:
+                print(f"No files match {item}", file=sys.stderr)
+        for candidate in candidates:
+            if candidate.is_file() and candidate.suffix.lower() in IMAGE_EXTENSIONS:
+                yield candidate
+
+
+def read_path_list(stream) -> Iterator[str]:
+    """ One path per line, blank lines skipped """
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield line
+
+
+def manifest_path(inputs: List[str]) -> Path:
+    """ The manifest of a single input directory goes in it, else in the working directory """
+    if len(inputs) == 1 and Path(inputs[0]).is_dir():
+        return Path(inputs[0]) / MANIFEST_NAME
+    return Path(MANIFEST_NAME)
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='python -m wd_tagger',
+        description='Tag images without the GUI. Results are written as they complete.')
+    parser.add_argument(
+        'inputs', nargs='*',
+        help='image files, glob patterns or directories, "-" or nothing reads paths from stdin')
+    parser.add_argument('-m', '--model', default='wd-swinv2-v3',
+                        help='registered model name, join several with + for an ensemble')
+    parser.add_argument('-t', '--threshold', type=float, default=0.35)
+    parser.add_argument('-b', '--batch-size', type=int, default=8)
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='image decoding threads, or processes with --processes')
+    parser.add_argument('-p', '--processes', type=int, default=0,
+                        help='run the model in this many processes, results stay in input order')
+    parser.add_argument('--threads-per-process', type=int, default=None,
+                        help='onnxruntime threads of each --processes process, with the '
+                             'default of 1 the processes share one copy of the model')
+    parser.add_argument('-f', '--format', choices=SINK_FORMATS, default='txt',
+                        help='txt writes a sidecar file next to each image, '
+                             'the others write to --output in bulk')
+    parser.add_argument('-o', '--output', default='-',
+                        help='output file, stdout by default for jsonl/csv. '
+                             'A parquet directory gets a part file per run')
+    parser.add_argument('--confidences', action='store_true',
+                        help='store every rating and tag confidence too, with jsonl, sqlite or parquet')
+    parser.add_argument('--ext', default='.txt', help='sidecar file extension')
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='descend into subdirectories, and let ** match them in globs')
+    parser.add_argument('--cache', default='', help='result cache file')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='skip images tagged before with the same model and threshold, '
+                             f'recorded in {MANIFEST_NAME} of the input directory')
+    parser.add_argument('--manifest', default='',
+                        help='manifest file of --incremental, implies it. '
+                             'jsonl/csv --output is appended to')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and tag images as they arrive in the input '
+                             'directories, implies --incremental')
+    parser.add_argument('--settle', type=float, default=0.5,
+                        help='seconds a file must stay unchanged before --watch tags it')
+    parser.add_argument('--max-latency-ms', type=float, default=500,
+                        help='with --watch, run a partial batch this long after its first image')
+    parser.add_argument('--poll-interval', type=float, default=2.0,
+                        help='seconds between directory listings where inotify is unavailable')
+    parser.add_argument('--poll', action='store_true', help='poll with --watch even with inotify')
+    parser.add_argument('--merge', choices=['mean', 'max'], default='mean',
+                        help='how an ensemble merges confidents')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='serve Prometheus metrics on this port')
+    parser.add_argument('--metrics-log', default='',
+                        help='append a JSON metrics snapshot to this file periodically')
+    parser.add_argument('--metrics-interval', type=float, default=10.0)
+    parser.add_argument('--profile-sample-rate', type=float, default=0.0,
+                        help='share of inference calls traced by the onnxruntime profiler')
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] = None) -> int:
+    args = parse_args(argv)
+    # machine readable results own stdout, everything else goes to stderr
+    out = sys.stdout
+
+    if args.metrics_port or args.metrics_log or args.profile_sample_rate:
+        metrics.configure(
+            port=args.metrics_port, json_log=args.metrics_log,
+            interval=args.metrics_interval, sample_rate=args.profile_sample_rate)
+
+    tagger = wd_tagger(threshold=args.threshold, model=args.model)
+    tagger.ensemble_merge = args.merge
+    if args.cache:
+        tagger.set_cache(args.cache)
+
+    if args.format in ('sqlite', 'parquet') and args.output == '-':
+        print(f"{args.format} output needs --output", file=sys.stderr)
+        return 2
+    if args.confidences and args.format in ('txt', 'csv'):
+        print(f"--confidences can't be stored in {args.format}", file=sys.stderr)
+        return 2
+
+    incremental = args.incremental or args.watch or bool(args.manifest)
+    inputs = args.inputs
+    manifest_file = Path(args.manifest) if args.manifest else manifest_path(inputs)
+    watcher = None
+    if args.watch:
+        from tagger.watcher import FolderWatcher
+
+        if not inputs or not all(Path(d).is_dir() for d in inputs):
+            print("--watch takes directories only", file=sys.stderr)
+            return 2
+        paths = watcher = FolderWatcher(
+            inputs, IMAGE_EXTENSIONS, recursive=args.recursive, settle=args.settle,
+            poll_interval=args.poll_interval, polling=args.poll)
+    else:
+        if not inputs or inputs == ['-']:
+            inputs = read_path_list(sys.stdin)
+        paths = expand_inputs(inputs, recursive=args.recursive)
+
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(contextlib.redirect_stdout(sys.stderr))
+        header = True
+        if args.format in ('jsonl', 'csv') and args.output != '-':
+            # incrementally, the earlier runs' results stay
+            mode = 'a' if incremental else 'w'
+            out = stack.enter_context(
+                open(args.output, mode, encoding='utf-8', newline=''))
+            header = out.tell() == 0
+
+        interrogator = tagger.get_interrogator(args.model)
+        if args.format == 'jsonl':
+            vocabulary_path = None
+            if args.confidences and args.output != '-':
+                vocabulary_path = f'{args.output}.vocabulary.json'
+            sink = JsonlSink(
+                interrogator, args.threshold, out,
+                confidences=args.confidences, vocabulary_path=vocabulary_path)
+        elif args.format == 'csv':
+            sink = CsvSink(interrogator, args.threshold, out, header=header)
+        elif args.format == 'sqlite':
+            sink = SqliteSink(interrogator, args.threshold, args.output, confidences=args.confidences)
+        elif args.format == 'parquet':
+            if incremental:
+                if Path(args.output).is_file():
+                    print("Incremental parquet output goes to a directory", file=sys.stderr)
+                    return 2
+                Path(args.output).mkdir(parents=True, exist_ok=True)
+            try:
+                sink = ParquetSink(
+                    interrogator, args.threshold, args.output, confidences=args.confidences)
+            except ImportError as e:
+                print(e, file=sys.stderr)
+                return 2
+        else:
+            sink = SidecarSink(interrogator, args.threshold, args.ext)
+
+        manifest = None
+        if incremental:
+            manifest = TaggingManifest.for_interrogator(
+                manifest_file, interrogator, args.threshold, output=sink.target)
+            stack.callback(manifest.close)
+        # closed first, the manifest records what it wrote out
+        stack.callback(sink.close)
+
+        max_latency = None
+        if watcher is not None:
+            # stop watching, then finish what was already read
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                previous = signal.signal(signum, lambda *_: watcher.stop())
+                stack.callback(signal.signal, signum, previous)
+            max_latency = args.max_latency_ms / 1000
+            print(f"Watching {', '.join(args.inputs)}, press Ctrl+C to stop")
+
+        start = time.perf_counter()
+        processed = tagger.tag_paths(
+            paths, sink, batch_size=args.batch_size, workers=args.workers,
+            processes=args.processes, threads_per_process=args.threads_per_process,
+            manifest=manifest, max_latency=max_latency)
+        elapsed = time.perf_counter() - start
+
+    # includes model loading, unlike the pipeline's own summary
+    print(f"Tagged {processed} images in {elapsed:.1f}s, "
+          f"{processed / elapsed if elapsed > 0 else 0:.1f} images/sec overall",
+          file=sys.stderr)
+    if args.metrics_log:
+        # the last partial interval too
+        with open(args.metrics_log, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(metrics.snapshot()) + '\n')
+    if watcher is not None:
+        return 0
+    return 0 if processed or (manifest is not None and manifest.skipped) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())